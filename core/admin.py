@@ -1,5 +1,7 @@
+from django import forms
 from django.contrib import admin
-from core.models import AllowedExtension, Space, Asset
+from core.models import AllowedExtension, Space, Asset, AssetChange, Release, ApiToken, Job, CachePolicy
+from core import cachepolicy
 
 
 @admin.register(AllowedExtension)
@@ -19,6 +21,69 @@ class SpaceAdmin(admin.ModelAdmin):
 
 @admin.register(Asset)
 class AssetAdmin(admin.ModelAdmin):
-    list_display = ("space", "rel_path", "original_name", "size", "mime", "created_at")
+    list_display = ("space", "rel_path", "original_name", "size", "mime", "tier", "created_at")
     search_fields = ("original_name", "rel_path", "space__owner__username", "space__slug", "mime")
-    list_filter = ("space",)
+    list_filter = ("space", "tier")
+
+
+@admin.register(AssetChange)
+class AssetChangeAdmin(admin.ModelAdmin):
+    list_display = ("seq", "space", "op", "rel_path", "name", "new_rel_path", "new_name", "created_at")
+    list_filter = ("op", "space")
+    search_fields = ("rel_path", "name")
+
+
+@admin.register(Release)
+class ReleaseAdmin(admin.ModelAdmin):
+    list_display = ("id", "space", "site", "label", "state", "file_count", "total_bytes", "created_at", "promoted_at")
+    list_filter = ("state", "space")
+    search_fields = ("site", "label")
+    readonly_fields = ("file_count", "total_bytes")
+
+
+@admin.register(ApiToken)
+class ApiTokenAdmin(admin.ModelAdmin):
+    list_display = ("space", "name", "key_id", "scopes", "revoked", "expires_at", "created_at")
+    list_filter = ("revoked", "space")
+    search_fields = ("name", "key_id")
+    readonly_fields = ("key_id",)
+
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ("id", "space", "kind", "state", "progress", "total", "attempts", "created_at", "finished_at")
+    list_filter = ("state", "kind")
+    readonly_fields = ("progress", "total", "result", "error", "attempts", "locked_by", "heartbeat_at", "finished_at")
+
+
+class CachePolicyForm(forms.ModelForm):
+    class Meta:
+        model = CachePolicy
+        fields = "__all__"
+
+    def clean_cors_origins(self):
+        try:
+            return cachepolicy.validate_origins(self.cleaned_data["cors_origins"])
+        except ValueError as e:
+            raise forms.ValidationError(str(e))
+
+
+@admin.register(CachePolicy)
+class CachePolicyAdmin(admin.ModelAdmin):
+    form = CachePolicyForm
+    list_display = ("space", "prefix", "max_age", "immutable", "stale_while_revalidate", "cors_origins", "updated_at")
+    list_filter = ("immutable", "space")
+    search_fields = ("prefix", "space__slug", "space__owner__name_spase")
+
+    # every change re-renders the nginx map include (debounced, in the background)
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        cachepolicy.render_async()
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        cachepolicy.render_async()
+
+    def delete_queryset(self, request, queryset):
+        super().delete_queryset(request, queryset)
+        cachepolicy.render_async()
@@ -0,0 +1,106 @@
+"""Stateless API tokens for machine clients.
+
+A token is `cdn_` + a django.core.signing blob of {key_id, space_id}, sent as
+`Authorization: Bearer <token>`. The signature is checked in memory; the
+key's scopes, revocation and owner deactivation come from the cache (one DB
+read per key per API_TOKEN_CACHE_TTL), so steady-state token auth does no DB query and never
+touches the session. Token requests are bound to the token's space and skip
+CSRF, which stays enforced for the cookie-authenticated dashboard.
+"""
+from __future__ import annotations
+import copy, secrets
+from dataclasses import dataclass
+from functools import wraps
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+from django.http import JsonResponse
+from django.utils import timezone
+from .models import Space, ApiToken
+
+TOKEN_PREFIX = 'cdn_'
+TOKEN_SALT = 'core.apitoken'
+
+
+@dataclass
+class TokenAuth:
+    key_id: str
+    space: Space
+    scopes: frozenset
+
+
+def _cache_key(key_id: str) -> str:
+    return f"apitoken:{key_id}"
+
+def issue(space: Space, name: str, scopes, expires_at=None) -> tuple[ApiToken, str]:
+    """Create a token row and return it with the raw token (shown to the user once)."""
+    scopes = sorted(set(scopes) & set(ApiToken.SCOPES))
+    t = ApiToken.objects.create(space=space, name=name, key_id=secrets.token_hex(8),
+                                scopes=','.join(scopes), expires_at=expires_at)
+    raw = TOKEN_PREFIX + signing.dumps({'k': t.key_id, 's': space.id}, salt=TOKEN_SALT)
+    return t, raw
+
+def revoke(t: ApiToken):
+    ApiToken.objects.filter(id=t.id).update(revoked=True)
+    cache.delete(_cache_key(t.key_id))  # other processes notice within API_TOKEN_CACHE_TTL
+
+def _lookup(key_id: str) -> dict:
+    entry = cache.get(_cache_key(key_id))
+    if entry is None:
+        t = ApiToken.objects.select_related('space__owner').filter(
+            key_id=key_id, revoked=False, space__owner__is_active=True).first()
+        entry = {'ok': False} if t is None else {
+            'ok': True, 'space': t.space, 'user': t.space.owner,
+            'scopes': t.scope_set, 'expires_at': t.expires_at,
+        }
+        cache.set(_cache_key(key_id), entry, settings.API_TOKEN_CACHE_TTL)
+    return entry
+
+def authenticate(raw: str):
+    """(user, TokenAuth) for a valid token, else None."""
+    if not raw.startswith(TOKEN_PREFIX): return None
+    try:
+        payload = signing.loads(raw[len(TOKEN_PREFIX):], salt=TOKEN_SALT)
+    except signing.BadSignature:
+        return None
+    entry = _lookup(payload.get('k', ''))
+    if not entry['ok'] or entry['space'].id != payload.get('s'): return None
+    if entry['expires_at'] and entry['expires_at'] <= timezone.now(): return None
+    # copies: views may mutate the space (quota refresh) and must not touch the cached object
+    return entry['user'], TokenAuth(payload['k'], copy.copy(entry['space']), entry['scopes'])
+
+
+class ApiTokenMiddleware:
+    """Authenticates `Authorization: Bearer cdn_...` before the session is ever read."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.api_token = None
+        header = request.META.get('HTTP_AUTHORIZATION', '')
+        if header.startswith('Bearer '):
+            res = authenticate(header[7:].strip())
+            if res is None:
+                return JsonResponse({'ok': False, 'error': 'invalid token'}, status=401)
+            request.user, request.api_token = res
+            request._dont_enforce_csrf_checks = True  # no cookies involved
+        return self.get_response(request)
+
+
+def token_scope(scope: str | None, **by_method):
+    """Require `scope` (or by_method[request.method]) for token requests; sessions pass.
+    scope=None rejects token requests entirely (session-only endpoints)."""
+    def deco(view):
+        @wraps(view)
+        def wrapped(request, *args, **kwargs):
+            tok = getattr(request, 'api_token', None)
+            if tok is not None:
+                need = by_method.get(request.method, scope)
+                if need is None:
+                    return JsonResponse({'ok': False, 'error': 'not available with API tokens'}, status=403)
+                if need not in tok.scopes:
+                    return JsonResponse({'ok': False, 'error': f'token lacks {need} scope'}, status=403)
+            return view(request, *args, **kwargs)
+        return wrapped
+    return deco
@@ -0,0 +1,345 @@
+"""Benchmark harness for the core API (used by `manage.py bench`).
+
+Everything runs inside a throw-away test database and a temporary CDN_ROOT:
+spaces are seeded with N synthetic Asset rows (files on disk only where an
+endpoint needs them), then each scenario is driven either through the Django
+test client (latency + queries per request) or over real HTTP against an
+in-process threaded server (latency + throughput under concurrency).
+
+Memory: each scenario reports `peak_rss_kb`, the process high-water mark
+while it ran (reset before every scenario through /proc/self/clear_refs on
+Linux). Where that reset is not available the scenarios report None, since
+the process-wide `ru_maxrss` only grows. The per-scale `peak_rss_kb` is
+always the process-wide maximum so far, seeding included. In --http mode the
+server threads share the process and count too.
+"""
+from __future__ import annotations
+import json, os, platform, statistics, subprocess, tempfile, threading, time
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable
+from django.conf import settings
+from django.db import connection
+from django.test import Client
+from .models import AllowedExtension, Space, Asset, ApiToken
+from . import auth as api_auth
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+FOLDERS = 100
+FILE_BYTES = 4096
+
+
+def peak_rss_kb() -> int | None:
+    """Process-wide peak RSS since start (ru_maxrss, KiB on Linux)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource else None
+
+def reset_peak_rss() -> bool:
+    """Reset the process high-water mark (Linux); False where it cannot be reset."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def scenario_peak_rss_kb() -> int | None:
+    """VmHWM since the last reset_peak_rss()."""
+    try:
+        with open('/proc/self/status') as f:
+            return next(int(line.split()[1]) for line in f if line.startswith('VmHWM:'))
+    except (OSError, StopIteration, ValueError):
+        return None
+
+def percentile(values: list[float], p: float) -> float:
+    if not values: return 0.0
+    s = sorted(values)
+    k = min(len(s) - 1, max(0, round(p / 100 * (len(s) - 1))))
+    return s[k]
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR,
+                              capture_output=True, text=True, timeout=5).stdout.strip()
+    except Exception:
+        return ''
+
+
+# ---------- seeding ----------
+
+def seed_space(owner, scale: int, batch: int = 5000) -> Space:
+    """Space `s<scale>` with `scale` rows spread over FOLDERS folders (+ a nested one)."""
+    space = Space.objects.create(owner=owner, name=f"bench {scale}", slug=f"s{scale}",
+                                 max_bytes=1 << 50, max_files=1 << 30)
+    rows = []
+    for i in range(scale):
+        rel = 'deep/a/b' if i % 97 == 0 else f"d{i % FOLDERS:03d}"
+        rows.append(Asset(space=space, rel_path=rel, original_name=f"f{i:07d}.bin", size=FILE_BYTES,
+                          mime='application/octet-stream'))
+        if len(rows) >= batch:
+            Asset.objects.bulk_create(rows); rows.clear()
+    if rows: Asset.objects.bulk_create(rows)
+    Space.objects.filter(id=space.id).update(used_bytes=scale * FILE_BYTES, file_count=scale)
+    return space
+
+def seed_files(space: Space, rel: str, names: list[str]):
+    """Real files + rows for endpoints that touch the disk (delete, rename, zip)."""
+    base = Path(settings.CDN_ROOT) / space.owner.name_spase / space.slug / rel
+    base.mkdir(parents=True, exist_ok=True)
+    payload = os.urandom(FILE_BYTES)
+    for n in names: (base / n).write_bytes(payload)
+    Asset.objects.bulk_create([Asset(space=space, rel_path=rel, original_name=n, size=FILE_BYTES,
+                                     mime='application/octet-stream') for n in names])
+
+
+# ---------- scenarios ----------
+
+@dataclass
+class Request:
+    method: str
+    path: str
+    body: bytes | dict | None = None
+    content_type: str = 'application/json'
+
+@dataclass
+class Scenario:
+    name: str
+    build: Callable[[int], Request]
+    prepare: Callable[[Space, str, int], None] | None = None
+
+def _json(method, path, payload) -> Request:
+    return Request(method, path, json.dumps(payload).encode())
+
+def scenarios() -> list[Scenario]:
+    def prep_names(prefix, per=1):
+        def prepare(space, tag, n):
+            seed_files(space, f"work/{tag}", [f"{prefix}-{i}-{k}.bin" for i in range(n) for k in range(per)])
+        return prepare
+
+    return [
+        Scenario('spaces', lambda i: Request('GET', '/api/spaces')),
+        Scenario('allowed_extensions', lambda i: Request('GET', '/api/allowed-extensions')),
+        Scenario('browse_root', lambda i: Request('GET', '/api/browse?rel_path=')),
+        Scenario('browse_folder', lambda i: Request('GET', f"/api/browse?rel_path=d{i % FOLDERS:03d}")),
+        Scenario('browse_deep', lambda i: Request('GET', '/api/browse?rel_path=deep/a/b')),
+        Scenario('assets_search', lambda i: Request('GET', f"/api/assets?q=f{i % 10}")),
+        Scenario('upload', lambda i: Request('POST', '/api/upload?rel_path=work/upload', None, 'multipart')),
+        Scenario('zip', lambda i: _json('POST', '/api/zip', {'items': [
+            {'rel_path': 'work/{tag}', 'name': f"zip-{i}-{k}.bin"} for k in range(10)]}), prep_names('zip', 10)),
+        Scenario('rename', lambda i: _json('POST', '/api/rename', {
+            'old_rel_path': 'work/{tag}', 'old_name': f"ren-{i}-0.bin", 'new_name': f"renamed-{i}.bin"}), prep_names('ren')),
+        Scenario('delete', lambda i: _json('POST', '/api/delete', {
+            'rel_path': 'work/{tag}', 'name': f"del-{i}-0.bin"}), prep_names('del')),
+        Scenario('delete_batch', lambda i: _json('POST', '/api/delete-batch', {'items': [
+            {'rel_path': 'work/{tag}', 'name': f"bat-{i}-{k}.bin"} for k in range(10)]}), prep_names('bat', 10)),
+        Scenario('mkdir', lambda i: _json('POST', '/api/mkdir', {'rel_path': 'work/mk', 'name': f"m{i}"})),
+    ]
+
+def _materialize(req: Request, tag: str, i: int):
+    """Fill the per-run folder tag into JSON bodies; build multipart bodies for uploads."""
+    if req.content_type == 'multipart':
+        return req.method, req.path, {'file': _upload_file(f"up-{tag}-{i}.bin")}, None
+    body = req.body.replace(b'{tag}', tag.encode()) if isinstance(req.body, bytes) else req.body
+    return req.method, req.path, body, req.content_type
+
+def _upload_file(name):
+    from django.core.files.uploadedfile import SimpleUploadedFile
+    return SimpleUploadedFile(name, os.urandom(FILE_BYTES), content_type='application/octet-stream')
+
+
+# ---------- drivers ----------
+
+@dataclass
+class Result:
+    latencies_ms: list[float] = field(default_factory=list)
+    queries: list[int] = field(default_factory=list)
+    errors: int = 0
+    wall_s: float = 0.0
+    peak_rss_kb: int | None = None
+
+    def summary(self) -> dict:
+        n = len(self.latencies_ms)
+        return {
+            'requests': n, 'errors': self.errors,
+            'p50_ms': round(percentile(self.latencies_ms, 50), 3),
+            'p99_ms': round(percentile(self.latencies_ms, 99), 3),
+            'mean_ms': round(statistics.fmean(self.latencies_ms), 3) if n else 0.0,
+            'queries_per_request': round(statistics.fmean(self.queries), 2) if self.queries else None,
+            'throughput_rps': round(n / self.wall_s, 1) if self.wall_s else None,
+            'peak_rss_kb': self.peak_rss_kb,
+        }
+
+class _QueryCounter:
+    """execute_wrapper that counts queries (no DEBUG query log, no 9000-entry cap)."""
+
+    def __init__(self):
+        self.n = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.n += 1
+        return execute(sql, params, many, context)
+
+def run_client(client: Client, sc: Scenario, tag: str, n: int) -> Result:
+    res = Result()
+    t0 = time.perf_counter()
+    for i in range(n):
+        method, path, body, ctype = _materialize(sc.build(i), tag, i)
+        q = _QueryCounter()
+        with connection.execute_wrapper(q):
+            start = time.perf_counter()
+            if method == 'GET':
+                r = client.get(path)
+            elif ctype is None:
+                r = client.post(path, body)
+            else:
+                r = client.generic(method, path, body, content_type=ctype)
+            if hasattr(r, 'streaming_content'): b''.join(r.streaming_content)
+            res.latencies_ms.append((time.perf_counter() - start) * 1000)
+        res.queries.append(q.n)
+        if r.status_code >= 400: res.errors += 1
+    res.wall_s = time.perf_counter() - t0
+    return res
+
+def _multipart(name: str, data: bytes) -> tuple[bytes, str]:
+    boundary = 'benchboundary7f3a'
+    body = (f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"{name}\"\r\n"
+            f"Content-Type: application/octet-stream\r\n\r\n").encode() + data + f"\r\n--{boundary}--\r\n".encode()
+    return body, f"multipart/form-data; boundary={boundary}"
+
+def run_http(host: str, port: int, auth_headers: dict, sc: Scenario, tag: str, n: int, concurrency: int) -> Result:
+    res = Result()
+    local = threading.local()
+    lock = threading.Lock()
+
+    def one(i):
+        conn = getattr(local, 'conn', None)
+        if conn is None:
+            conn = local.conn = http.client.HTTPConnection(host, port, timeout=60)
+        method, path, body, ctype = _materialize(sc.build(i), tag, i)
+        headers = dict(auth_headers)
+        if ctype is None:
+            body, ctype = _multipart(f"up-{tag}-{i}.bin", os.urandom(FILE_BYTES))
+        if body is not None: headers['Content-Type'] = ctype
+        start = time.perf_counter()
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            r = conn.getresponse(); r.read()
+            ok = r.status < 400
+        except Exception:
+            local.conn = None
+            ok = False
+        ms = (time.perf_counter() - start) * 1000
+        with lock:
+            res.latencies_ms.append(ms)
+            if not ok: res.errors += 1
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as ex:
+        list(ex.map(one, range(n)))
+    res.wall_s = time.perf_counter() - t0
+    return res
+
+class _Server:
+    """Threaded WSGI server on an ephemeral port, sharing the test database."""
+
+    def __init__(self):
+        from django.core.handlers.wsgi import WSGIHandler
+        from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler
+
+        class Quiet(WSGIRequestHandler):
+            def log_message(self, *args): pass
+
+        self.httpd = ThreadedWSGIServer(('127.0.0.1', 0), Quiet, allow_reuse_address=False)
+        self.httpd.set_app(WSGIHandler())
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown(); self.httpd.server_close()
+
+
+# ---------- orchestration ----------
+
+def run(scales: list[int], requests: int, concurrency: int, http_mode: bool,
+        only: list[str] | None = None, log=print) -> dict:
+    """Create a test DB + temp CDN_ROOT, seed each scale and drive every scenario."""
+    from django.test.utils import setup_test_environment, teardown_test_environment, override_settings
+    from accounts.models import User
+
+    tmp = tempfile.TemporaryDirectory(prefix='cdn-bench-')
+    db = settings.DATABASES['default']
+    if db['ENGINE'].endswith('sqlite3'):
+        # file-backed so server threads see the same data
+        db.setdefault('TEST', {})['NAME'] = str(Path(tmp.name) / 'bench.sqlite3')
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    out = {
+        'meta': {'commit': git_commit(), 'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                 'python': platform.python_version(), 'db': connection.vendor,
+                 'requests': requests, 'concurrency': concurrency if http_mode else 1,
+                 'mode': 'http' if http_mode else 'client'},
+        'scales': {},
+    }
+    try:
+        with override_settings(CDN_ROOT=Path(tmp.name) / 'objects', ALLOWED_HOSTS=['*'], IMAGE_OPT_ENABLED=False):
+            AllowedExtension.objects.get_or_create(ext='bin')
+            user = User.objects.create_user('bench', 'bench@example.com', 'bench', name_spase='bench')
+            client = Client()
+            client.force_login(user)
+            for scale in scales:
+                t0 = time.perf_counter()
+                space = seed_space(user, scale)
+                log(f"seeded {scale} rows in {time.perf_counter() - t0:.1f}s")
+                session = client.session; session['space_id'] = space.id; session.save()
+                # HTTP mode drives the API the way machine clients do: Bearer token, no session/CSRF
+                _, raw = api_auth.issue(space, f"bench-{scale}", ApiToken.SCOPES)
+                auth_headers = {'Authorization': f"Bearer {raw}"}
+                results = {}
+                for sc in scenarios():
+                    if only and sc.name not in only: continue
+                    tag = f"{sc.name}-{scale}"
+                    if sc.prepare: sc.prepare(space, tag, requests)
+                    per_scenario = reset_peak_rss()
+                    if http_mode:
+                        with _Server() as srv:
+                            r = run_http('127.0.0.1', srv.port, auth_headers, sc, tag, requests, concurrency)
+                    else:
+                        r = run_client(client, sc, tag, requests)
+                    if per_scenario: r.peak_rss_kb = scenario_peak_rss_kb()
+                    results[sc.name] = r.summary()
+                    log(f"  {scale:>8} {sc.name:<20} " + json.dumps(results[sc.name]))
+                out['scales'][str(scale)] = {'endpoints': results, 'peak_rss_kb': peak_rss_kb()}
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+        tmp.cleanup()
+    return out
+
+def compare(old: dict, new: dict, threshold: float) -> tuple[list[str], int]:
+    """Text diff of two baselines; counts p50/p99/query regressions above `threshold` (fraction)."""
+    lines, regressions = [], 0
+    for scale, data in new['scales'].items():
+        base = old.get('scales', {}).get(scale, {}).get('endpoints', {})
+        for ep, cur in data['endpoints'].items():
+            prev = base.get(ep)
+            if not prev: continue
+            cells = []
+            for key in ('p50_ms', 'p99_ms', 'queries_per_request'):
+                a, b = prev.get(key), cur.get(key)
+                if not a or b is None: continue
+                delta = (b - a) / a
+                flag = ' !' if delta > threshold else ''
+                if flag: regressions += 1
+                cells.append(f"{key}={a}->{b} ({delta:+.0%}){flag}")
+            lines.append(f"{scale:>8} {ep:<20} " + '  '.join(cells))
+    return lines, regressions
@@ -0,0 +1,173 @@
+"""Cache-Control / CORS policies per Space and folder, compiled into nginx maps.
+
+nginx resolves a request to a policy with exact-match hash lookups: one map
+splits $uri into its directory and its space (two fixed regexes, no matter how
+many policies exist), the directory map falls back to the space map, and the
+policy id then selects the Cache-Control and CORS values. Folder policies are
+expanded to every folder that exists at render time (longest prefix wins).
+
+Folders created later are not in the hash yet. For those, and only after the
+hash missed, each folder policy also has an anchored prefix regex, so a new
+subfolder inherits its policy right away instead of waiting for a re-render.
+The directory key carries a per-space marker: requests to spaces without
+folder policies fail every regex on the first byte. Only policy edits rewrite
+the file (atomically) and reload nginx, and only when the content changed;
+`render_cache_policies` run from cron folds new folders into the hash.
+"""
+from __future__ import annotations
+import os, re, shlex, subprocess, threading, logging
+from pathlib import Path
+from django.conf import settings
+from django.db import connection, transaction
+from .models import Space, Asset, CachePolicy
+from .utils import fs_space_root
+
+log = logging.getLogger(__name__)
+
+ORIGIN_RE = re.compile(r"^https?://[A-Za-z0-9.-]+(:\d+)?$")
+MAX_KEY = 480  # keep below map_hash_bucket_size in cdn.nginx.conf
+
+HEADER = """\
+# Generated by `manage.py render_cache_policies` from CachePolicy rows; do not edit.
+# Policy lookups are exact-match hash lookups; folders created after the render
+# fall through to one anchored prefix regex per folder policy.
+map $uri $cdn_dir   { default ""; "~^(?<cdn_d>/cdn/.+)/[^/]+$" $cdn_d; }
+map $uri $cdn_space { default ""; "~^/cdn/(?<cdn_s>[^/]+/[^/]+)/" $cdn_s; }
+"""
+
+
+class PolicyError(Exception):
+    pass
+
+
+def validate_origins(value: str) -> str:
+    """Normalize a CORS origin list; raises ValueError on anything nginx should not echo."""
+    items = value.replace(',', ' ').split()
+    if items == ['*'] or not items:
+        return ' '.join(items)
+    bad = [o for o in items if not ORIGIN_RE.match(o)]
+    if bad: raise ValueError(f"invalid origin(s): {', '.join(bad)}")
+    return ' '.join(o.rstrip('/') for o in items)
+
+def _q(s: str) -> str:
+    return '"' + s.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def _folders(space: Space, prefix: str) -> set[str]:
+    """prefix and every folder below it, from Asset rows and the disk (empty folders)."""
+    found = {prefix}
+    for rel in (Asset.objects.filter(space=space, rel_path__startswith=f"{prefix}/")
+                .order_by().values_list('rel_path', flat=True).distinct().iterator()):
+        while rel != prefix and rel not in found:
+            found.add(rel)
+            rel = rel.rpartition('/')[0]
+    root = fs_space_root(space)
+    for dirpath, dirnames, _ in os.walk(root / prefix, followlinks=True):
+        for d in dirnames:
+            found.add(str(Path(dirpath, d).relative_to(root)))
+    return found
+
+def compile_maps() -> str:
+    """The nginx include for all CachePolicy rows."""
+    by_space: dict[int, list[CachePolicy]] = {}
+    for p in CachePolicy.objects.select_related('space__owner').order_by('space_id', 'prefix'):
+        by_space.setdefault(p.space_id, []).append(p)
+
+    space_map, marked, dir_map, dir_rx, policies = [], [], [], [], []
+    for ps in by_space.values():
+        space = ps[0].space
+        key = f"{space.owner.name_spase}/{space.slug}"
+        policies.extend(ps)
+        root = next((p for p in ps if not p.prefix), None)
+        if root: space_map.append((key, f"p{root.id}"))
+        nested = sorted((p for p in ps if p.prefix), key=lambda p: len(p.prefix), reverse=True)
+        if nested: marked.append(key)
+        dirs: set[str] = set()
+        for p in nested:
+            dirs |= _folders(space, p.prefix)
+        for d in sorted(dirs):
+            best = next(p for p in nested if d == p.prefix or d.startswith(p.prefix + '/'))
+            k = f"1/cdn/{key}/{d}"
+            if len(k) > MAX_KEY: continue  # too long for the hash; the prefix regex covers it
+            dir_map.append((k, f"p{best.id}"))
+        for p in nested:
+            dir_rx.append((len(p.prefix), f"~^1/cdn/{re.escape(key)}/{re.escape(p.prefix)}(/|$)", f"p{p.id}"))
+    dir_rx.sort(key=lambda e: e[0], reverse=True)  # regexes match in order: longest prefix wins
+
+    out = [HEADER]
+    out.append("map $cdn_space $cdn_space_policy {\n    default \"\";\n"
+               + ''.join(f"    {_q(k)} {v};\n" for k, v in space_map) + "}\n")
+    out.append("map $cdn_space $cdn_folder_policies {\n    default \"\";\n"
+               + ''.join(f"    {_q(k)} 1;\n" for k in marked) + "}\n")
+    out.append("map \"$cdn_folder_policies$cdn_dir\" $cdn_policy {\n    default $cdn_space_policy;\n"
+               + ''.join(f"    {_q(k)} {v};\n" for k, v in dir_map)
+               + ''.join(f"    {_q(k)} {v};\n" for _, k, v in dir_rx) + "}\n")
+    out.append(f"map $cdn_policy $cdn_cache_control {{\n    default {_q(settings.CACHE_DEFAULT_CONTROL)};\n"
+               + ''.join(f"    p{p.id} {_q(p.cache_control)};\n" for p in policies) + "}\n")
+    # listed origins are echoed back (with Vary: Origin); "*" and "" are sent as-is
+    out.append(f"map $cdn_policy $cdn_cors_default {{\n    default {_q(settings.CACHE_DEFAULT_CORS)};\n"
+               + ''.join(f"    p{p.id} {_q('*' if p.cors_origins.strip() == '*' else '')};\n" for p in policies) + "}\n")
+    out.append("map \"$cdn_policy $http_origin\" $cdn_cors_origin {\n    default $cdn_cors_default;\n"
+               + ''.join(f"    {_q(f'p{p.id} {o}')} {_q(o)};\n"
+                         for p in policies if p.cors_origins.strip() != '*' for o in p.origins) + "}\n")
+    out.append("map $cdn_policy $cdn_cors_vary {\n    default \"\";\n"
+               + ''.join(f"    p{p.id} \"Origin\";\n" for p in policies if p.origins and p.cors_origins.strip() != '*')
+               + "}\n")
+    return '\n'.join(out)
+
+def _run(cmd: str):
+    if not cmd: return
+    r = subprocess.run(shlex.split(cmd), capture_output=True, text=True, timeout=60)
+    if r.returncode != 0:
+        raise PolicyError(f"{cmd!r} failed: {(r.stderr or r.stdout).strip()}")
+
+def _replace(path: Path, text: str):
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    with tmp.open('w', encoding='utf-8') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def render(path: Path | None = None, reload: bool = True) -> bool:
+    """Write the map include; test + reload nginx if it changed. Returns whether it changed.
+    A config that fails CACHE_POLICY_TEST_CMD is rolled back to the previous file."""
+    path = Path(path or settings.CACHE_POLICY_MAP_PATH)
+    text = compile_maps()
+    old = path.read_text(encoding='utf-8') if path.exists() else None
+    if text == old: return False
+    path.parent.mkdir(parents=True, exist_ok=True)
+    _replace(path, text)
+    if reload:
+        try:
+            _run(settings.CACHE_POLICY_TEST_CMD)
+        except PolicyError:
+            if old is None: path.unlink(missing_ok=True)
+            else: _replace(path, old)
+            raise
+        _run(settings.CACHE_POLICY_RELOAD_CMD)
+    return True
+
+
+# ---------- automatic re-render ----------
+
+_timer: threading.Timer | None = None
+_lock = threading.Lock()
+
+def _render_bg():
+    try:
+        render()
+    except Exception:
+        log.exception("cache policy render failed")
+    finally:
+        connection.close()
+
+def render_async(delay: float = 2.0):
+    """Debounced background render: a burst of policy edits causes one reload."""
+    def schedule():
+        global _timer
+        with _lock:
+            if _timer is not None: _timer.cancel()
+            _timer = threading.Timer(delay, _render_bg)
+            _timer.daemon = True
+            _timer.start()
+    transaction.on_commit(schedule)
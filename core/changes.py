@@ -0,0 +1,125 @@
+"""Change feed and manifest diff for delta sync.
+
+Every Asset/folder mutation appends an AssetChange row in the mutation's own
+transaction; clients poll `/api/changes?since=<cursor>` and only see what
+happened after their cursor. Cursors come from Space.change_seq, incremented
+with the Space row locked until commit, so a space's changes become visible
+in cursor order and a client can never skip one that commits late.
+CI deploys post a `{path: {sha256, size}}` manifest to `/api/manifest/diff`
+and upload only what is missing or changed. Manifests hash the files as the
+client has them, so they are compared against the hash of the uploaded bytes
+(`source_sha256`), not against what image optimization left on disk.
+"""
+from __future__ import annotations
+import hashlib
+from django.db import transaction
+from django.db.models import F, Q
+from .models import Space, Asset, AssetChange
+from . import tiering
+
+FEED_MAX_LIMIT = 5000
+
+
+def _allocate(space: Space, n: int) -> int:
+    """Reserve n cursor values, returns the first. The UPDATE keeps the Space row locked
+    until the caller's transaction commits, which serializes feed writers per space."""
+    Space.objects.filter(id=space.id).update(change_seq=F('change_seq') + n)
+    return Space.objects.filter(id=space.id).values_list('change_seq', flat=True).get() - n + 1
+
+def record(space: Space, op: str, rel_path: str = '', name: str = '', **extra) -> AssetChange:
+    """Call inside the transaction of the mutation being recorded."""
+    with transaction.atomic():
+        seq = _allocate(space, 1)
+        return AssetChange.objects.create(space=space, seq=seq, op=op, rel_path=rel_path, name=name, **extra)
+
+def record_many(space: Space, op: str, items: list[dict]):
+    """Bulk variant for batch endpoints; items are AssetChange field dicts."""
+    if not items: return
+    with transaction.atomic():
+        first = _allocate(space, len(items))
+        AssetChange.objects.bulk_create([AssetChange(space=space, seq=first + i, op=op, **it)
+                                         for i, it in enumerate(items)])
+
+def current_cursor(space: Space) -> int:
+    return Space.objects.filter(id=space.id).values_list('change_seq', flat=True).first() or 0
+
+def feed(space: Space, since: int, limit: int) -> tuple[list[dict], int, bool]:
+    """Changes with seq > since, oldest first; returns (items, next cursor, more)."""
+    limit = max(1, min(limit, FEED_MAX_LIMIT))
+    rows = list(AssetChange.objects.filter(space=space, seq__gt=since).order_by('seq').values(
+        'seq', 'op', 'rel_path', 'name', 'new_rel_path', 'new_name', 'size', 'sha256', 'created_at'
+    )[:limit + 1])
+    more = len(rows) > limit
+    rows = rows[:limit]
+    items = [{
+        'seq': r['seq'], 'op': r['op'], 'rel_path': r['rel_path'], 'name': r['name'],
+        'new_rel_path': r['new_rel_path'], 'new_name': r['new_name'],
+        'size': r['size'], 'sha256': r['sha256'], 'at': r['created_at'].isoformat(),
+    } for r in rows]
+    return items, (rows[-1]['seq'] if rows else since), more
+
+def split_path(path: str) -> tuple[str, str]:
+    rel, _, name = path.strip('/').rpartition('/')
+    return rel, name
+
+def _backfill_sha256(a: Asset) -> str:
+    """Legacy rows have no hash yet: hash once from disk and store it."""
+    h = hashlib.sha256()
+    try:
+        with tiering.open_asset(a) as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                h.update(chunk)
+    except FileNotFoundError:
+        return ''
+    digest = h.hexdigest()
+    Asset.objects.filter(id=a.id).update(sha256=digest)
+    return digest
+
+def _invalidate_listings(space: Space):
+    """Bump the listing ETag for a change that is not a feed event (a seq gap is harmless)."""
+    Space.objects.filter(id=space.id).update(change_seq=F('change_seq') + 1)
+
+def bad_manifest_entry(manifest: dict) -> str | None:
+    """Key of the first entry that is not {"size": int, "sha256": str (optional)}, or None."""
+    for key, want in manifest.items():
+        if not isinstance(want, dict): return key
+        size, digest = want.get('size'), want.get('sha256', '')
+        if not isinstance(size, int) or isinstance(size, bool) or size < 0 or not isinstance(digest, str):
+            return key
+    return None
+
+def manifest_diff(space: Space, manifest: dict[str, dict], prefix: str = '') -> dict:
+    """
+    Compare a client manifest {"<rel/path/name>": {"sha256": .., "size": ..}} (paths relative
+    to `prefix`) with the space. Returns what to upload and what is stale on the server.
+    """
+    base = f"{prefix}/" if prefix else ''
+    pending = dict(manifest)
+    upload, delete = [], []
+    unchanged = backfilled = 0
+    qs = Asset.objects.filter(space=space).select_related('space__owner').order_by()
+    if prefix:
+        qs = qs.filter(Q(rel_path__startswith=base) | Q(rel_path=prefix))
+    for a in qs.only('id', 'space', 'rel_path', 'original_name', 'size', 'sha256', 'source_sha256',
+                     'tier', 'cold_codec').iterator(chunk_size=2000):
+        full = f"{a.rel_path}/{a.original_name}" if a.rel_path else a.original_name
+        key = full[len(base):] if base else full
+        want = pending.pop(key, None)
+        if want is None:
+            delete.append(key); continue
+        if a.source_sha256:  # size may have changed since upload (optimized images)
+            digest = a.source_sha256
+        elif want['size'] != a.size:
+            upload.append(key); continue
+        elif a.sha256:  # indexed by the watcher or a legacy row: the stored bytes are what was sent
+            digest = a.sha256
+        else:
+            digest = _backfill_sha256(a)
+            backfilled += bool(digest)
+        if digest and digest == want.get('sha256', '').lower():
+            unchanged += 1
+        else:
+            upload.append(key)
+    upload.extend(pending.keys())  # not on the server at all
+    if backfilled: _invalidate_listings(space)  # /api/assets lists the hash
+    return {'upload': sorted(upload), 'delete': sorted(delete), 'unchanged': unchanged}
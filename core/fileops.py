@@ -0,0 +1,158 @@
+"""Folder-level file operations shared by the API views and the job worker.
+
+Small inputs run inline in the request; large ones are queued as Jobs (see
+jobs.py) and run here from `manage.py run_jobs`. Every operation works in
+chunks, keeps Asset rows and Space counters in step with the disk after each
+chunk, and is idempotent: re-running it after a crash or retry finishes the
+remaining work. Progress goes to `tick(done, total)`, which the worker also
+uses to stop canceled jobs between chunks.
+"""
+from __future__ import annotations
+import shutil, zipfile
+from pathlib import Path
+from typing import BinaryIO, Callable
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q, F, Sum, Count, Value, CharField
+from django.db.models.functions import Concat, Substr
+from .models import Space, Asset, AssetChange
+from .utils import fs_space_root
+from . import tiering, imageopt, changes, releases
+
+BATCH = 500
+
+Tick = Callable[[int, int], None]
+
+
+class FileOpError(Exception):
+    """Permanent failure (bad input / conflicting target): retrying will not help."""
+
+
+def _noop(done: int, total: int):
+    pass
+
+def folder_assets(space: Space, rel: str):
+    return Asset.objects.filter(space=space).filter(Q(rel_path=rel) | Q(rel_path__startswith=f"{rel}/"))
+
+def folder_stats(space: Space, rel: str) -> tuple[int, int]:
+    """(files, bytes) under a folder, for the inline-or-job decision."""
+    agg = folder_assets(space, rel).aggregate(n=Count('id'), b=Sum('size'))
+    return agg['n'] or 0, agg['b'] or 0
+
+def items_query(space: Space, items: list[tuple[str, str]]):
+    """Assets for (rel_path, name) pairs; grouped by folder so a batch is a few IN queries."""
+    by_rel: dict[str, list[str]] = {}
+    for rel, name in items:
+        by_rel.setdefault(rel, []).append(name)
+    q = Q()
+    for rel, names in by_rel.items():
+        q |= Q(rel_path=rel, original_name__in=names)
+    return Asset.objects.filter(space=space).filter(q) if by_rel else Asset.objects.none()
+
+def delete_assets(space: Space, assets: list[Asset], record: bool = False) -> tuple[list[Asset], int]:
+    """Remove files (hot, cold, derivatives) and rows of one chunk; returns (deleted, failed).
+    With record=True the deletes go to the change feed in the same transaction."""
+    gone, failed = [], 0
+    for a in assets:
+        a.space = space
+        p = tiering.hot_path(a)
+        try:
+            p.unlink(missing_ok=True)
+            tiering.discard_cold(a)
+            for v in imageopt.derivative_paths(p): v.unlink(missing_ok=True)
+        except OSError:
+            failed += 1; continue
+        gone.append(a)
+    if gone:
+        with transaction.atomic():
+            # release only what is still there: the watcher may have removed some rows already
+            sizes = dict(Asset.objects.select_for_update().filter(id__in=[a.id for a in gone]).values_list('id', 'size'))
+            Asset.objects.filter(id__in=list(sizes)).delete()
+            Space.objects.filter(id=space.id).update(
+                used_bytes=F('used_bytes') - sum(sizes.values()),
+                file_count=F('file_count') - len(sizes),
+            )
+            if record:
+                changes.record_many(space, AssetChange.OP_DELETE,
+                                    [{'rel_path': a.rel_path, 'name': a.original_name} for a in gone if a.id in sizes])
+    return gone, failed
+
+def rmdir(space: Space, rel: str, tick: Tick = _noop) -> dict:
+    """Recursive folder delete: rows and files chunk by chunk, then whatever is left on disk."""
+    qs = folder_assets(space, rel).order_by('id').only('id', 'space', 'rel_path', 'original_name', 'size', 'tier', 'cold_codec')
+    total, done, failed = qs.count(), 0, 0
+    tick(0, total)
+    last_id = 0
+    while chunk := list(qs.filter(id__gt=last_id)[:BATCH]):
+        last_id = chunk[-1].id
+        gone, bad = delete_assets(space, chunk)
+        done += len(gone); failed += bad
+        tick(done + failed, total)
+    if failed:
+        raise OSError(f"{failed} files could not be deleted")  # retried; rows of the rest are gone already
+    target = fs_space_root(space) / rel
+    if target.is_symlink():
+        target.unlink()  # a release site: the release dirs are left to gc_releases
+    elif target.exists():
+        shutil.rmtree(target)
+    shutil.rmtree(Path(settings.CDN_COLD_ROOT) / space.owner.name_spase / space.slug / rel, ignore_errors=True)
+    changes.record(space, AssetChange.OP_RMDIR, rel)
+    return {'deleted': done}
+
+def move_folder(space: Space, src_rel: str, dst_rel: str, tick: Tick = _noop) -> dict:
+    """Move/rename a folder on disk (hot and cold mirror) and rewrite the rel_path of its rows."""
+    root = fs_space_root(space)
+    cold_root = Path(settings.CDN_COLD_ROOT) / space.owner.name_spase / space.slug
+    src, dst = root / src_rel, root / dst_rel
+    if src.exists() or src.is_symlink():
+        if dst.exists(): raise FileOpError('dst exists')
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        shutil.move(str(src), str(dst))
+    elif not dst.exists():
+        raise FileOpError('src not found')
+    csrc, cdst = cold_root / src_rel, cold_root / dst_rel
+    if csrc.exists():
+        cdst.parent.mkdir(parents=True, exist_ok=True)
+        shutil.move(str(csrc), str(cdst))
+
+    # rows leave the src filter once rewritten, so each pass picks up the next chunk
+    rows = folder_assets(space, src_rel)
+    total, done = rows.count(), 0
+    tick(0, total)
+    new_rel = Concat(Value(dst_rel), Substr('rel_path', len(src_rel) + 1), output_field=CharField())
+    while ids := list(rows.order_by('id').values_list('id', flat=True)[:BATCH]):
+        done += Asset.objects.filter(id__in=ids).update(rel_path=new_rel)
+        tick(done, total)
+    releases.move_sites(space, src_rel, dst_rel)
+    changes.record(space, AssetChange.OP_FOLDER_MOVE, src_rel, new_rel_path=dst_rel)
+    return {'moved': done}
+
+def delete_batch(space: Space, items: list[tuple[str, str]], tick: Tick = _noop) -> dict:
+    total, done, failed = len(items), 0, 0
+    tick(0, total)
+    for i in range(0, total, BATCH):
+        part = items[i:i + BATCH]
+        found = list(items_query(space, part))
+        gone, bad = delete_assets(space, found, record=True)
+        done += len(gone); failed += bad + len(part) - len(found)
+        tick(done + failed, total)
+    return {'deleted': done, 'failed': failed}
+
+def write_zip(space: Space, items: list[tuple[str, str]], out: BinaryIO, tick: Tick = _noop) -> int:
+    """Write the selected assets into a zip on `out` (a file, not memory); returns files added."""
+    total, done, added = len(items), 0, 0
+    tick(0, total)
+    with zipfile.ZipFile(out, 'w', compression=zipfile.ZIP_DEFLATED) as z:
+        for i in range(0, total, BATCH):
+            for a in items_query(space, items[i:i + BATCH]).order_by('rel_path', 'original_name'):
+                a.space = space
+                tiering.ensure_hot(a)
+                p = tiering.hot_path(a)
+                if p.exists():
+                    z.write(p, arcname=f"{a.rel_path}/{a.original_name}" if a.rel_path else a.original_name)
+                    added += 1
+                done += 1
+                tick(done, total)
+            done = min(i + BATCH, total)  # missing items count as processed
+    tick(total, total)
+    return added
@@ -0,0 +1,172 @@
+"""Image optimization after upload.
+
+For still PNG/JPEG assets: strip metadata, recompress losslessly (Pillow for PNG,
+`jpegtran` for JPEG when installed) and write WebP/AVIF derivatives next to
+the original as `<name>.webp` / `<name>.avif`, so nginx can pick them with
+`try_files $uri$avif_ext $uri$webp_ext $uri` based on the Accept header.
+
+Work runs on a small in-process thread pool; at most IMAGE_OPT_MAX_PENDING
+jobs are queued, anything beyond that is left for `optimize_images`.
+The pipeline is idempotent: an asset whose bytes already hash to
+`optimized_sha256` is skipped. The hash is recorded after every run, also
+when no derivative came out smaller than the original and none was kept.
+"""
+from __future__ import annotations
+import io, os, shutil, subprocess, threading, logging
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
+from .models import Space, Asset, AssetChange
+from .utils import sha256_file
+from . import tiering, changes
+
+log = logging.getLogger(__name__)
+
+OPTIMIZABLE_MIMES = {'image/png', 'image/jpeg'}
+DERIVATIVE_EXTS = ('.webp', '.avif')
+
+_executor: ThreadPoolExecutor | None = None
+_slots: threading.BoundedSemaphore | None = None
+_lock = threading.Lock()
+
+
+def is_candidate(asset: Asset) -> bool:
+    return asset.mime in OPTIMIZABLE_MIMES
+
+def derivative_paths(p: Path) -> list[Path]:
+    """Sibling variant files for an original path (used by rename/delete too)."""
+    return [p.with_name(p.name + ext) for ext in DERIVATIVE_EXTS]
+
+def avif_supported() -> bool:
+    try:
+        from PIL import features  # type: ignore
+        return bool(features.check('avif'))
+    except Exception:
+        return False
+
+def _write_atomic(dst: Path, data: bytes):
+    tmp = dst.with_name(f"{dst.name}.{os.getpid()}.{threading.get_ident()}.part")
+    tmp.write_bytes(data)
+    os.replace(tmp, dst)
+
+def _exif_orientation(im) -> int:
+    try:
+        return int(im.getexif().get(0x0112, 1))
+    except Exception:
+        return 1
+
+def _recompress(p: Path, im) -> bytes | None:
+    """Lossless, metadata-free re-encoding of the original, or None if not possible."""
+    if im.format == 'PNG':
+        out = io.BytesIO()
+        params = {'optimize': True}
+        if im.info.get('icc_profile'): params['icc_profile'] = im.info['icc_profile']
+        im.save(out, 'PNG', **params)
+        return out.getvalue()
+    if im.format == 'JPEG':
+        # dropping EXIF would also drop the rotation; leave those files alone
+        jpegtran = shutil.which('jpegtran')
+        if not jpegtran or _exif_orientation(im) != 1: return None
+        # keep the ICC profile: without it Display P3 and other non-sRGB exports shift colour
+        r = subprocess.run([jpegtran, '-copy', 'icc', '-optimize', '-progressive', str(p)],
+                           capture_output=True, timeout=120)
+        return r.stdout if r.returncode == 0 and r.stdout else None
+    return None
+
+def _derivative(im, fmt: str) -> bytes:
+    from PIL import ImageOps  # type: ignore
+    params = {'icc_profile': im.info['icc_profile']} if im.info.get('icc_profile') else {}
+    lossless = im.format == 'PNG' or im.mode in ('RGBA', 'LA', 'P')
+    im = ImageOps.exif_transpose(im)
+    out = io.BytesIO()
+    if fmt == 'WEBP':
+        if lossless:
+            im.save(out, 'WEBP', lossless=True, method=6, **params)
+        else:
+            im.save(out, 'WEBP', quality=settings.IMAGE_OPT_WEBP_QUALITY, method=6, **params)
+    else:
+        im.save(out, 'AVIF', quality=settings.IMAGE_OPT_AVIF_QUALITY, **params)
+    return out.getvalue()
+
+def optimize_asset(asset: Asset, force: bool = False) -> int:
+    """Optimize one asset in place; returns bytes saved on the original (>= 0)."""
+    from PIL import Image  # type: ignore
+
+    if not is_candidate(asset) or asset.tier != Asset.TIER_HOT: return 0
+    p = tiering.hot_path(asset)
+    if not p.exists(): return 0
+    digest = sha256_file(p)
+    variants = derivative_paths(p)
+    if not force and digest == asset.optimized_sha256:
+        return 0
+
+    with Image.open(p) as im:
+        # single-frame encoders would keep only the first frame of an APNG/animated image
+        if getattr(im, 'is_animated', False):
+            Asset.objects.filter(id=asset.id, size=p.stat().st_size).update(optimized_sha256=digest)
+            asset.optimized_sha256 = digest
+            return 0
+        im.load()
+        before = p.stat().st_size
+        data = _recompress(p, im)
+        if data and len(data) >= before: data = None
+        best = len(data) if data else before
+        for v, fmt in zip(variants, ('WEBP', 'AVIF')):
+            if fmt == 'AVIF' and not avif_supported(): continue
+            try:
+                blob = _derivative(im, fmt)
+            except Exception:
+                log.warning("imageopt: %s derivative failed for %s", fmt, p, exc_info=True)
+                continue
+            if len(blob) < best:
+                _write_atomic(v, blob)
+            else:
+                v.unlink(missing_ok=True)
+
+    saved = 0
+    with transaction.atomic():
+        # the row lock serializes runs on this asset, and the watcher re-reads the size
+        # under it, so the in-place rewrite below is never mistaken for an outside edit
+        row = Asset.objects.select_for_update().filter(id=asset.id, tier=Asset.TIER_HOT).only('size').first()
+        if row is None or row.size != before or sha256_file(p) != digest:
+            return 0  # rewritten since we read it; the next run starts over
+        if data:
+            _write_atomic(p, data)
+            saved = before - len(data)
+        new_size = before - saved
+        new_digest = sha256_file(p) if saved else digest
+        Asset.objects.filter(id=asset.id).update(size=new_size, sha256=new_digest, optimized_sha256=new_digest)
+        if saved:
+            changes.record(asset.space, AssetChange.OP_UPDATE, asset.rel_path, asset.original_name,
+                           size=new_size, sha256=new_digest)
+            Space.objects.filter(id=asset.space_id).update(
+                used_bytes=F('used_bytes') - saved,
+                optimized_saved_bytes=F('optimized_saved_bytes') + saved,
+            )
+    asset.size, asset.sha256, asset.optimized_sha256 = new_size, new_digest, new_digest
+    return saved
+
+def _run(asset_id: int):
+    try:
+        a = Asset.objects.select_related('space__owner').filter(id=asset_id).first()
+        if a: optimize_asset(a)
+    except Exception:
+        log.exception("imageopt: optimizing asset %s failed", asset_id)
+    finally:
+        connection.close()
+        _slots.release()
+
+def submit(asset: Asset) -> bool:
+    """Queue an asset for background optimization; False if disabled or the queue is full."""
+    global _executor, _slots
+    if not (settings.IMAGE_OPT_ENABLED and getattr(settings, 'PIL_AVAILABLE', False)): return False
+    if not is_candidate(asset): return False
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=settings.IMAGE_OPT_WORKERS, thread_name_prefix='imageopt')
+            _slots = threading.BoundedSemaphore(settings.IMAGE_OPT_MAX_PENDING)
+    if not _slots.acquire(blocking=False): return False
+    _executor.submit(_run, asset.id)
+    return True
@@ -0,0 +1,168 @@
+"""Durable background jobs without a broker.
+
+Jobs are rows in the Job table. `manage.py run_jobs` polls for queued jobs,
+claims one with a conditional UPDATE (so two workers never run the same job),
+keeps a heartbeat while it runs and records progress/result/error on the row.
+Failed jobs are retried with exponential backoff up to max_attempts; jobs of a
+worker that died (stale heartbeat) are requeued. At most JOBS_PER_SPACE jobs
+run per space at a time. Cancellation is cooperative: the handler stops at its
+next progress tick.
+"""
+from __future__ import annotations
+import os, time, logging
+from datetime import timedelta
+from pathlib import Path
+from typing import Callable
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q, F, Count
+from django.utils import timezone
+from .models import Space, Job
+from . import fileops
+
+log = logging.getLogger(__name__)
+
+# token scope needed to cancel a job, same as the endpoint that queued it
+KIND_SCOPES = {Job.KIND_RMDIR: 'delete', Job.KIND_DELETE_BATCH: 'delete',
+               Job.KIND_FOLDER_MOVE: 'upload', Job.KIND_ZIP: 'read'}
+
+HANDLERS: dict[str, Callable[[Job, fileops.Tick], dict]] = {}
+
+
+class Canceled(Exception):
+    pass
+
+
+def handler(kind: str):
+    def deco(fn):
+        HANDLERS[kind] = fn
+        return fn
+    return deco
+
+def should_defer(files: int, nbytes: int = 0) -> bool:
+    return files >= settings.JOBS_ASYNC_MIN_FILES or nbytes >= settings.JOBS_ASYNC_MIN_BYTES
+
+def enqueue(space: Space, kind: str, payload: dict, total: int = 0) -> Job:
+    return Job.objects.create(space=space, kind=kind, payload=payload, total=total,
+                              max_attempts=settings.JOBS_MAX_ATTEMPTS)
+
+def artifact_path(job: Job) -> Path:
+    return Path(settings.JOBS_ROOT) / f"{job.id}.zip"
+
+def cancel(job: Job) -> Job:
+    """Queued jobs are canceled at once; running ones stop at their next progress tick."""
+    now = timezone.now()
+    if not Job.objects.filter(id=job.id, state=Job.STATE_QUEUED).update(state=Job.STATE_CANCELED, finished_at=now):
+        Job.objects.filter(id=job.id, state=Job.STATE_RUNNING).update(cancel_requested=True)
+    job.refresh_from_db()
+    return job
+
+
+# ---------- worker side ----------
+
+class _Ticker:
+    """Progress callback for handlers: throttled progress writes + cancellation check."""
+    INTERVAL = 0.5
+
+    def __init__(self, job: Job):
+        self.job, self.last = job, 0.0
+
+    def __call__(self, done: int, total: int):
+        now = time.monotonic()
+        if now - self.last < self.INTERVAL and done < total: return
+        self.last = now
+        Job.objects.filter(id=self.job.id).update(progress=done, total=total)
+        if Job.objects.filter(id=self.job.id, cancel_requested=True).exists():
+            raise Canceled()
+
+def claim(worker: str) -> Job | None:
+    """Take the oldest runnable job whose space is under its JOBS_PER_SPACE limit."""
+    now = timezone.now()
+    limit = settings.JOBS_PER_SPACE
+    busy = dict(Job.objects.filter(state=Job.STATE_RUNNING).order_by()
+                .values_list('space_id').annotate(n=Count('id')))
+    runnable = (Job.objects.filter(state=Job.STATE_QUEUED)
+                .filter(Q(run_after__isnull=True) | Q(run_after__lte=now))
+                .order_by('id').values_list('id', 'space_id')[:100])
+    for jid, sid in runnable:
+        if busy.get(sid, 0) >= limit: continue
+        with transaction.atomic():
+            # the space row lock serializes claims per space across worker processes
+            list(Space.objects.select_for_update().filter(id=sid).values_list('id'))
+            if Job.objects.filter(space_id=sid, state=Job.STATE_RUNNING).count() >= limit:
+                busy[sid] = limit; continue
+            if Job.objects.filter(id=jid, state=Job.STATE_QUEUED).update(
+                    state=Job.STATE_RUNNING, locked_by=worker, heartbeat_at=now, attempts=F('attempts') + 1):
+                return Job.objects.select_related('space__owner').get(id=jid)
+    return None
+
+def heartbeat(worker: str):
+    Job.objects.filter(locked_by=worker, state=Job.STATE_RUNNING).update(heartbeat_at=timezone.now())
+
+def recover_stale() -> int:
+    """Requeue (or fail) running jobs whose worker stopped sending heartbeats."""
+    cutoff = timezone.now() - timedelta(seconds=settings.JOBS_STALE_SECONDS)
+    stale = Job.objects.filter(state=Job.STATE_RUNNING, heartbeat_at__lt=cutoff)
+    n = stale.filter(attempts__lt=F('max_attempts')).update(state=Job.STATE_QUEUED, locked_by='', error='worker lost')
+    n += stale.update(state=Job.STATE_FAILED, error='worker lost', finished_at=timezone.now())
+    return n
+
+def _finish(job: Job, state: str, **fields):
+    Job.objects.filter(id=job.id, state=Job.STATE_RUNNING).update(state=state, finished_at=timezone.now(), **fields)
+
+def execute(job: Job):
+    """Run one claimed job and record its outcome."""
+    try:
+        result = HANDLERS[job.kind](job, _Ticker(job))
+    except Canceled:
+        _finish(job, Job.STATE_CANCELED)
+    except fileops.FileOpError as e:
+        _finish(job, Job.STATE_FAILED, error=str(e))
+    except Exception as e:
+        log.exception("job %s (%s) failed, attempt %s/%s", job.id, job.kind, job.attempts, job.max_attempts)
+        if job.attempts < job.max_attempts:
+            delay = settings.JOBS_RETRY_DELAY * 2 ** (job.attempts - 1)
+            Job.objects.filter(id=job.id, state=Job.STATE_RUNNING).update(
+                state=Job.STATE_QUEUED, locked_by='', error=str(e)[:2000],
+                run_after=timezone.now() + timedelta(seconds=delay))
+        else:
+            _finish(job, Job.STATE_FAILED, error=str(e)[:2000])
+    else:
+        done = Job.objects.filter(id=job.id).values_list('total', flat=True).first() or 0
+        _finish(job, Job.STATE_DONE, result=result, progress=done, error='')
+
+def purge() -> int:
+    """Drop finished jobs (and zip results) older than JOBS_KEEP_HOURS."""
+    old = Job.objects.filter(state__in=Job.FINISHED,
+                             finished_at__lt=timezone.now() - timedelta(hours=settings.JOBS_KEEP_HOURS))
+    for job in old.filter(kind=Job.KIND_ZIP).only('id'):
+        artifact_path(job).unlink(missing_ok=True)
+    return old.delete()[0]
+
+
+# ---------- handlers ----------
+
+@handler(Job.KIND_RMDIR)
+def _rmdir(job: Job, tick) -> dict:
+    return fileops.rmdir(job.space, job.payload['rel_path'], tick)
+
+@handler(Job.KIND_FOLDER_MOVE)
+def _folder_move(job: Job, tick) -> dict:
+    return fileops.move_folder(job.space, job.payload['src'], job.payload['dst'], tick)
+
+@handler(Job.KIND_DELETE_BATCH)
+def _delete_batch(job: Job, tick) -> dict:
+    return fileops.delete_batch(job.space, [tuple(it) for it in job.payload['items']], tick)
+
+@handler(Job.KIND_ZIP)
+def _zip(job: Job, tick) -> dict:
+    out = artifact_path(job)
+    out.parent.mkdir(parents=True, exist_ok=True)
+    tmp = out.with_name(out.name + '.part')
+    try:
+        with tmp.open('wb') as f:
+            n = fileops.write_zip(job.space, [tuple(it) for it in job.payload['items']], f, tick)
+        os.replace(tmp, out)
+    finally:
+        tmp.unlink(missing_ok=True)
+    return {'files': n, 'size': out.stat().st_size, 'download': f"/api/jobs/{job.id}/download"}
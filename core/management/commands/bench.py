@@ -0,0 +1,42 @@
+import json
+from django.core.management.base import BaseCommand, CommandError
+from core import bench
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the core API on seeded spaces (throw-away test DB) and write/compare a JSON baseline'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scales', default='10000,100000', help='comma separated row counts, e.g. 10000,100000,1000000')
+        parser.add_argument('--requests', type=int, default=200, help='requests per endpoint and scale')
+        parser.add_argument('--http', action='store_true', help='drive a threaded HTTP server instead of the test client')
+        parser.add_argument('--concurrency', type=int, default=8, help='client threads in --http mode')
+        parser.add_argument('--only', default='', help='comma separated scenario names')
+        parser.add_argument('--output', '-o', default=None, help='write the JSON baseline here')
+        parser.add_argument('--compare', default=None, help='baseline JSON to diff against')
+        parser.add_argument('--threshold', type=float, default=0.2, help='regression threshold for --compare (0.2 = +20%%)')
+
+    def handle(self, *args, **opts):
+        try:
+            scales = [int(s) for s in opts['scales'].split(',') if s.strip()]
+        except ValueError:
+            raise CommandError('--scales must be integers')
+        only = [s.strip() for s in opts['only'].split(',') if s.strip()] or None
+        known = {sc.name for sc in bench.scenarios()}
+        if only and set(only) - known:
+            raise CommandError(f"unknown scenarios: {', '.join(sorted(set(only) - known))}")
+
+        result = bench.run(scales, opts['requests'], opts['concurrency'], opts['http'], only, log=self.stdout.write)
+        if opts['output']:
+            with open(opts['output'], 'w', encoding='utf-8') as f:
+                json.dump(result, f, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Baseline written to {opts['output']}"))
+
+        if opts['compare']:
+            with open(opts['compare'], encoding='utf-8') as f:
+                old = json.load(f)
+            lines, regressions = bench.compare(old, result, opts['threshold'])
+            self.stdout.write(f"vs {old.get('meta', {}).get('commit') or opts['compare']}:")
+            for line in lines: self.stdout.write(line)
+            if regressions:
+                raise CommandError(f'{regressions} metrics regressed by more than {opts["threshold"]:.0%}')
@@ -0,0 +1,78 @@
+import sys, json, hashlib, tarfile
+from django.core.management.base import BaseCommand, CommandError
+from core.models import Asset
+from core.utils import space_from_ref
+from core import tiering
+
+FORMAT_VERSION = 1
+ASSET_FIELDS = ('id', 'rel_path', 'original_name', 'size', 'mime', 'is_public', 'created_at',
+                'sha256', 'optimized_sha256', 'source_sha256', 'tier', 'cold_codec')
+
+
+class _HashingReader:
+    """File wrapper that hashes what tarfile reads from it."""
+
+    def __init__(self, f):
+        self.f, self.h = f, hashlib.sha256()
+
+    def read(self, n=-1):
+        b = self.f.read(n)
+        self.h.update(b)
+        return b
+
+
+class Command(BaseCommand):
+    help = 'Stream a space\'s Asset rows as NDJSON (and optionally its files as a tar) in constant memory'
+
+    def add_arguments(self, parser):
+        parser.add_argument('space', help='space id or <name_spase>/<slug>')
+        parser.add_argument('--output', '-o', default='-', help='NDJSON path (default: stdout)')
+        parser.add_argument('--files', default=None, help='also write the files to this tar (.tar, .tar.gz)')
+        parser.add_argument('--chunk-size', type=int, default=2000)
+
+    def handle(self, *args, **opts):
+        space = space_from_ref(opts['space'])
+        if not space: raise CommandError(f"space {opts['space']!r} not found")
+
+        out = sys.stdout if opts['output'] == '-' else open(opts['output'], 'w', encoding='utf-8')
+        tar = None
+        if opts['files']:
+            mode = 'w|gz' if opts['files'].endswith(('.gz', '.tgz')) else 'w|'
+            tar = tarfile.open(opts['files'], mode)
+        try:
+            out.write(json.dumps({
+                'type': 'space', 'format': FORMAT_VERSION, 'owner': space.owner.name_spase,
+                'name': space.name, 'slug': space.slug,
+                'max_bytes': space.max_bytes, 'max_files': space.max_files,
+            }) + '\n')
+            n = 0
+            qs = Asset.objects.filter(space=space).order_by('id').only(*ASSET_FIELDS, 'space_id')
+            for a in qs.iterator(chunk_size=opts['chunk_size']):
+                a.space = space  # avoid a per-row FK fetch for paths
+                if tar is not None:
+                    a.sha256 = self._add_file(tar, a) or a.sha256
+                out.write(json.dumps({
+                    'type': 'asset', 'rel_path': a.rel_path, 'name': a.original_name, 'size': a.size,
+                    'mime': a.mime, 'is_public': a.is_public, 'created_at': a.created_at.isoformat(),
+                    'sha256': a.sha256, 'optimized_sha256': a.optimized_sha256, 'source_sha256': a.source_sha256,
+                }) + '\n')
+                n += 1
+        finally:
+            if tar is not None: tar.close()
+            if out is not sys.stdout: out.close()
+        self.stderr.write(self.style.SUCCESS(f'Exported {n} assets from {space.owner.name_spase}/{space.slug}.'))
+
+    def _add_file(self, tar, a: Asset) -> str:
+        """Stream one file into the tar; returns its sha256 ('' if missing on disk)."""
+        try:
+            f = tiering.open_asset(a)
+        except FileNotFoundError:
+            self.stderr.write(f'missing on disk: {a}')
+            return ''
+        with f:
+            ti = tarfile.TarInfo(f"{a.rel_path}/{a.original_name}" if a.rel_path else a.original_name)
+            ti.size = a.size if a.tier == Asset.TIER_COLD else tiering.hot_path(a).stat().st_size
+            ti.mtime = int(a.created_at.timestamp())
+            reader = _HashingReader(f)
+            tar.addfile(ti, reader)
+        return reader.h.hexdigest()
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from core import releases
+
+
+class Command(BaseCommand):
+    help = 'Delete archived releases beyond RELEASES_KEEP and abandoned staging releases'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--keep', type=int, default=None, help='archived releases to keep per site')
+
+    def handle(self, *args, **opts):
+        n = releases.gc(keep=opts['keep'])
+        self.stdout.write(self.style.SUCCESS(f'Removed {n} releases.'))
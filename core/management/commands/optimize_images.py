@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from core.models import Space, Asset
+from core import imageopt
+
+
+class Command(BaseCommand):
+    help = 'Optimize PNG/JPEG assets (lossless recompress + WebP/AVIF derivatives); idempotent by content hash'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--space', type=int, default=None, help='only this space id')
+        parser.add_argument('--force', action='store_true', help='re-run even if the hash is unchanged')
+        parser.add_argument('--report', action='store_true', help='only print bytes saved per space')
+
+    def handle(self, *args, **opts):
+        spaces = Space.objects.select_related('owner').order_by('id')
+        if opts['space']: spaces = spaces.filter(id=opts['space'])
+
+        if not opts['report']:
+            if not getattr(settings, 'PIL_AVAILABLE', False):
+                raise CommandError('Pillow is not installed')
+            qs = Asset.objects.filter(mime__in=imageopt.OPTIMIZABLE_MIMES, tier=Asset.TIER_HOT).select_related('space__owner')
+            if opts['space']: qs = qs.filter(space_id=opts['space'])
+            done = saved = 0
+            for a in qs.order_by('id').iterator(chunk_size=500):
+                try:
+                    saved += imageopt.optimize_asset(a, force=opts['force'])
+                    done += 1
+                except Exception as e:
+                    self.stderr.write(f"{a}: {e}")
+            self.stdout.write(self.style.SUCCESS(f'Processed {done} images, saved {saved} bytes.'))
+
+        for s in spaces:
+            self.stdout.write(f"{s.owner.name_spase}/{s.slug}: {s.optimized_saved_bytes} bytes saved")
@@ -0,0 +1,21 @@
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from core import cachepolicy
+
+
+class Command(BaseCommand):
+    help = 'Compile CachePolicy rows into the nginx map include (atomic write, test + reload on change)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', default=None, help='default: CACHE_POLICY_MAP_PATH ("-" prints it)')
+        parser.add_argument('--no-reload', action='store_true', help='write only, do not run the test/reload commands')
+
+    def handle(self, *args, **opts):
+        if opts['output'] == '-':
+            sys.stdout.write(cachepolicy.compile_maps())
+            return
+        try:
+            changed = cachepolicy.render(opts['output'], reload=not opts['no_reload'])
+        except cachepolicy.PolicyError as e:
+            raise CommandError(f'{e} (previous map restored)')
+        self.stdout.write(self.style.SUCCESS('Cache policy map updated.' if changed else 'Cache policy map unchanged.'))
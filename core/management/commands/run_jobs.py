@@ -0,0 +1,58 @@
+import os, signal, socket, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from core import jobs
+
+
+class Command(BaseCommand):
+    help = 'Run queued background jobs (folder delete/move, zip, batch delete) from the Job table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None, help='parallel jobs in this process; default: JOBS_WORKERS')
+        parser.add_argument('--poll', type=float, default=1.0, help='seconds between polls when idle')
+        parser.add_argument('--once', action='store_true', help='drain the queue and exit')
+
+    def handle(self, *args, **opts):
+        workers = opts['workers'] or settings.JOBS_WORKERS
+        worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        stop = threading.Event()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, lambda *_: stop.set())  # finish running jobs, claim no new ones
+
+        running: set = set()
+        ran = 0
+        last_beat = last_recover = last_purge = 0.0
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job') as pool:
+            while not stop.is_set():
+                now = time.monotonic()
+                if now - last_beat >= 10:
+                    jobs.heartbeat(worker_id); last_beat = now
+                if now - last_recover >= 30:
+                    n = jobs.recover_stale(); last_recover = now
+                    if n: self.stderr.write(f'requeued {n} stale jobs')
+                if now - last_purge >= 3600:
+                    jobs.purge(); last_purge = now
+
+                running = {f for f in running if not f.done()}
+                claimed = False
+                while len(running) < workers:
+                    job = jobs.claim(worker_id)
+                    if job is None: break
+                    claimed = True; ran += 1
+                    if opts['verbosity'] > 1: self.stdout.write(f'running {job}')
+                    running.add(pool.submit(self._run, job))
+                if opts['once'] and not claimed and not running: break
+                stop.wait(0.1 if claimed else opts['poll'])
+            while any(not f.done() for f in running):
+                jobs.heartbeat(worker_id)
+                time.sleep(1)
+        self.stdout.write(self.style.SUCCESS(f'Ran {ran} jobs.'))
+
+    @staticmethod
+    def _run(job):
+        try:
+            jobs.execute(job)
+        finally:
+            connection.close()
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from core import tiering
+
+
+class Command(BaseCommand):
+    help = 'Move cold assets (not read for N days) from CDN_ROOT to CDN_COLD_ROOT, throttled'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than-days', type=int, default=None, help='default: TIER_COLD_AFTER_DAYS')
+        parser.add_argument('--min-bytes', type=int, default=None, help='default: TIER_MIN_BYTES')
+        parser.add_argument('--rate', type=int, default=None, help='I/O limit in bytes/sec (0 = unlimited); default: TIER_IO_RATE')
+        parser.add_argument('--limit', type=int, default=None, help='max files to move in this run')
+        parser.add_argument('--dry-run', action='store_true')
+
+    def handle(self, *args, **opts):
+        stats = tiering.run(
+            older_than_days=opts['older_than_days'], min_bytes=opts['min_bytes'], rate=opts['rate'],
+            limit=opts['limit'], dry_run=opts['dry_run'],
+            log=self.stdout.write if opts['verbosity'] > 1 else None,
+        )
+        verb = 'Would move' if opts['dry_run'] else 'Moved'
+        self.stdout.write(self.style.SUCCESS(
+            f"{verb} {stats['moved']} files ({stats['moved_bytes']} bytes) to cold tier; scanned {stats['scanned']}."
+        ))
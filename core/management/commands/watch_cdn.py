@@ -0,0 +1,31 @@
+import signal, threading
+from django.core.management.base import BaseCommand, CommandError
+from core.utils import space_from_ref
+from core import watcher
+
+
+class Command(BaseCommand):
+    help = 'Watch CDN_ROOT (inotify, scandir fallback) and sync out-of-band file changes into Asset rows'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='one full scandir reconcile, then exit')
+        parser.add_argument('--space', default=None, help='with --once: only this space (id or <name_spase>/<slug>)')
+        parser.add_argument('--poll', action='store_true', help='do not use inotify; rescan every WATCH_RESCAN_SECONDS')
+
+    def handle(self, *args, **opts):
+        log = self.stdout.write if opts['verbosity'] > 1 else None
+        w = watcher.Watcher(log_fn=log)
+        if opts['once']:
+            if opts['space']:
+                space = space_from_ref(opts['space'])
+                if not space: raise CommandError(f"space {opts['space']!r} not found")
+                stats = w.index.reconcile(space)
+            else:
+                stats = w.rescan()
+            self.stdout.write(self.style.SUCCESS(f'Reconciled: {stats}'))
+            return
+        stop = threading.Event()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, lambda *_: stop.set())
+        w.run(stop, use_inotify=not opts['poll'])
+        self.stdout.write(self.style.SUCCESS('Watcher stopped.'))
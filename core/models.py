@@ -23,6 +23,9 @@ class Space(models.Model):
     # accounting (kept in sync)
     used_bytes = models.BigIntegerField(default=0)
     file_count = models.IntegerField(default=0)
+    optimized_saved_bytes = models.BigIntegerField(default=0)  # image optimization savings
+    # last AssetChange.seq handed out (changes.record); also the dashboard listings' ETag
+    change_seq = models.BigIntegerField(default=0)
 
     class Meta:
         unique_together = (("owner", "slug"),)
@@ -33,6 +36,10 @@ class Space(models.Model):
 
 class Asset(models.Model):
     """Files live inside a Space; hierarchical rel_path; no bucket."""
+    TIER_HOT = "hot"
+    TIER_COLD = "cold"
+    TIER_CHOICES = ((TIER_HOT, "Hot"), (TIER_COLD, "Cold"))
+
     space = models.ForeignKey(Space, on_delete=models.CASCADE, related_name="assets")
     original_name = models.CharField(max_length=255)
     rel_path = models.CharField(max_length=512, default="")  # folder tree inside the space
@@ -40,11 +47,27 @@ class Asset(models.Model):
     mime = models.CharField(max_length=128, default='application/octet-stream')
     is_public = models.BooleanField(default=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    sha256 = models.CharField(max_length=64, blank=True, default="")  # content hash of the stored bytes
+    optimized_sha256 = models.CharField(max_length=64, blank=True, default="")  # hash after image optimization
+    source_sha256 = models.CharField(max_length=64, blank=True, default="")  # hash of the bytes as uploaded (manifest diff)
+
+    # storage tiering: cold files live under CDN_COLD_ROOT, optionally compressed
+    tier = models.CharField(max_length=8, choices=TIER_CHOICES, default=TIER_HOT)
+    cold_codec = models.CharField(max_length=8, blank=True, default="")  # "" (raw) or "zstd"
+    last_accessed_at = models.DateTimeField(null=True, blank=True)
 
     class Meta:
         ordering = ["-created_at"]
         unique_together = (("space", "rel_path", "original_name"),)
-        indexes = [models.Index(fields=["space", "rel_path"])]
+        indexes = [
+            # text_pattern_ops serves `rel_path LIKE 'a/b/%'` prefix scans on PostgreSQL,
+            # include makes folder listings index-only (both are ignored on SQLite)
+            models.Index(fields=["space", "rel_path"], name="asset_space_relpath_idx",
+                         opclasses=["int8_ops", "text_pattern_ops"],
+                         include=["original_name", "size", "mime", "created_at"]),
+            models.Index(fields=["space", "-created_at"], name="asset_space_created_idx"),
+            models.Index(fields=["tier", "last_accessed_at"]),
+        ]
 
     def __str__(self):
         p = f"{self.rel_path}/" if self.rel_path else ""
@@ -54,3 +77,144 @@ class Asset(models.Model):
     def public_url(self) -> str:
         base = f"/cdn/{self.space.owner.name_spase}/{self.space.slug}"
         return f"{base}/{self.rel_path}/{self.original_name}" if self.rel_path else f"{base}/{self.original_name}"
+
+class AssetChange(models.Model):
+    """Append-only change feed per space; `seq` (per space, in commit order) is the sync cursor."""
+    OP_UPLOAD, OP_UPDATE, OP_RENAME, OP_DELETE = "upload", "update", "rename", "delete"
+    OP_MKDIR, OP_RMDIR, OP_FOLDER_MOVE = "mkdir", "rmdir", "folder_move"
+    OP_RELEASE = "release"  # everything under rel_path was replaced by a promoted release
+    OP_CHOICES = [(o, o) for o in (OP_UPLOAD, OP_UPDATE, OP_RENAME, OP_DELETE, OP_MKDIR, OP_RMDIR,
+                                   OP_FOLDER_MOVE, OP_RELEASE)]
+
+    space = models.ForeignKey(Space, on_delete=models.CASCADE, related_name="changes")
+    seq = models.BigIntegerField(default=0)
+    op = models.CharField(max_length=16, choices=OP_CHOICES)
+    rel_path = models.CharField(max_length=512, default="")
+    name = models.CharField(max_length=255, blank=True, default="")      # empty for folder ops
+    new_rel_path = models.CharField(max_length=512, blank=True, default="")  # rename / folder_move
+    new_name = models.CharField(max_length=255, blank=True, default="")
+    size = models.BigIntegerField(null=True, blank=True)
+    sha256 = models.CharField(max_length=64, blank=True, default="")
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["space", "seq"])]
+
+    def __str__(self):
+        return f"#{self.seq} {self.op} {self.rel_path}/{self.name}"
+
+
+class Release(models.Model):
+    """A versioned build of a folder (`site`) in a Space; the live one is symlinked into place."""
+    STATE_STAGING, STATE_LIVE, STATE_ARCHIVED = "staging", "live", "archived"
+    STATE_CHOICES = ((STATE_STAGING, "Staging"), (STATE_LIVE, "Live"), (STATE_ARCHIVED, "Archived"))
+
+    space = models.ForeignKey(Space, on_delete=models.CASCADE, related_name="releases")
+    site = models.CharField(max_length=512)  # rel_path the release is served at
+    label = models.CharField(max_length=64, blank=True, default="")
+    state = models.CharField(max_length=16, choices=STATE_CHOICES, default=STATE_STAGING)
+    file_count = models.IntegerField(default=0)
+    total_bytes = models.BigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    promoted_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ["-created_at"]
+        indexes = [models.Index(fields=["space", "site", "state"])]
+
+    def __str__(self):
+        return f"{self.space}:{self.site}#{self.id} ({self.state})"
+
+class ReleaseFile(models.Model):
+    """File staged in a Release; copied into Asset rows when the release is promoted."""
+    release = models.ForeignKey(Release, on_delete=models.CASCADE, related_name="files")
+    rel_path = models.CharField(max_length=512, default="")  # inside the release
+    original_name = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    mime = models.CharField(max_length=128, default='application/octet-stream')
+    sha256 = models.CharField(max_length=64, blank=True, default="")
+
+    class Meta:
+        unique_together = (("release", "rel_path", "original_name"),)
+
+class ApiToken(models.Model):
+    """Scoped machine token bound to one Space. The secret part is signed, never stored."""
+    SCOPES = ("read", "upload", "delete")
+
+    space = models.ForeignKey(Space, on_delete=models.CASCADE, related_name="api_tokens")
+    name = models.CharField(max_length=64)
+    key_id = models.CharField(max_length=32, unique=True)
+    scopes = models.CharField(max_length=64, default="read")  # comma separated subset of SCOPES
+    revoked = models.BooleanField(default=False)
+    expires_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.space}:{self.name} [{self.scopes}]" + (" (revoked)" if self.revoked else "")
+
+    @property
+    def scope_set(self) -> frozenset:
+        return frozenset(s for s in self.scopes.split(",") if s)
+
+class Job(models.Model):
+    """Durable background job (folder delete/move, zip, batch delete) run by `manage.py run_jobs`."""
+    KIND_RMDIR, KIND_FOLDER_MOVE, KIND_ZIP, KIND_DELETE_BATCH = "rmdir", "folder_move", "zip", "delete_batch"
+    KIND_CHOICES = [(k, k) for k in (KIND_RMDIR, KIND_FOLDER_MOVE, KIND_ZIP, KIND_DELETE_BATCH)]
+    STATE_QUEUED, STATE_RUNNING, STATE_DONE = "queued", "running", "done"
+    STATE_FAILED, STATE_CANCELED = "failed", "canceled"
+    STATE_CHOICES = [(s, s) for s in (STATE_QUEUED, STATE_RUNNING, STATE_DONE, STATE_FAILED, STATE_CANCELED)]
+    FINISHED = (STATE_DONE, STATE_FAILED, STATE_CANCELED)
+
+    space = models.ForeignKey(Space, on_delete=models.CASCADE, related_name="jobs")
+    kind = models.CharField(max_length=16, choices=KIND_CHOICES)
+    payload = models.JSONField(default=dict)
+    state = models.CharField(max_length=16, choices=STATE_CHOICES, default=STATE_QUEUED)
+    progress = models.IntegerField(default=0)   # units done (files)
+    total = models.IntegerField(default=0)      # units expected, 0 = unknown
+    result = models.JSONField(default=dict, blank=True)
+    error = models.TextField(blank=True, default="")
+    attempts = models.IntegerField(default=0)
+    max_attempts = models.IntegerField(default=3)
+    cancel_requested = models.BooleanField(default=False)
+    run_after = models.DateTimeField(null=True, blank=True)  # retry backoff
+    locked_by = models.CharField(max_length=64, blank=True, default="")
+    heartbeat_at = models.DateTimeField(null=True, blank=True)  # running jobs without a recent beat are requeued
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ["-id"]
+        indexes = [models.Index(fields=["state", "run_after"]), models.Index(fields=["space", "state"])]
+
+    def __str__(self):
+        return f"#{self.id} {self.kind} [{self.state}] {self.progress}/{self.total}"
+
+class CachePolicy(models.Model):
+    """Cache-Control / CORS for a Space or one of its folders, compiled into nginx maps."""
+    space = models.ForeignKey(Space, on_delete=models.CASCADE, related_name="cache_policies")
+    prefix = models.CharField(max_length=512, blank=True, default="")  # folder rel_path; "" = whole space
+    max_age = models.IntegerField(default=31536000)  # seconds; 0 = "no-cache" (always revalidate)
+    immutable = models.BooleanField(default=False)
+    stale_while_revalidate = models.IntegerField(default=0)  # seconds; 0 = off
+    cors_origins = models.CharField(max_length=1024, blank=True, default="*")  # "*", "" (none) or space separated origins
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = (("space", "prefix"),)
+        verbose_name_plural = "cache policies"
+
+    def __str__(self):
+        return f"{self.space}/{self.prefix}" if self.prefix else str(self.space)
+
+    @property
+    def cache_control(self) -> str:
+        if self.max_age <= 0:
+            return "no-cache"
+        v = f"public, max-age={self.max_age}"
+        if self.immutable: v += ", immutable"
+        if self.stale_while_revalidate > 0: v += f", stale-while-revalidate={self.stale_while_revalidate}"
+        return v
+
+    @property
+    def origins(self) -> list[str]:
+        return self.cors_origins.replace(",", " ").split()
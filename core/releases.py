@@ -0,0 +1,265 @@
+"""Atomic release deployments.
+
+A release is staged under CDN_RELEASES_ROOT/<name_spase>/<slug>/<site>/<id>/
+(outside the tree nginx serves, so staging content is never public). Promoting
+swaps the symlink CDN_ROOT/<name_spase>/<slug>/<site> -> <release dir> with a
+single rename(2), so clients see either the old or the new build, never a mix,
+and replaces the site's Asset rows in one transaction. Rollback is promoting an
+older archived release again; garbage collection keeps RELEASES_KEEP of them.
+"""
+from __future__ import annotations
+import os, shutil, threading, logging
+from datetime import timedelta
+from pathlib import Path
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q, Sum, Count
+from django.utils import timezone
+from .models import Space, Asset, AssetChange, Release, ReleaseFile
+from .utils import fs_space_root, write_chunks
+from . import changes, tiering, imageopt
+
+log = logging.getLogger(__name__)
+
+
+class ReleaseError(Exception):
+    pass
+
+
+def release_dir(r: Release) -> Path:
+    return Path(settings.CDN_RELEASES_ROOT) / r.space.owner.name_spase / r.space.slug / r.site / str(r.id)
+
+def live_path(space: Space, site: str) -> Path:
+    return fs_space_root(space) / site
+
+def live_release(space: Space, site: str) -> Release | None:
+    return Release.objects.filter(space=space, site=site, state=Release.STATE_LIVE).first()
+
+def _site_assets(space: Space, site: str):
+    return Asset.objects.filter(space=space).filter(Q(rel_path=site) | Q(rel_path__startswith=f"{site}/"))
+
+def _relative(site: str, rel_path: str) -> str:
+    return '' if rel_path == site else rel_path[len(site) + 1:]
+
+def create(space: Space, site: str, label: str = '', clone: bool = False) -> Release:
+    """New staging release; with clone=True it starts as a hard-linked copy of the live one."""
+    r = Release.objects.create(space=space, site=site, label=label)
+    d = release_dir(r)
+    d.mkdir(parents=True, exist_ok=True)
+    cur = live_release(space, site) if clone else None
+    if cur:
+        src = release_dir(cur)
+        for f in cur.files.all().iterator(chunk_size=2000):
+            rel = Path(f.rel_path) / f.original_name
+            (d / rel).parent.mkdir(parents=True, exist_ok=True)
+            try:
+                os.link(src / rel, d / rel)  # uploads replace files, so sharing inodes is safe
+            except OSError:
+                shutil.copy2(src / rel, d / rel)
+        ReleaseFile.objects.bulk_create([
+            ReleaseFile(release=r, rel_path=f.rel_path, original_name=f.original_name,
+                        size=f.size, mime=f.mime, sha256=f.sha256)
+            for f in cur.files.all()
+        ], batch_size=2000)
+        Release.objects.filter(id=r.id).update(file_count=cur.file_count, total_bytes=cur.total_bytes)
+        r.file_count, r.total_bytes = cur.file_count, cur.total_bytes
+    return r
+
+def add_file(r: Release, rel_path: str, name: str, chunks, mime: str) -> ReleaseFile:
+    """Write (or replace) one file in a staging release."""
+    if r.state != Release.STATE_STAGING: raise ReleaseError('release is not staging')
+    p = release_dir(r) / rel_path / name if rel_path else release_dir(r) / name
+    p.parent.mkdir(parents=True, exist_ok=True)
+    size, digest = write_chunks(chunks, p)
+    with transaction.atomic():
+        rf, _ = ReleaseFile.objects.update_or_create(
+            release=r, rel_path=rel_path, original_name=name,
+            defaults={'size': size, 'mime': mime, 'sha256': digest},
+        )
+        _recount(r)
+    return rf
+
+def remove_files(r: Release, paths: list[tuple[str, str]]) -> int:
+    if r.state != Release.STATE_STAGING: raise ReleaseError('release is not staging')
+    n = 0
+    for rel, name in paths:
+        if ReleaseFile.objects.filter(release=r, rel_path=rel, original_name=name).delete()[0]:
+            p = release_dir(r) / rel / name if rel else release_dir(r) / name
+            p.unlink(missing_ok=True)
+            n += 1
+    _recount(r)
+    return n
+
+def _recount(r: Release):
+    agg = r.files.aggregate(b=Sum('size'), n=Count('id'))
+    Release.objects.filter(id=r.id).update(file_count=agg['n'] or 0, total_bytes=agg['b'] or 0)
+
+def _swap(live: Path, target: Path):
+    """Point `live` at `target` atomically (symlink + rename over the old symlink)."""
+    live.parent.mkdir(parents=True, exist_ok=True)
+    tmp = live.with_name(f".{live.name}.swap-{os.getpid()}")
+    tmp.unlink(missing_ok=True)
+    os.symlink(target, tmp, target_is_directory=True)
+    os.replace(tmp, live)
+
+def move_sites(space: Space, src_rel: str, dst_rel: str) -> int:
+    """Folder `src_rel` was moved to `dst_rel`: carry the releases of sites at or below it
+    along (release dirs, Release.site) and re-point their live symlinks. Idempotent."""
+    base = Path(settings.CDN_RELEASES_ROOT) / space.owner.name_spase / space.slug
+    sites = sorted(set(Release.objects.filter(space=space).filter(Q(site=src_rel) | Q(site__startswith=f"{src_rel}/"))
+                       .values_list('site', flat=True)), key=len)
+    for site in sites:
+        new = dst_rel + site[len(src_rel):]
+        old_dir, new_dir = base / site, base / new
+        if old_dir.exists() and not new_dir.exists():  # nested sites moved with their parent already
+            new_dir.parent.mkdir(parents=True, exist_ok=True)
+            shutil.move(str(old_dir), str(new_dir))
+        Release.objects.filter(space=space, site=site).update(site=new)
+        r = live_release(space, new)
+        if r and os.path.lexists(live_path(space, new)):
+            _swap(live_path(space, new), release_dir(r))
+    return len(sites)
+
+def _adopt(space: Space, site: str) -> Release | None:
+    """First promote on a plain folder: keep its current content as an archived release.
+    Rows only; the folder is moved into the release dir by _adopt_dir() (see promote)."""
+    live = live_path(space, site)
+    if not live.is_dir() or live.is_symlink(): return None
+    r = Release.objects.create(space=space, site=site, label='adopted', state=Release.STATE_ARCHIVED,
+                               promoted_at=timezone.now())
+    # the folder's content predates every release of the site: order it first for rollback
+    first = (Release.objects.filter(space=space, site=site).exclude(id=r.id)
+             .order_by('created_at').values_list('created_at', flat=True).first())
+    r.created_at = (first or r.created_at) - timedelta(microseconds=1)
+    Release.objects.filter(id=r.id).update(created_at=r.created_at)
+    ReleaseFile.objects.bulk_create([
+        ReleaseFile(release=r, rel_path=_relative(site, a.rel_path), original_name=a.original_name,
+                    size=a.size, mime=a.mime, sha256=a.sha256)
+        for a in _site_assets(space, site).iterator(chunk_size=2000)
+    ], batch_size=2000)
+    _recount(r)
+    return r
+
+def _adopt_dir(live: Path, d: Path, undo: list):
+    """Move the plain folder `live` to release dir `d`, leaving a symlink in its place."""
+    d.parent.mkdir(parents=True, exist_ok=True)
+    # symlink first, then move the folder away: the gap is two renames
+    tmp = live.with_name(f".{live.name}.swap-{os.getpid()}")
+    tmp.unlink(missing_ok=True)
+    os.symlink(d, tmp, target_is_directory=True)
+    shutil.move(str(live), str(d))
+
+    def back():
+        if live.is_symlink(): live.unlink()
+        tmp.unlink(missing_ok=True)
+        shutil.move(str(d), str(live))
+    undo.append(back)
+    os.replace(tmp, live)
+
+def _swap_undoable(live: Path, target: Path, undo: list):
+    prev = Path(os.readlink(live)) if live.is_symlink() else None
+    _swap(live, target)
+    undo.append(lambda: _swap(live, prev) if prev else live.unlink(missing_ok=True))
+
+def _release_site_rows(space: Space, site: str):
+    """Before the site's rows are dropped: cold files go back into the folder/release dir they
+    belong to (a later rollback serves them from there) and stale derivatives are removed."""
+    for a in _site_assets(space, site).select_related('space__owner').iterator(chunk_size=2000):
+        if a.tier == Asset.TIER_COLD and not tiering.ensure_hot(a):
+            raise ReleaseError(f'cannot rehydrate {a.rel_path}/{a.original_name}')
+        for v in imageopt.derivative_paths(tiering.hot_path(a)): v.unlink(missing_ok=True)
+
+def promote(r: Release) -> Release:
+    """Make `r` live: Asset rows of the site replaced in one transaction, then the symlink swap.
+    Disk changes are undone if anything fails before the commit."""
+    space = r.space
+    if r.state == Release.STATE_LIVE: return r
+    if not release_dir(r).is_dir(): raise ReleaseError('release files are gone')
+    _release_site_rows(space, r.site)
+    undo: list = []
+    try:
+        with transaction.atomic():
+            r = Release.objects.select_for_update().select_related('space__owner').get(id=r.id)
+            if r.state == Release.STATE_LIVE: return r
+            adopted = _adopt(space, r.site)
+
+            old = _site_assets(space, r.site)
+            before = old.aggregate(b=Sum('size'), n=Count('id'))
+            old.delete()
+            prefix = r.site
+            rows = []
+            for f in r.files.all().iterator(chunk_size=2000):
+                rows.append(Asset(space=space, rel_path=f"{prefix}/{f.rel_path}" if f.rel_path else prefix,
+                                  original_name=f.original_name, size=f.size, mime=f.mime, sha256=f.sha256,
+                                  source_sha256=f.sha256))
+                if len(rows) >= 2000:
+                    Asset.objects.bulk_create(rows); rows.clear()
+            if rows: Asset.objects.bulk_create(rows)
+            _recount(r); r.refresh_from_db(fields=['file_count', 'total_bytes'])
+
+            Space.objects.filter(id=space.id).update(
+                used_bytes=F('used_bytes') + (r.total_bytes - (before['b'] or 0)),
+                file_count=F('file_count') + (r.file_count - (before['n'] or 0)),
+            )
+            Release.objects.filter(space=space, site=r.site, state=Release.STATE_LIVE).update(state=Release.STATE_ARCHIVED)
+            r.state, r.promoted_at = Release.STATE_LIVE, timezone.now()
+            r.save(update_fields=['state', 'promoted_at'])
+            changes.record(space, AssetChange.OP_RELEASE, r.site, size=r.total_bytes)
+
+            # disk last, inside the transaction: a failure here or in the commit is undone below
+            live = live_path(space, r.site)
+            if adopted: _adopt_dir(live, release_dir(adopted), undo)
+            _swap_undoable(live, release_dir(r), undo)
+            transaction.on_commit(lambda: gc_async(space, r.site))
+    except Exception:
+        for step in reversed(undo):
+            try:
+                step()
+            except OSError:
+                log.exception("release %s: undoing a disk change failed", r.id)
+        raise
+    return r
+
+def rollback(space: Space, site: str, steps: int = 1) -> Release:
+    """Promote the archived release `steps` versions before the live one (by creation,
+    not by promotion time: rolling back twice must not bounce back to the bad release)."""
+    qs = Release.objects.filter(space=space, site=site, state=Release.STATE_ARCHIVED)
+    live = live_release(space, site)
+    if live:
+        qs = qs.filter(Q(created_at__lt=live.created_at) | Q(created_at=live.created_at, id__lt=live.id))
+    prev = list(qs.order_by('-created_at', '-id')[:max(1, steps)])
+    if len(prev) < max(1, steps): raise ReleaseError('no release to roll back to')
+    return promote(prev[-1])
+
+def gc(space: Space | None = None, site: str | None = None, keep: int | None = None) -> int:
+    """Delete archived releases beyond `keep` and abandoned staging releases; returns count.
+    Kept first are the ones `rollback` reaches first: created before the live release, newest first."""
+    keep = settings.RELEASES_KEEP if keep is None else keep
+    stale_staging = timezone.now() - timedelta(hours=settings.RELEASES_STAGING_TTL_HOURS)
+    qs = Release.objects.select_related('space__owner')
+    if space is not None: qs = qs.filter(space=space)
+    if site is not None: qs = qs.filter(site=site)
+    doomed = list(qs.filter(state=Release.STATE_STAGING, created_at__lt=stale_staging))
+    sites: dict[tuple[int, str], list[Release]] = {}
+    for r in qs.filter(state=Release.STATE_ARCHIVED).order_by('space_id', 'site', '-created_at', '-id'):
+        sites.setdefault((r.space_id, r.site), []).append(r)
+    for (_, s), archived in sites.items():
+        live = live_release(archived[0].space, s)
+        if live:  # releases newer than the live one (rolled back from) go last; the sort is stable
+            archived.sort(key=lambda r: (r.created_at, r.id) > (live.created_at, live.id))
+        doomed.extend(archived[keep:])
+    for r in doomed:
+        shutil.rmtree(release_dir(r), ignore_errors=True)
+        r.delete()
+    return len(doomed)
+
+def gc_async(space: Space, site: str):
+    def run():
+        from django.db import connection
+        try:
+            gc(space, site)
+        except Exception:
+            log.exception("release gc failed for %s:%s", space.id, site)
+        finally:
+            connection.close()
+    threading.Thread(target=run, name='release-gc', daemon=True).start()
@@ -1,3 +1,792 @@
-from django.test import TestCase
+import io, os, shutil, subprocess, tempfile
+from datetime import timedelta
+from pathlib import Path
+from django.contrib.auth import get_user_model
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from .models import Space, Asset, AssetChange, Release
 
-# Create your tests here.
+
+class SpaceTestCase(TestCase):
+    """A user + default space with the CDN_* storage roots pointing at temp dirs."""
+
+    def setUp(self):
+        tmp = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, tmp, ignore_errors=True)
+        self.hot, self.cold = tmp / 'hot', tmp / 'cold'
+        self.hot.mkdir(); self.cold.mkdir()
+        self.releases = tmp / 'releases'
+        dirs = override_settings(CDN_ROOT=self.hot, CDN_COLD_ROOT=self.cold, CDN_RELEASES_ROOT=self.releases,
+                                 JOBS_ROOT=tmp / 'jobs')
+        dirs.enable()
+        self.addCleanup(dirs.disable)
+        self.user = get_user_model().objects.create_user('alice', 'alice@example.com', 'pw', name_spase='alice')
+        self.space = Space.objects.create(owner=self.user, name='Default', slug='default', is_default=True)
+        self.root = self.hot / 'alice' / 'default'
+        self.root.mkdir(parents=True)
+
+    def add_file(self, rel: str, name: str, data: bytes, mime: str = 'application/octet-stream') -> Asset:
+        d = self.root / rel if rel else self.root
+        d.mkdir(parents=True, exist_ok=True)
+        (d / name).write_bytes(data)
+        return Asset.objects.create(space=self.space, rel_path=rel, original_name=name, size=len(data), mime=mime)
+
+
+# ---------- schema ----------
+
+class AssetIndexTests(TestCase):
+
+    def test_listing_indexes_are_declared(self):
+        idx = {i.name: i for i in Asset._meta.indexes}
+        rel = idx['asset_space_relpath_idx']
+        self.assertEqual((rel.fields, rel.opclasses), (['space', 'rel_path'], ['int8_ops', 'text_pattern_ops']))
+        self.assertEqual(list(rel.include), ['original_name', 'size', 'mime', 'created_at'])
+        self.assertEqual(idx['asset_space_created_idx'].fields, ['space', '-created_at'])
+
+    def test_indexes_exist_in_the_database(self):
+        from django.db import connection
+        with connection.cursor() as cursor:
+            found = connection.introspection.get_constraints(cursor, Asset._meta.db_table)
+        self.assertLessEqual({'asset_space_relpath_idx', 'asset_space_created_idx'}, set(found))
+        self.assertEqual(found['asset_space_relpath_idx']['columns'][:2], ['space_id', 'rel_path'])
+
+
+# ---------- storage tiering ----------
+
+class TieringTests(SpaceTestCase):
+
+    def demote(self, a: Asset, compress: bool) -> bool:
+        from . import tiering
+        p = tiering.hot_path(a)
+        past = (timezone.now() - timedelta(days=200)).timestamp()
+        os.utime(p, (past, past))
+        return tiering.demote(a, timezone.now() - timedelta(days=90), compress=compress)
+
+    def test_demote_moves_file_to_cold_tier(self):
+        a = self.add_file('docs', 'a.bin', b'x' * 5000)
+        self.assertTrue(self.demote(a, compress=False))
+        a.refresh_from_db()
+        self.assertEqual(a.tier, Asset.TIER_COLD)
+        self.assertFalse((self.root / 'docs' / 'a.bin').exists())
+        self.assertEqual((self.cold / 'alice' / 'default' / 'docs' / 'a.bin').read_bytes(), b'x' * 5000)
+
+    def test_demote_keeps_recently_read_files_hot(self):
+        from . import tiering
+        a = self.add_file('', 'fresh.bin', b'y' * 100)
+        self.assertFalse(tiering.demote(a, timezone.now() - timedelta(days=90)))
+        a.refresh_from_db()
+        self.assertEqual(a.tier, Asset.TIER_HOT)
+
+    def test_rehydrate_restores_bytes(self):
+        from django.conf import settings
+        from . import tiering
+        for compress in (False, True):
+            if compress and not settings.ZSTD_AVAILABLE: continue
+            with self.subTest(compress=compress):
+                data = os.urandom(3000) + b'z' * 100000
+                a = self.add_file('r', f'c{int(compress)}.bin', data)
+                self.assertTrue(self.demote(a, compress=compress))
+                a.refresh_from_db()
+                self.assertTrue(tiering.rehydrate(a))
+                a.refresh_from_db()
+                self.assertEqual((a.tier, a.cold_codec), (Asset.TIER_HOT, ''))
+                self.assertEqual(tiering.hot_path(a).read_bytes(), data)
+                self.assertFalse(tiering.cold_path(a, 'zstd' if compress else '').exists())
+                self.assertEqual([p.name for p in tiering.hot_path(a).parent.iterdir() if p.name.startswith('.')], [])
+
+    def test_origin_rehydrates_cold_asset(self):
+        a = self.add_file('img', 'big.bin', b'q' * 4000)
+        self.assertTrue(self.demote(a, compress=False))
+        r = self.client.get('/api/origin/alice/default/img/big.bin')
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r['X-Accel-Redirect'], '/cdn/alice/default/img/big.bin')
+        self.assertTrue((self.root / 'img' / 'big.bin').exists())
+
+    def test_origin_404s(self):
+        a = self.add_file('', 'gone.bin', b'g')
+        (self.root / 'gone.bin').unlink()  # hot row, file removed out of band
+        self.assertEqual(self.client.get('/api/origin/alice/default/gone.bin').status_code, 404)
+        self.assertEqual(self.client.get('/api/origin/alice/default/nope.bin').status_code, 404)
+        Asset.objects.filter(id=a.id).update(is_public=False)
+        (self.root / 'gone.bin').write_bytes(b'g')
+        self.assertEqual(self.client.get('/api/origin/alice/default/gone.bin').status_code, 404)
+
+    def test_rename_onto_cold_asset_is_409(self):
+        import json
+        self.add_file('d', 'a.bin', b'aaa')
+        b = self.add_file('d', 'b.bin', b'b' * 4000)
+        self.assertTrue(self.demote(b, compress=False))
+        self.client.login(username='alice', password='pw')
+        r = self.client.post('/api/rename', json.dumps({'old_rel_path': 'd', 'old_name': 'a.bin', 'new_name': 'b.bin'}),
+                             content_type='application/json')
+        self.assertEqual(r.status_code, 409)
+        self.assertEqual((self.root / 'd' / 'a.bin').read_bytes(), b'aaa')
+        self.assertFalse((self.root / 'd' / 'b.bin').exists())
+        self.assertEqual(Asset.objects.get(id=b.id).tier, Asset.TIER_COLD)
+
+
+# ---------- image optimization ----------
+
+class ImageOptTests(SpaceTestCase):
+
+    def test_animated_png_is_left_alone(self):
+        from PIL import Image
+        from . import imageopt
+        frames = [Image.new('RGB', (16, 16), c) for c in ('red', 'green', 'blue', 'white')]
+        buf = io.BytesIO()
+        frames[0].save(buf, 'PNG', save_all=True, append_images=frames[1:])
+        a = self.add_file('img', 'anim.png', buf.getvalue(), 'image/png')
+
+        self.assertEqual(imageopt.optimize_asset(a), 0)
+        p = self.root / 'img' / 'anim.png'
+        self.assertEqual(p.read_bytes(), buf.getvalue())
+        with Image.open(p) as im:
+            self.assertEqual(im.n_frames, 4)
+        self.assertFalse(any(v.exists() for v in imageopt.derivative_paths(p)))
+        self.assertEqual(Space.objects.get(id=self.space.id).optimized_saved_bytes, 0)
+        a.refresh_from_db()
+        self.assertTrue(a.optimized_sha256)  # not opened again next time
+
+    def test_derivatives_keep_icc_profile(self):
+        from PIL import Image, ImageCms
+        from . import imageopt
+        icc = ImageCms.ImageCmsProfile(ImageCms.createProfile('sRGB')).tobytes()
+        buf = io.BytesIO()
+        Image.new('RGB', (64, 64), 'red').save(buf, 'PNG', compress_level=0, icc_profile=icc)
+        a = self.add_file('img', 'p3.png', buf.getvalue(), 'image/png')
+        imageopt.optimize_asset(a)
+        p = self.root / 'img' / 'p3.png'
+        with Image.open(p) as im:
+            self.assertEqual(im.info.get('icc_profile'), icc)
+        with Image.open(p) as im, Image.open(io.BytesIO(imageopt._derivative(im, 'WEBP'))) as webp:
+            self.assertEqual(webp.info.get('icc_profile'), icc)
+
+    def test_second_run_is_skipped_by_hash(self):
+        from unittest import mock
+        from PIL import Image
+        from . import imageopt
+        buf = io.BytesIO()
+        Image.new('RGB', (4, 4), 'red').save(buf, 'PNG')
+        a = self.add_file('img', 'tiny.png', buf.getvalue(), 'image/png')
+        with mock.patch.object(imageopt, '_derivative', return_value=b'x' * 100000):  # nothing smaller: none kept
+            imageopt.optimize_asset(a)
+        self.assertFalse(any(v.exists() for v in imageopt.derivative_paths(self.root / 'img' / 'tiny.png')))
+        a.refresh_from_db()
+        with mock.patch.object(imageopt, '_derivative') as derive, mock.patch.object(imageopt, '_recompress') as recompress:
+            self.assertEqual(imageopt.optimize_asset(a), 0)
+        derive.assert_not_called(); recompress.assert_not_called()
+
+
+# ---------- change feed ----------
+
+class ChangeFeedTests(SpaceTestCase):
+
+    def test_cursor_is_per_space_sequence(self):
+        from . import changes
+        other = Space.objects.create(owner=self.user, name='Other', slug='other')
+        changes.record(self.space, AssetChange.OP_MKDIR, 'a')
+        changes.record(other, AssetChange.OP_MKDIR, 'x')
+        changes.record_many(self.space, AssetChange.OP_DELETE, [{'rel_path': 'a', 'name': f'{i}.txt'} for i in range(3)])
+        items, cursor, more = changes.feed(self.space, 0, 100)
+        self.assertEqual([i['seq'] for i in items], [1, 2, 3, 4])
+        self.assertEqual((cursor, more), (4, False))
+        self.assertEqual(changes.current_cursor(self.space), 4)
+        self.assertEqual(changes.current_cursor(other), 1)
+        items, cursor, more = changes.feed(self.space, 1, 2)
+        self.assertEqual(([i['name'] for i in items], cursor, more), (['0.txt', '1.txt'], 3, True))
+
+    def test_batch_delete_records_only_deleted_rows(self):
+        from . import changes, fileops
+        self.add_file('d', 'a.txt', b'a')
+        fileops.delete_batch(self.space, [('d', 'a.txt'), ('d', 'missing.txt')])
+        items, _, _ = changes.feed(self.space, 0, 100)
+        self.assertEqual([(i['op'], i['name']) for i in items], [('delete', 'a.txt')])
+        self.assertFalse(Asset.objects.filter(space=self.space).exists())
+
+
+# ---------- manifest diff ----------
+
+class ManifestDiffTests(SpaceTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client.login(username='alice', password='pw')
+
+    def diff(self, files: dict, rel_path: str = ''):
+        import json
+        return self.client.post('/api/manifest/diff', json.dumps({'rel_path': rel_path, 'files': files}),
+                                content_type='application/json')
+
+    def test_diff(self):
+        import hashlib
+        self.add_file('site', 'same.js', b'same')
+        self.add_file('site', 'changed.js', b'old')
+        self.add_file('site/lib', 'stale.js', b'stale')
+        r = self.diff({
+            'same.js': {'size': 4, 'sha256': hashlib.sha256(b'same').hexdigest()},
+            'changed.js': {'size': 3, 'sha256': hashlib.sha256(b'new').hexdigest()},
+            'new.js': {'size': 1},
+        }, 'site').json()
+        self.assertEqual((r['upload'], r['delete'], r['unchanged']), (['changed.js', 'new.js'], ['lib/stale.js'], 1))
+
+    def test_optimized_image_matches_uploaded_hash(self):
+        import hashlib
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        from PIL import Image
+        from . import imageopt
+        from .models import AllowedExtension
+        AllowedExtension.objects.create(ext='png', enabled=True)
+        buf = io.BytesIO()
+        Image.new('RGB', (64, 64), 'red').save(buf, 'PNG', compress_level=0)
+        raw = buf.getvalue()
+        self.client.post('/api/upload?rel_path=site', {'file': SimpleUploadedFile('logo.png', raw, 'image/png')})
+        a = Asset.objects.get(space=self.space, original_name='logo.png')
+        self.assertGreater(imageopt.optimize_asset(a), 0)
+        r = self.diff({'logo.png': {'size': len(raw), 'sha256': hashlib.sha256(raw).hexdigest()}}, 'site').json()
+        self.assertEqual((r['upload'], r['unchanged']), ([], 1))
+
+    def test_malformed_entries_are_rejected(self):
+        for bad in ({'x.txt': 3}, {'x.txt': {'size': 'abc'}}, {'x.txt': {}}, {'x.txt': {'size': 1, 'sha256': 5}}):
+            with self.subTest(bad=bad):
+                r = self.diff(bad)
+                self.assertEqual(r.status_code, 400)
+                self.assertEqual(r.json()['key'], 'x.txt')
+
+
+# ---------- listing ETags ----------
+
+class ListingETagTests(SpaceTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client.login(username='alice', password='pw')
+
+    def test_listings_revalidate(self):
+        import json
+        self.add_file('docs', 'a.txt', b'a')
+        for url in ('/api/browse?rel_path=docs', '/api/assets'):
+            with self.subTest(url=url):
+                r = self.client.get(url)
+                etag = r['ETag']
+                self.assertTrue(etag.startswith('W/"'))
+                r = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+                self.assertEqual(r.status_code, 304)
+                self.assertEqual(r['ETag'], etag)
+                self.client.post('/api/mkdir', json.dumps({'rel_path': 'docs', 'name': f'n{len(url)}'}),
+                                 content_type='application/json')
+                r = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+                self.assertEqual(r.status_code, 200)
+                self.assertNotEqual(r['ETag'], etag)
+
+    def test_bootstrap(self):
+        self.add_file('', 'top.txt', b'x')
+        (self.root / 'empty').mkdir()
+        r = self.client.get('/api/bootstrap').json()
+        self.assertEqual(set(r), {'ok', 'spaces', 'allowed_extensions', 'browse'})
+        self.assertEqual([s['slug'] for s in r['spaces']], ['default'])
+        self.assertEqual((r['browse']['path'], r['browse']['folders']), ('', ['empty']))
+        self.assertEqual([f['name'] for f in r['browse']['files']], ['top.txt'])
+        self.assertEqual(r['browse']['etag'], self.client.get('/api/browse')['ETag'])
+        self.assertEqual(self.client.get('/api/browse', HTTP_IF_NONE_MATCH=r['browse']['etag']).status_code, 304)
+
+    def test_hash_backfill_changes_etag(self):
+        import json
+        self.add_file('', 'legacy.bin', b'old row')
+        etag = self.client.get('/api/assets')['ETag']
+        self.client.post('/api/manifest/diff', json.dumps({'files': {'legacy.bin': {'size': 7}}}),
+                         content_type='application/json')
+        r = self.client.get('/api/assets', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(r.status_code, 200)
+        self.assertTrue(r.json()['items'][0]['sha256'])
+
+
+# ---------- API tokens ----------
+
+class ApiTokenTests(SpaceTestCase):
+
+    def test_token_only_lists_its_space(self):
+        from . import auth
+        Space.objects.create(owner=self.user, name='Other', slug='other')
+        _, raw = auth.issue(self.space, 'ci', ['read'])
+        headers = {'HTTP_AUTHORIZATION': f'Bearer {raw}'}
+        r = self.client.get('/api/spaces', **headers)
+        self.assertEqual([s['slug'] for s in r.json()['items']], ['default'])
+        r = self.client.get('/api/bootstrap', **headers)
+        self.assertEqual([s['slug'] for s in r.json()['spaces']], ['default'])
+        self.client.login(username='alice', password='pw')
+        self.assertEqual(len(self.client.get('/api/spaces').json()['items']), 2)
+
+    def bearer(self, scopes=('read',), **kw) -> dict:
+        from . import auth
+        self.token, raw = auth.issue(self.space, 'ci', scopes, **kw)
+        return {'HTTP_AUTHORIZATION': f'Bearer {raw}'}
+
+    def test_read_token_cannot_write(self):
+        import json
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        self.add_file('', 'a.txt', b'a')
+        h = self.bearer(['read'])
+        r = self.client.post('/api/upload', {'file': SimpleUploadedFile('b.txt', b'b')}, **h)
+        self.assertEqual(r.status_code, 403)
+        for url, body in (('/api/mkdir', {'name': 'x'}), ('/api/delete', {'name': 'a.txt'})):
+            with self.subTest(url=url):
+                r = self.client.post(url, json.dumps(body), content_type='application/json', **h)
+                self.assertEqual(r.status_code, 403)
+        self.assertTrue(Asset.objects.filter(original_name='a.txt').exists())
+        self.assertFalse((self.root / 'x').exists())
+        self.assertEqual(self.client.get('/api/browse', **h).status_code, 200)
+
+    def test_revocation_applies_after_cache_ttl(self):
+        import time
+        from unittest import mock
+        from django.conf import settings
+        from .models import ApiToken
+        h = self.bearer()
+        self.assertEqual(self.client.get('/api/browse', **h).status_code, 200)
+        ApiToken.objects.filter(id=self.token.id).update(revoked=True)  # revoked from another process
+        self.assertEqual(self.client.get('/api/browse', **h).status_code, 200)
+        later = time.time() + settings.API_TOKEN_CACHE_TTL + 1
+        with mock.patch('time.time', return_value=later):
+            self.assertEqual(self.client.get('/api/browse', **h).status_code, 401)
+
+    def test_revoke_is_immediate_here(self):
+        from . import auth
+        h = self.bearer()
+        self.assertEqual(self.client.get('/api/browse', **h).status_code, 200)
+        auth.revoke(self.token)
+        self.assertEqual(self.client.get('/api/browse', **h).status_code, 401)
+
+    def test_expired_token(self):
+        h = self.bearer(expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(self.client.get('/api/browse', **h).status_code, 401)
+
+    def test_inactive_owner(self):
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.get('/api/browse', **self.bearer()).status_code, 401)
+
+    def test_session_posts_need_csrf(self):
+        import json
+        from django.test import Client
+        c = Client(enforce_csrf_checks=True)
+        c.login(username='alice', password='pw')
+        body = json.dumps({'name': 'x'})
+        self.assertEqual(c.post('/api/mkdir', body, content_type='application/json').status_code, 403)
+        c.get('/dashboard/')  # sets the csrftoken cookie
+        r = c.post('/api/mkdir', body, content_type='application/json', HTTP_X_CSRFTOKEN=c.cookies['csrftoken'].value)
+        self.assertEqual(r.status_code, 201)
+        h = self.bearer(['upload'])
+        r = Client(enforce_csrf_checks=True).post('/api/mkdir', json.dumps({'name': 'y'}),
+                                                  content_type='application/json', **h)
+        self.assertEqual(r.status_code, 201)
+
+
+# ---------- export / import ----------
+
+class ExportImportTests(SpaceTestCase):
+
+    def export(self, tmp: Path):
+        from django.core.management import call_command
+        call_command('export_space', 'alice/default', output=str(tmp / 'a.ndjson'), files=str(tmp / 'a.tar'),
+                     stderr=io.StringIO())
+
+    def load(self, tmp: Path, *args) -> str:
+        from django.core.management import call_command
+        err = io.StringIO()
+        call_command('import_space', str(tmp / 'a.ndjson'), '--owner', 'bob', *args, stderr=err)
+        return err.getvalue()
+
+    def test_round_trip(self):
+        import tarfile
+        from . import changes
+        tmp = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, tmp, ignore_errors=True)
+        a = self.add_file('docs', 'a.txt', b'alpha', 'text/plain')
+        self.add_file('', 'b.bin', b'bravo!')
+        old = timezone.now() - timedelta(days=30)
+        Asset.objects.filter(id=a.id).update(created_at=old)
+        self.export(tmp)
+        with tarfile.open(tmp / 'a.tar') as tar:
+            self.assertEqual({m.name: tar.extractfile(m).read() for m in tar}, {'docs/a.txt': b'alpha', 'b.bin': b'bravo!'})
+
+        bob = get_user_model().objects.create_user('bob', 'bob@example.com', 'pw', name_spase='bob')
+        out = self.load(tmp, '--files', str(tmp / 'a.tar'), '--verify')
+        self.assertIn('Imported 2 rows', out)
+        space = Space.objects.get(owner=bob, slug='default')
+        rows = {(r.rel_path, r.original_name): r for r in Asset.objects.filter(space=space)}
+        self.assertEqual(set(rows), {('docs', 'a.txt'), ('', 'b.bin')})
+        self.assertEqual(rows[('docs', 'a.txt')].created_at, old)
+        self.assertEqual((rows[('docs', 'a.txt')].mime, rows[('docs', 'a.txt')].size), ('text/plain', 5))
+        self.assertEqual((self.hot / 'bob' / 'default' / 'docs' / 'a.txt').read_bytes(), b'alpha')
+        self.assertEqual((space.used_bytes, space.file_count), (11, 2))
+        items, _, _ = changes.feed(space, 0, 100)
+        self.assertEqual(sorted((i['op'], i['name']) for i in items), [('upload', 'a.txt'), ('upload', 'b.bin')])
+
+        self.assertIn('Imported 0 rows', self.load(tmp))  # existing rows are kept, not counted
+        self.assertEqual(len(changes.feed(space, 0, 100)[0]), 2)
+
+        Asset.objects.filter(space=space).delete()
+        (self.hot / 'bob' / 'default' / 'b.bin').write_bytes(b'BRAVO!')  # same size, other bytes
+        self.assertIn('1 size/hash mismatches', self.load(tmp, '--verify'))
+        self.assertEqual(list(Asset.objects.filter(space=space).values_list('original_name', flat=True)), ['a.txt'])
+
+
+# ---------- releases ----------
+
+class ReleaseTests(SpaceTestCase):
+
+    def deploy(self, site: str, files: dict[str, bytes], label: str = ''):
+        from . import releases
+        r = releases.create(self.space, site, label)
+        for path, data in files.items():
+            rel, _, name = path.rpartition('/')
+            releases.add_file(r, rel, name, [data], 'text/plain')
+        return releases.promote(r)
+
+    def test_folder_ops_on_promoted_site(self):
+        import json
+        self.deploy('web', {'index.html': b'v1'})
+        self.assertTrue((self.root / 'web').is_symlink())
+        self.client.login(username='alice', password='pw')
+
+        r = self.client.post('/api/mkdir', json.dumps({'rel_path': 'web', 'name': 'extra'}), content_type='application/json')
+        self.assertEqual(r.status_code, 201, r.content)
+
+        r = self.client.post('/api/folder/move', json.dumps({'old_rel_path': '', 'name': 'web', 'new_name': 'site'}),
+                             content_type='application/json')
+        self.assertEqual(r.status_code, 200, r.content)
+        self.assertEqual((self.root / 'site' / 'index.html').read_bytes(), b'v1')
+        self.assertTrue(Asset.objects.filter(space=self.space, rel_path='site', original_name='index.html').exists())
+        self.assertEqual(set(self.space.releases.values_list('site', flat=True)), {'site'})
+
+        r = self.client.delete('/api/rmdir?rel_path=site&recursive=1')
+        self.assertEqual(r.status_code, 200, r.content)
+        self.assertFalse(os.path.lexists(self.root / 'site'))
+        self.assertFalse(Asset.objects.filter(space=self.space).exists())
+
+    def test_rollback_walks_back_by_creation(self):
+        from . import releases
+        for v in ('v1', 'v2', 'v3'):
+            self.deploy('web', {'index.html': v.encode()}, v)
+        self.assertEqual(releases.rollback(self.space, 'web').label, 'v2')
+        self.assertEqual(releases.rollback(self.space, 'web').label, 'v1')
+        with self.assertRaises(releases.ReleaseError):
+            releases.rollback(self.space, 'web')
+        self.assertEqual((self.root / 'web' / 'index.html').read_bytes(), b'v1')
+
+    def test_gc_keeps_what_rollback_needs(self):
+        from . import releases
+        for v in ('v1', 'v2', 'v3'):
+            self.deploy('web', {'index.html': v.encode()}, v)
+        releases.rollback(self.space, 'web')
+        self.assertEqual(releases.gc(self.space, 'web', keep=1), 1)
+        self.assertEqual(sorted(Release.objects.values_list('label', flat=True)), ['v1', 'v2'])
+        self.assertEqual(releases.rollback(self.space, 'web').label, 'v1')
+        self.assertEqual((self.root / 'web' / 'index.html').read_bytes(), b'v1')
+
+    def test_rollback_to_adopted_folder(self):
+        from . import releases
+        self.add_file('web', 'index.html', b'plain')
+        self.deploy('web', {'index.html': b'v1'}, 'v1')
+        self.assertEqual(releases.rollback(self.space, 'web').label, 'adopted')
+        self.assertEqual((self.root / 'web' / 'index.html').read_bytes(), b'plain')
+
+    def test_failed_promote_leaves_disk_and_rows_alone(self):
+        from unittest import mock
+        from . import releases
+        self.add_file('web', 'index.html', b'plain')
+        r = releases.create(self.space, 'web')
+        releases.add_file(r, '', 'index.html', [b'v1'], 'text/html')
+        with mock.patch.object(releases.changes, 'record', side_effect=RuntimeError('boom')), \
+                self.assertRaises(RuntimeError):
+            releases.promote(r)
+        self.assertFalse((self.root / 'web').is_symlink())
+        self.assertEqual((self.root / 'web' / 'index.html').read_bytes(), b'plain')
+        self.assertEqual(list(self.space.releases.values_list('state', flat=True)), [Release.STATE_STAGING])
+        self.assertTrue(Asset.objects.filter(space=self.space, rel_path='web', original_name='index.html').exists())
+
+    def test_failed_swap_is_undone(self):
+        from unittest import mock
+        from . import releases
+        self.add_file('web', 'index.html', b'plain')
+        r = releases.create(self.space, 'web')
+        releases.add_file(r, '', 'index.html', [b'v1'], 'text/html')
+        with mock.patch.object(releases, '_swap', side_effect=OSError('disk full')), self.assertRaises(OSError):
+            releases.promote(r)
+        self.assertFalse((self.root / 'web').is_symlink())
+        self.assertEqual((self.root / 'web' / 'index.html').read_bytes(), b'plain')
+        self.assertEqual(self.space.releases.count(), 1)
+
+    def test_cold_site_files_come_back_for_rollback(self):
+        from . import releases, tiering
+        self.deploy('web', {'big.bin': b'b' * 5000}, 'v1')
+        a = Asset.objects.get(space=self.space, original_name='big.bin')
+        a.space = self.space
+        past = (timezone.now() - timedelta(days=200)).timestamp()
+        os.utime(tiering.hot_path(a), (past, past))
+        self.assertTrue(tiering.demote(a, timezone.now() - timedelta(days=90), compress=False))
+        self.deploy('web', {'big.bin': b'2'}, 'v2')
+        self.assertFalse(tiering.cold_path(a, '').exists())
+        releases.rollback(self.space, 'web')
+        a = Asset.objects.get(space=self.space, original_name='big.bin')
+        self.assertEqual(a.tier, Asset.TIER_HOT)
+        self.assertEqual((self.root / 'web' / 'big.bin').read_bytes(), b'b' * 5000)
+
+
+# ---------- filesystem watcher ----------
+
+class WatcherTests(SpaceTestCase):
+
+    def index(self):
+        from .watcher import Index
+        return Index(self.hot)
+
+    def test_reconcile_syncs_out_of_band_changes(self):
+        kept = self.add_file('a', 'kept.txt', b'1')
+        self.add_file('a', 'gone.txt', b'22')
+        (self.root / 'a' / 'gone.txt').unlink()
+        (self.root / 'a' / 'kept.txt').write_bytes(b'1234')
+        (self.root / 'b').mkdir()
+        (self.root / 'b' / 'new.txt').write_bytes(b'abc')
+        (self.root / 'b' / '.hidden').write_bytes(b'x')
+        Space.objects.filter(id=self.space.id).update(used_bytes=3, file_count=2)
+
+        stats = self.index().reconcile(self.space)
+        self.assertEqual(stats, {'created': 1, 'updated': 1, 'renamed': 0, 'deleted': 1})
+        self.assertEqual(sorted(Asset.objects.filter(space=self.space).values_list('rel_path', 'original_name', 'size')),
+                         [('a', 'kept.txt', 4), ('b', 'new.txt', 3)])
+        sp = Space.objects.get(id=self.space.id)
+        self.assertEqual((sp.used_bytes, sp.file_count), (7, 2))
+        self.assertEqual(self.index().reconcile(self.space), {'created': 0, 'updated': 0, 'renamed': 0, 'deleted': 0})
+
+    def test_reconcile_keeps_rows_for_skipped_names(self):
+        self.add_file('img', 'hero.png.webp', b'uploaded webp')
+        self.add_file('img', 'notes.tmp', b'tmp')
+        self.add_file('img', 'x.png', b'png')
+        (self.root / 'img' / 'x.png.webp').write_bytes(b'derivative')
+        (self.root / 'img' / 'lone.jpg.avif').write_bytes(b'no original: a file like any other')
+        self.assertEqual(self.index().reconcile(self.space), {'created': 1, 'updated': 0, 'renamed': 0, 'deleted': 0})
+        self.assertEqual(sorted(Asset.objects.filter(space=self.space).values_list('original_name', flat=True)),
+                         ['hero.png.webp', 'lone.jpg.avif', 'notes.tmp', 'x.png'])
+
+    def test_upload_takes_over_row_indexed_by_watcher(self):
+        from unittest import mock
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        from . import views
+        from .models import AllowedExtension
+        AllowedExtension.objects.create(ext='txt', enabled=True)
+        real = views.write_chunks
+
+        def write_then_index(chunks, path):
+            out = real(chunks, path)
+            self.index().apply_paths([str(path)])  # watcher wins the race for the row
+            return out
+
+        self.client.login(username='alice', password='pw')
+        with mock.patch.object(views, 'write_chunks', write_then_index):
+            r = self.client.post('/api/upload?rel_path=up', {'file': SimpleUploadedFile('a.txt', b'hello')})
+        self.assertEqual(r.status_code, 200, r.content)
+        self.assertEqual(r.json()['name'], 'a.txt')
+        a = Asset.objects.get(space=self.space, rel_path='up')
+        self.assertEqual((a.original_name, a.size, a.mime), ('a.txt', 5, 'text/plain'))
+        sp = Space.objects.get(id=self.space.id)
+        self.assertEqual((sp.used_bytes, sp.file_count), (5, 1))
+
+    def test_optimizer_rewrite_is_not_an_outside_edit(self):
+        from PIL import Image
+        from . import imageopt
+        buf = io.BytesIO()
+        Image.new('RGB', (64, 64), 'red').save(buf, 'PNG', compress_level=0)
+        a = self.add_file('img', 'raw.png', buf.getvalue(), 'image/png')
+        stale = Asset.objects.get(id=a.id)  # loaded by the watcher before the rewrite settled
+        Space.objects.filter(id=self.space.id).update(used_bytes=a.size, file_count=1)
+        saved = imageopt.optimize_asset(a)
+        self.assertGreater(saved, 0)
+
+        new_size = (self.root / 'img' / 'raw.png').stat().st_size
+        stats = self.index()._write(self.space, [], [(stale, new_size)], [], [])
+        self.assertEqual(stats['updated'], 0)
+        a.refresh_from_db()
+        self.assertEqual((a.size, a.optimized_sha256), (new_size, a.sha256))
+        self.assertTrue(a.sha256)
+        sp = Space.objects.get(id=self.space.id)
+        self.assertEqual((sp.used_bytes, sp.optimized_saved_bytes), (new_size, saved))
+
+
+# ---------- folder ops + job queue ----------
+
+class FolderJobTests(SpaceTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client.login(username='alice', password='pw')
+
+    def post(self, url: str, body: dict):
+        import json
+        return self.client.post(url, json.dumps(body), content_type='application/json')
+
+    def run_jobs(self):
+        from . import jobs
+        while job := jobs.claim('test'):
+            jobs.execute(job)
+
+    def test_folder_move_conflict_is_409(self):
+        from unittest import mock
+        from . import fileops
+        self.add_file('src', 'a.txt', b'a')
+        with mock.patch.object(fileops, 'move_folder', side_effect=fileops.FileOpError('dst exists')):
+            r = self.post('/api/folder/move', {'old_rel_path': '', 'name': 'src', 'new_name': 'dst'})
+        self.assertEqual((r.status_code, r.json()['error']), (409, 'dst exists'))
+
+    def test_async_rmdir_runs_as_job(self):
+        from .models import Job
+        for i in range(3): self.add_file('big/sub', f'{i}.txt', b'x' * 10)
+        Space.objects.filter(id=self.space.id).update(used_bytes=30, file_count=3)
+        r = self.client.delete('/api/rmdir?rel_path=big&recursive=1&async=1')
+        self.assertEqual(r.status_code, 202)
+        self.assertEqual(r['Location'], f"/api/jobs/{r.json()['job']['id']}")
+        self.run_jobs()
+        job = self.client.get(r['Location']).json()['job']
+        self.assertEqual((job['state'], job['result'], job['progress']), (Job.STATE_DONE, {'deleted': 3}, 3))
+        self.assertFalse((self.root / 'big').exists())
+        sp = Space.objects.get(id=self.space.id)
+        self.assertEqual((sp.used_bytes, sp.file_count), (0, 0))
+
+    def test_async_zip_download(self):
+        import zipfile
+        self.add_file('z', 'a.txt', b'aaa')
+        r = self.post('/api/zip', {'items': [{'rel_path': 'z', 'name': 'a.txt'}], 'async': True})
+        self.assertEqual(r.status_code, 202)
+        self.run_jobs()
+        job = self.client.get(r['Location']).json()['job']
+        dl = self.client.get(job['result']['download'])
+        with zipfile.ZipFile(io.BytesIO(b''.join(dl.streaming_content))) as z:
+            self.assertEqual(z.read('z/a.txt'), b'aaa')
+
+    def test_failed_job_is_retried_then_failed(self):
+        from unittest import mock
+        from . import jobs
+        from .models import Job
+        job = jobs.enqueue(self.space, Job.KIND_RMDIR, {'rel_path': 'x'})
+        with mock.patch.dict(jobs.HANDLERS, {Job.KIND_RMDIR: mock.Mock(side_effect=OSError('busy'))}), \
+                self.settings(JOBS_RETRY_DELAY=0), self.assertLogs('core.jobs', 'ERROR'):
+            for _ in range(job.max_attempts):
+                jobs.execute(jobs.claim('test'))
+        job.refresh_from_db()
+        self.assertEqual((job.state, job.attempts, job.error), (Job.STATE_FAILED, job.max_attempts, 'busy'))
+
+    def test_cancel_queued_job(self):
+        from . import jobs
+        from .models import Job
+        job = jobs.enqueue(self.space, Job.KIND_RMDIR, {'rel_path': 'x'})
+        self.assertEqual(self.post(f'/api/jobs/{job.id}/cancel', {}).json()['job']['state'], Job.STATE_CANCELED)
+        self.assertIsNone(jobs.claim('test'))
+
+
+# ---------- cache policies ----------
+
+class CachePolicyTests(SpaceTestCase):
+
+    def policy_for(self, text: str, uri: str, exact_only: bool = False) -> str:
+        """Evaluate the generated $cdn_policy map the way nginx would: exact keys, then regexes in order."""
+        import re
+        space_key = '/'.join(uri.split('/')[2:4])
+        marked = re.search(r'map \$cdn_space \$cdn_folder_policies \{(.*?)\}', text, re.S).group(1)
+        key = ('1' if f'"{space_key}" 1;' in marked else '') + uri.rsplit('/', 1)[0]
+        body = re.search(r'map "\$cdn_folder_policies\$cdn_dir" \$cdn_policy \{(.*?)\}', text, re.S).group(1)
+        exact = dict(re.findall(r'"([^~"][^"]*)" (p\d+);', body))
+        if key in exact or exact_only: return exact.get(key, '')
+        for rx, pid in re.findall(r'"~(.*)" (p\d+);', body):
+            if re.search(rx.replace('\\\\', '\\'), key): return pid
+        spaces = re.search(r'map \$cdn_space \$cdn_space_policy \{(.*?)\}', text, re.S).group(1)
+        m = re.search(rf'"{re.escape(space_key)}" (p\d+);', spaces)
+        return m.group(1) if m else ''
+
+    def test_new_subfolders_inherit_without_rerender(self):
+        from .cachepolicy import compile_maps
+        from .models import CachePolicy
+        root = CachePolicy.objects.create(space=self.space, prefix='', max_age=3600)
+        data = CachePolicy.objects.create(space=self.space, prefix='data', max_age=60)
+        live = CachePolicy.objects.create(space=self.space, prefix='data/live', max_age=0)
+        text = compile_maps()
+        cases = {
+            '/cdn/alice/default/x.js': root, '/cdn/alice/default/data/x.json': data,
+            '/cdn/alice/default/data/new/deep/x.json': data, '/cdn/alice/default/data/live/x.json': live,
+            '/cdn/alice/default/data/live/created/later/x.json': live, '/cdn/alice/default/database/x': root,
+        }
+        for uri, policy in cases.items():
+            with self.subTest(uri=uri):
+                self.assertEqual(self.policy_for(text, uri), f'p{policy.id}')
+        self.assertEqual(self.policy_for(text, '/cdn/bob/default/data/x'), '')
+        self.assertIn(f'p{live.id} "no-cache', text)
+
+    def test_existing_folders_are_hash_entries(self):
+        from .cachepolicy import compile_maps
+        from .models import CachePolicy
+        data = CachePolicy.objects.create(space=self.space, prefix='data', max_age=60)
+        live = CachePolicy.objects.create(space=self.space, prefix='data/live', max_age=0)
+        (self.root / 'data' / 'live' / 'v1').mkdir(parents=True)
+        self.add_file('data/old', 'x.json', b'{}')
+        text = compile_maps()
+        cases = {'/cdn/alice/default/data/x': data, '/cdn/alice/default/data/old/x.json': data,
+                 '/cdn/alice/default/data/live/x': live, '/cdn/alice/default/data/live/v1/x': live}
+        for uri, policy in cases.items():
+            with self.subTest(uri=uri):
+                self.assertEqual(self.policy_for(text, uri, exact_only=True), f'p{policy.id}')
+        self.assertEqual(self.policy_for(text, '/cdn/alice/default/data/live/v2/x', exact_only=True), '')
+        self.assertEqual(self.policy_for(text, '/cdn/alice/default/data/live/v2/x'), f'p{live.id}')
+
+    def test_mkdir_does_not_reload_nginx(self):
+        import json
+        from unittest import mock
+        from . import cachepolicy
+        from .models import CachePolicy
+        CachePolicy.objects.create(space=self.space, prefix='data', max_age=0)
+        self.client.login(username='alice', password='pw')
+        with mock.patch.object(cachepolicy, 'render_async') as render:
+            r = self.client.post('/api/mkdir', json.dumps({'rel_path': 'data', 'name': 'new'}), content_type='application/json')
+        self.assertEqual(r.status_code, 201)
+        render.assert_not_called()
+
+
+# ---------- benchmark harness ----------
+
+class BenchTests(SimpleTestCase):
+    """Runs `manage.py bench` in a child process: it builds and drops its own test database."""
+
+    def bench(self, *args) -> subprocess.CompletedProcess:
+        import sys
+        from django.conf import settings
+        return subprocess.run([sys.executable, 'manage.py', 'bench', '--scales', '20', '--requests', '2',
+                               '--only', 'spaces,browse_folder,mkdir', *args],
+                              cwd=settings.BASE_DIR, capture_output=True, text=True, timeout=300)
+
+    def test_baseline_and_compare(self):
+        import json
+        tmp = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, tmp, ignore_errors=True)
+        r = self.bench('-o', str(tmp / 'base.json'))
+        self.assertEqual(r.returncode, 0, r.stderr)
+        base = json.loads((tmp / 'base.json').read_text())
+        self.assertEqual(set(base), {'meta', 'scales'})
+        self.assertEqual(set(base['meta']), {'commit', 'time', 'python', 'db', 'requests', 'concurrency', 'mode'})
+        endpoints = base['scales']['20']['endpoints']
+        self.assertEqual(set(endpoints), {'spaces', 'browse_folder', 'mkdir'})
+        for name, m in endpoints.items():
+            with self.subTest(endpoint=name):
+                self.assertEqual((m['requests'], m['errors']), (2, 0))
+                self.assertLessEqual({'p50_ms', 'p99_ms', 'mean_ms', 'queries_per_request', 'throughput_rps',
+                                      'peak_rss_kb'}, set(m))
+
+        for m in endpoints.values():  # an impossibly fast baseline: everything regressed
+            m['p50_ms'] = m['p99_ms'] = 1e-6
+        (tmp / 'fast.json').write_text(json.dumps(base))
+        r = self.bench('--compare', str(tmp / 'fast.json'))
+        self.assertEqual(r.returncode, 1)
+        self.assertIn('regressed', r.stderr)
+
+        for m in endpoints.values():
+            m['p50_ms'] = m['p99_ms'] = 1e6
+            m['queries_per_request'] = 1e6
+        (tmp / 'slow.json').write_text(json.dumps(base))
+        self.assertEqual(self.bench('--compare', str(tmp / 'slow.json')).returncode, 0)
@@ -0,0 +1,187 @@
+"""Hot/cold storage tiering for assets.
+
+Hot files live under CDN_ROOT and are served by nginx straight from disk.
+Cold files are moved to CDN_COLD_ROOT (optionally zstd-compressed); the hot
+path disappears and nginx falls back to the Django origin, which rehydrates
+the file on first request and hands it back to nginx via X-Accel-Redirect.
+"""
+from __future__ import annotations
+import os, time, threading
+from datetime import datetime, timedelta, timezone as dt_timezone
+from pathlib import Path
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from .models import Asset
+
+CHUNK = 1024 * 1024
+
+
+class RateLimiter:
+    """Simple token bucket to keep background tiering I/O under `rate` bytes/sec."""
+
+    def __init__(self, rate: int):
+        self.rate = rate
+        self.start = time.monotonic()
+        self.done = 0
+
+    def consume(self, n: int):
+        if self.rate <= 0: return
+        self.done += n
+        ahead = self.done / self.rate - (time.monotonic() - self.start)
+        if ahead > 0: time.sleep(ahead)
+
+
+def hot_path(asset: Asset) -> Path:
+    """CDN_ROOT/<name_spase>/<slug>/<rel_path>/<name> (no mkdir)."""
+    p = Path(settings.CDN_ROOT) / asset.space.owner.name_spase / asset.space.slug
+    if asset.rel_path: p = p / asset.rel_path
+    return p / asset.original_name
+
+def cold_path(asset: Asset, codec: str | None = None) -> Path:
+    """Same layout as hot_path under CDN_COLD_ROOT; '.zst' suffix when compressed."""
+    codec = asset.cold_codec if codec is None else codec
+    p = Path(settings.CDN_COLD_ROOT) / asset.space.owner.name_spase / asset.space.slug
+    if asset.rel_path: p = p / asset.rel_path
+    return p / (asset.original_name + ('.zst' if codec == 'zstd' else ''))
+
+def last_access(asset: Asset, st: os.stat_result) -> datetime:
+    """Most recent known access: file atime (nginx reads) or the recorded rehydrate time."""
+    seen = datetime.fromtimestamp(st.st_atime, tz=dt_timezone.utc)
+    if asset.last_accessed_at and asset.last_accessed_at > seen:
+        return asset.last_accessed_at
+    return seen
+
+def _copy(src: Path, dst: Path, limiter: RateLimiter | None, compress: bool = False, decompress: bool = False):
+    """Stream src -> dst.part -> dst, optionally through zstd, fsync before the rename."""
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    tmp = dst.with_name(f"{dst.name}.{os.getpid()}.part")
+    try:
+        with src.open('rb') as fin, tmp.open('wb') as fout:
+            reader, writer = fin, fout
+            if compress or decompress:
+                import zstandard  # type: ignore
+                if compress:
+                    writer = zstandard.ZstdCompressor(level=10).stream_writer(fout, closefd=False)
+                else:
+                    reader = zstandard.ZstdDecompressor().stream_reader(fin)
+            while True:
+                chunk = reader.read(CHUNK)
+                if not chunk: break
+                writer.write(chunk)
+                if limiter: limiter.consume(len(chunk))
+            if writer is not fout: writer.close()
+            fout.flush()
+            os.fsync(fout.fileno())
+        os.replace(tmp, dst)
+    finally:
+        if tmp.exists(): tmp.unlink()
+
+def cold_candidates(min_bytes: int | None = None, space=None):
+    """Hot assets at least `min_bytes` big; the atime check happens per file in demote()."""
+    min_bytes = settings.TIER_MIN_BYTES if min_bytes is None else min_bytes
+    qs = Asset.objects.filter(tier=Asset.TIER_HOT, size__gte=min_bytes).select_related('space__owner')
+    if space is not None: qs = qs.filter(space=space)
+    return qs.order_by('id')
+
+def demote(asset: Asset, cutoff: datetime, limiter: RateLimiter | None = None, compress: bool | None = None) -> bool:
+    """Move one hot asset to the cold tier if it has not been read since `cutoff`."""
+    src = hot_path(asset)
+    try:
+        st = src.stat()
+    except FileNotFoundError:
+        return False
+    if last_access(asset, st) >= cutoff: return False
+
+    if compress is None: compress = settings.TIER_COMPRESS
+    codec = 'zstd' if compress and getattr(settings, 'ZSTD_AVAILABLE', False) else ''
+    dst = cold_path(asset, codec)
+    _copy(src, dst, limiter, compress=bool(codec))
+
+    # file changed while we were copying -> keep it hot
+    st2 = src.stat()
+    if (st2.st_size, st2.st_mtime_ns) != (st.st_size, st.st_mtime_ns):
+        dst.unlink(missing_ok=True)
+        return False
+
+    with transaction.atomic():
+        updated = Asset.objects.filter(id=asset.id, tier=Asset.TIER_HOT).update(tier=Asset.TIER_COLD, cold_codec=codec)
+    if not updated:
+        dst.unlink(missing_ok=True)
+        return False
+    src.unlink(missing_ok=True)
+    asset.tier, asset.cold_codec = Asset.TIER_COLD, codec
+    return True
+
+def rehydrate(asset: Asset, limiter: RateLimiter | None = None) -> bool:
+    """Bring a cold asset back to CDN_ROOT. Returns True if the hot file is in place."""
+    a = Asset.objects.select_related('space__owner').filter(id=asset.id).first()
+    if a is None: return False
+    dst = hot_path(a)
+    if a.tier == Asset.TIER_HOT:
+        return dst.exists()
+    src = cold_path(a)
+    # copy/decompress before taking the row lock: under the SQLite profile that lock is
+    # the database-wide write lock. Dotfile name: the watcher ignores it.
+    staging = dst.with_name(f".{dst.name}.{os.getpid()}.{threading.get_ident()}.rehydrate")
+    try:
+        try:
+            _copy(src, staging, limiter, decompress=(a.cold_codec == 'zstd'))
+        except FileNotFoundError:
+            return dst.exists()  # a concurrent rehydrate already moved it
+        with transaction.atomic():
+            row = (Asset.objects.select_for_update().filter(id=a.id)
+                   .values_list('tier', 'cold_codec', 'rel_path', 'original_name').first())
+            if row != (Asset.TIER_COLD, a.cold_codec, a.rel_path, a.original_name):
+                return dst.exists()  # rehydrated, renamed or deleted meanwhile
+            os.replace(staging, dst)
+            Asset.objects.filter(id=a.id).update(tier=Asset.TIER_HOT, cold_codec='', last_accessed_at=timezone.now())
+    finally:
+        staging.unlink(missing_ok=True)
+    src.unlink(missing_ok=True)
+    asset.tier, asset.cold_codec = Asset.TIER_HOT, ''
+    return True
+
+def open_asset(asset: Asset):
+    """Readable binary stream of the asset's bytes, whichever tier it is on."""
+    if asset.tier == Asset.TIER_COLD:
+        f = cold_path(asset).open('rb')
+        if asset.cold_codec == 'zstd':
+            import zstandard  # type: ignore
+            return zstandard.ZstdDecompressor().stream_reader(f, closefd=True)
+        return f
+    return hot_path(asset).open('rb')
+
+def ensure_hot(asset: Asset) -> bool:
+    """Used by views that need the bytes on the hot path (rename, zip)."""
+    if asset.tier != Asset.TIER_COLD: return True
+    return rehydrate(asset)
+
+def discard_cold(asset: Asset):
+    """Remove the cold copy of an asset being deleted."""
+    if asset.tier == Asset.TIER_COLD:
+        cold_path(asset).unlink(missing_ok=True)
+
+def run(older_than_days: int | None = None, min_bytes: int | None = None, rate: int | None = None,
+        limit: int | None = None, space=None, dry_run: bool = False, log=None) -> dict:
+    """One tiering pass over hot assets; returns counters for the management command."""
+    days = settings.TIER_COLD_AFTER_DAYS if older_than_days is None else older_than_days
+    cutoff = timezone.now() - timedelta(days=days)
+    limiter = RateLimiter(settings.TIER_IO_RATE if rate is None else rate)
+    stats = {'scanned': 0, 'moved': 0, 'moved_bytes': 0}
+    for a in cold_candidates(min_bytes, space).iterator(chunk_size=500):
+        if limit is not None and stats['moved'] >= limit: break
+        stats['scanned'] += 1
+        if dry_run:
+            try:
+                st = hot_path(a).stat()
+            except FileNotFoundError:
+                continue
+            if last_access(a, st) < cutoff:
+                stats['moved'] += 1; stats['moved_bytes'] += a.size
+                if log: log(f"would move {a}")
+            continue
+        if demote(a, cutoff, limiter):
+            stats['moved'] += 1; stats['moved_bytes'] += a.size
+            if log: log(f"moved {a}")
+    return stats
@@ -1,9 +1,14 @@
 from django.urls import path
 from core.views import api_upload, api_assets, api_allowed_extensions, api_zip, api_browse, \
-    api_mkdir, api_rename, api_delete, api_delete_batch, api_space_set, api_spaces, api_rmdir, api_folder_move
+    api_mkdir, api_rename, api_delete, api_delete_batch, api_space_set, api_spaces, api_rmdir, api_folder_move, cdn_origin, \
+    api_changes, api_manifest_diff, api_releases, api_release_upload, api_release_remove, \
+    api_release_promote, api_release_rollback, api_tokens, api_token_revoke, \
+    api_jobs, api_job, api_job_cancel, api_job_download, api_cache_policies, api_cache_policy_delete, \
+    api_bootstrap
 
 urlpatterns = [
 
+    path('bootstrap', api_bootstrap, name='api_bootstrap'),
     path('spaces', api_spaces, name='api_spaces'),
     path('space/set', api_space_set, name='api_space_set'),
 
@@ -17,7 +22,33 @@ urlpatterns = [
     path('api/mkdir', api_mkdir, name='api_mkdir'),
     path('api/rmdir', api_rmdir, name='api_rmdir'),
     path('api/folder/move', api_folder_move, name='api_folder_move'),
+    # the paths dashboard.js calls
+    path('mkdir', api_mkdir),
+    path('rmdir', api_rmdir),
+    path('folder/move', api_folder_move),
     path('rename', api_rename, name='api_rename'),
     path('delete', api_delete, name='api_delete'),
     path('delete-batch', api_delete_batch, name='api_delete_batch'),
+
+    path('changes', api_changes, name='api_changes'),
+    path('manifest/diff', api_manifest_diff, name='api_manifest_diff'),
+
+    path('releases', api_releases, name='api_releases'),
+    path('releases/rollback', api_release_rollback, name='api_release_rollback'),
+    path('releases/<int:rid>/upload', api_release_upload, name='api_release_upload'),
+    path('releases/<int:rid>/remove', api_release_remove, name='api_release_remove'),
+    path('releases/<int:rid>/promote', api_release_promote, name='api_release_promote'),
+
+    path('jobs', api_jobs, name='api_jobs'),
+    path('jobs/<int:jid>', api_job, name='api_job'),
+    path('jobs/<int:jid>/cancel', api_job_cancel, name='api_job_cancel'),
+    path('jobs/<int:jid>/download', api_job_download, name='api_job_download'),
+
+    path('cache-policies', api_cache_policies, name='api_cache_policies'),
+    path('cache-policies/<int:pid>/delete', api_cache_policy_delete, name='api_cache_policy_delete'),
+
+    path('tokens', api_tokens, name='api_tokens'),
+    path('tokens/<int:tid>/revoke', api_token_revoke, name='api_token_revoke'),
+
+    path('origin/<path:path>', cdn_origin, name='cdn_origin'),
 ]
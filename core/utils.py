@@ -1,4 +1,4 @@
-import os, mimetypes, re
+import os, mimetypes, re, hashlib
 from pathlib import Path
 from django.conf import settings
 from django.db.models import F
@@ -32,6 +32,13 @@ def safe_folder_name(name: str) -> str:
     if SAFE_NAME_RE.search(name): raise ValueError('invalid folder name')
     return name[:64]
 
+def space_from_ref(ref: str) -> Space | None:
+    """Resolve a space from '<id>' or '<name_spase>/<slug>' (management commands)."""
+    if ref.isdigit():
+        return Space.objects.select_related('owner').filter(id=int(ref)).first()
+    ns, _, slug = ref.partition('/')
+    return Space.objects.select_related('owner').filter(owner__name_spase=ns, slug=slug or 'default').first()
+
 def ns_base(space: Space) -> Path:
     """Base directory for a user's space:
        CDN_ROOT/<name_spase>/<space.slug>/"""
@@ -45,6 +52,13 @@ def fs_space_root(space) -> Path:
     # Adjust to your layout; earlier you used settings.CDN_ROOT/<user>/<space>
     return Path(settings.CDN_ROOT) / space.owner.name_spase / space.slug
 
+def within_space(space: Space, p: Path) -> bool:
+    """Does p (symlinks resolved) stay inside the space? Promoted release sites are symlinks
+    into CDN_RELEASES_ROOT/<name_spase>/<slug>/, which counts as inside."""
+    real = p.resolve()
+    roots = (fs_space_root(space), Path(settings.CDN_RELEASES_ROOT) / space.owner.name_spase / space.slug)
+    return any(real.is_relative_to(r.resolve()) for r in roots)
+
 def fs_base(space: Space, rel_path: str = '') -> Path:
     base = ns_base(space)
     if rel_path:
@@ -67,6 +81,27 @@ def ensure_unique(p: Path) -> Path:
         if not cand.exists(): return cand
         i += 1
 
+def write_chunks(chunks, path: Path) -> tuple[int, str]:
+    """Write chunks to path via a .part file + os.replace; returns (size, sha256)."""
+    tmp = path.with_suffix(path.suffix + ".part")
+    digest = hashlib.sha256()
+    size = 0
+    with tmp.open('wb') as dst:
+        for chunk in chunks:
+            digest.update(chunk)
+            dst.write(chunk)
+            size += len(chunk)
+    os.replace(tmp, path)
+    return size, digest.hexdigest()
+
+def sha256_file(p: Path, chunk: int = 1024 * 1024) -> str:
+    """Hex SHA-256 of a file, streamed."""
+    h = hashlib.sha256()
+    with p.open('rb') as f:
+        for block in iter(lambda: f.read(chunk), b''):
+            h.update(block)
+    return h.hexdigest()
+
 def guess_mime(name: str, sample_bytes: bytes | None = None) -> str:
     """Best‑effort MIME detection using python‑magic if available; fallback to mimetypes."""
     if getattr(settings, 'MAGIC_AVAILABLE', False) and sample_bytes:
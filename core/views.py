@@ -1,23 +1,32 @@
 from __future__ import annotations
-import io, os, json, zipfile, shutil
-from django.db import transaction
-from django.db.models import Q, F
+import os, json, hashlib, tempfile
+from datetime import timedelta
+from django.db import IntegrityError, transaction
+from django.db.models import Q, F, Sum
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
-from django.http import JsonResponse, HttpResponseBadRequest, StreamingHttpResponse, HttpResponse
+from django.http import JsonResponse, HttpResponseBadRequest, HttpResponse, FileResponse
 from django.shortcuts import render
-from django.views.decorators.csrf import csrf_exempt
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.views.decorators.csrf import ensure_csrf_cookie
 from django.views.decorators.http import require_GET, require_POST, require_http_methods
 
-from .models import AllowedExtension, Space, Asset
+from .models import AllowedExtension, Space, Asset, AssetChange, Release, ApiToken, Job, CachePolicy
+from . import tiering, imageopt, changes, releases, auth, fileops, jobs, cachepolicy
+from .auth import token_scope
 from .utils import (
     safe_filename, extract_extension, sanitize_rel_path, safe_folder_name,
-    build_storage_path, ensure_unique, guess_mime, fs_base, fs_space_root
+    build_storage_path, ensure_unique, guess_mime, fs_base, fs_space_root, within_space, write_chunks
 )
 
 # ---------- helpers ----------
 
 def get_current_space(request) -> Space | None:
+    # API tokens are bound to one space; never touch the session for them
+    tok = getattr(request, 'api_token', None)
+    if tok is not None:
+        return tok.space
     sid = request.session.get("space_id")
     if not request.user.is_authenticated:
         return None
@@ -37,29 +46,51 @@ def get_current_space(request) -> Space | None:
     return sp
 
 @login_required
+@ensure_csrf_cookie
 def dashboard(request):
     """Dashboard with upload form + folder browser."""
     return render(request, 'core/dashboard.html', {'space': get_current_space(request)})
 
+def _item_pairs(items) -> list[tuple[str, str]]:
+    """[{rel_path, name}] from a request body -> sanitized (rel_path, name) pairs."""
+    return [(sanitize_rel_path(it.get('rel_path') or ''), safe_filename(it.get('name') or ''))
+            for it in (items or [])]
+
+def _job_json(job: Job) -> dict:
+    return {
+        'id': job.id, 'kind': job.kind, 'state': job.state, 'progress': job.progress, 'total': job.total,
+        'result': job.result, 'error': job.error, 'attempts': job.attempts,
+        'created_at': job.created_at.isoformat(), 'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+    }
+
+def _job_accepted(job: Job) -> JsonResponse:
+    resp = JsonResponse({'ok': True, 'job': _job_json(job)}, status=202)
+    resp['Location'] = f"/api/jobs/{job.id}"
+    return resp
+
 # ---------- spaces: list + switch ----------
 
-@login_required
-@require_GET
-@csrf_exempt
-def api_spaces(request):
-    spaces = Space.objects.filter(owner=request.user).order_by('-is_default','name')
-    space = get_current_space(request)
-    items = [{
+def _space_items(request, space: Space | None) -> list[dict]:
+    qs = Space.objects.filter(owner=request.user)
+    if getattr(request, 'api_token', None) is not None:
+        qs = qs.filter(id=request.api_token.space.id)  # a token only sees the space it is bound to
+    return [{
         'id': s.id, 'name': s.name, 'slug': s.slug, 'is_default': s.is_default,
         'max_bytes': int(s.max_bytes), 'max_files': int(s.max_files),
         'used_bytes': int(s.used_bytes), 'file_count': int(s.file_count),
+        'optimized_saved_bytes': int(s.optimized_saved_bytes),
         'current': (space and s.id == space.id),
-    } for s in spaces]
-    return JsonResponse({'ok': True, 'items': items})
+    } for s in qs.order_by('-is_default','name')]
+
+@login_required
+@require_GET
+@token_scope('read')
+def api_spaces(request):
+    return JsonResponse({'ok': True, 'items': _space_items(request, get_current_space(request))})
 
 @login_required
 @require_POST
-@csrf_exempt
+@token_scope(None)
 def api_space_set(request):
     data = json.loads(request.body.decode('utf-8'))
     sid = data.get('space_id')
@@ -70,68 +101,123 @@ def api_space_set(request):
 
 # ---------- browse/list ----------
 
-@login_required
-@require_GET
-@csrf_exempt
-def api_browse(request):
-    space = get_current_space(request)
-    if not space: return JsonResponse({'ok': False, 'error': 'no space'}, status=400)
-    rel = sanitize_rel_path(request.GET.get('rel_path') or '')
+def _listing_etag(request, space: Space, *key: str) -> str:
+    """Weak ETag of a listing: changes whenever anything in the space does (Space.change_seq)."""
+    seq = space.change_seq
+    if getattr(request, 'api_token', None) is not None:
+        # the token's space comes from the auth cache; read the live counter
+        seq = Space.objects.filter(id=space.id).values_list('change_seq', flat=True).first() or 0
+    digest = hashlib.md5('\0'.join(key).encode('utf-8')).hexdigest()[:12]
+    return f'W/"{space.id}-{seq}-{digest}"'
+
+def _not_modified(request, etag: str):
+    """304 for a matching If-None-Match, before any listing query runs."""
+    resp = get_conditional_response(request, etag=etag)
+    if resp is not None:
+        resp['ETag'] = etag
+        resp['Cache-Control'] = 'private, no-cache'
+    return resp
+
+def _with_etag(resp: JsonResponse, etag: str) -> JsonResponse:
+    resp['ETag'] = etag
+    resp['Cache-Control'] = 'private, no-cache'  # always revalidate; 304s are cheap
+    return resp
 
+def _listing(space: Space, rel: str) -> dict:
     qs = Asset.objects.filter(space=space)
 
     # Folders (DB + FS to include empty ones)
     prefix = f"{rel}/" if rel else ''
     folders_db = set()
-    for p in qs.exclude(rel_path='').values_list('rel_path', flat=True):
-        if not p.startswith(prefix): continue
-        rest = p[len(prefix):]
-        if not rest: continue
-        if '/' in rest:
-            folders_db.add(rest.split('/',1)[0])
+    sub = qs.filter(rel_path__startswith=prefix).exclude(rel_path=rel)  # index prefix scan
+    for p in sub.order_by().values_list('rel_path', flat=True).distinct():
+        folders_db.add(p[len(prefix):].split('/',1)[0])
 
     folders_fs = set()
     try:
-        for entry in fs_base(space, rel).iterdir():
+        for entry in (fs_space_root(space) / rel).iterdir():
             if entry.is_dir(): folders_fs.add(entry.name)
     except FileNotFoundError:
         pass
 
     folders = sorted(folders_db | folders_fs)
 
-    files = [{
-        'name': a.original_name, 'size': a.size, 'mime': a.mime,
-        'url': a.public_url, 'created_at': a.created_at.isoformat(),
-    } for a in qs.filter(rel_path=rel)]
+    files = []
+    for a in qs.filter(rel_path=rel):
+        a.space = space  # public_url would load space + owner per row otherwise
+        files.append({
+            'name': a.original_name, 'size': a.size, 'mime': a.mime,
+            'url': a.public_url, 'created_at': a.created_at.isoformat(),
+        })
+    return {'path': rel, 'folders': folders, 'files': files}
 
-    return JsonResponse({'ok': True, 'path': rel, 'folders': folders, 'files': files})
+@login_required
+@require_GET
+@token_scope('read')
+def api_browse(request):
+    space = get_current_space(request)
+    if not space: return JsonResponse({'ok': False, 'error': 'no space'}, status=400)
+    rel = sanitize_rel_path(request.GET.get('rel_path') or '')
+    etag = _listing_etag(request, space, 'browse', rel)
+    if resp := _not_modified(request, etag): return resp
+    return _with_etag(JsonResponse({'ok': True, **_listing(space, rel)}), etag)
 
 @login_required
 @require_GET
-@csrf_exempt
+@token_scope('read')
 def api_assets(request):
     space = get_current_space(request)
     if not space: return JsonResponse({'ok': False, 'error': 'no space'}, status=400)
     q = request.GET.get('q')
+    etag = _listing_etag(request, space, 'assets', q or '')
+    if resp := _not_modified(request, etag): return resp
     qs = Asset.objects.filter(space=space)
     if q:
         qs = qs.filter(Q(original_name__icontains=q) | Q(rel_path__icontains=q) | Q(mime__icontains=q))
-    items = [{'original_name': a.original_name, 'size': a.size, 'mime': a.mime, 'url': a.public_url} for a in qs[:300]]
-    return JsonResponse({'ok': True, 'items': items})
+    items = []
+    for a in qs[:300]:
+        a.space = space
+        items.append({'original_name': a.original_name, 'rel_path': a.rel_path, 'size': a.size, 'mime': a.mime,
+                      'sha256': a.sha256, 'url': a.public_url})
+    return _with_etag(JsonResponse({'ok': True, 'items': items}), etag)
 
 # ---------- allowed extensions ----------
 
+def _allowed_exts() -> list[str]:
+    return [f".{e}" for e in AllowedExtension.objects.filter(enabled=True).order_by('ext').values_list('ext', flat=True)]
+
 @login_required
 @require_GET
-@csrf_exempt
+@token_scope('read')
 def api_allowed_extensions(request):
-    exts = AllowedExtension.objects.filter(enabled=True).order_by('ext')
-    return JsonResponse({'ok': True, 'items': [f".{e.ext}" for e in exts]})
+    return JsonResponse({'ok': True, 'items': _allowed_exts()})
+
+# ---------- dashboard bootstrap ----------
+
+@login_required
+@require_GET
+@token_scope('read')
+def api_bootstrap(request):
+    """
+    GET /api/bootstrap?rel_path=<path>
+    Everything the dashboard needs on load in one round trip: spaces, the extension
+    allowlist and the listing of rel_path (root by default) with the ETag that
+    /api/browse would send for it, so the client can revalidate it later.
+    """
+    space = get_current_space(request)
+    if not space: return JsonResponse({'ok': False, 'error': 'no space'}, status=400)
+    rel = sanitize_rel_path(request.GET.get('rel_path') or '')
+    return JsonResponse({
+        'ok': True,
+        'spaces': _space_items(request, space),
+        'allowed_extensions': _allowed_exts(),
+        'browse': {**_listing(space, rel), 'etag': _listing_etag(request, space, 'browse', rel)},
+    })
 
 # ---------- API: create folder ----------
-@csrf_exempt
 @login_required
 @require_POST
+@token_scope('upload')
 def api_mkdir(request):
     """
     POST /api/mkdir
@@ -152,28 +238,28 @@ def api_mkdir(request):
     parent = fs_base(space, rel)
     target = parent / name
 
-    # Ensure parent is inside space root
-    root = fs_space_root(space)
     try:
         parent.mkdir(parents=True, exist_ok=True)  # ensure parent exists
-        # Check traversal: target must start with root
-        if not str(target.resolve()).startswith(str(root.resolve())):
+        # Check traversal: target must stay inside the space (or a promoted release of it)
+        if not within_space(space, target):
             return JsonResponse({'ok': False, 'error': 'invalid path'}, status=400)
         if target.exists():
             return JsonResponse({'ok': False, 'error': 'folder exists'}, status=409)
         target.mkdir(exist_ok=False)
+        changes.record(space, AssetChange.OP_MKDIR, f"{rel}/{name}" if rel else name)
         return JsonResponse({'ok': True}, status=201)
     except Exception as e:
         return JsonResponse({'ok': False, 'error': str(e)}, status=500)
 
 # ---------- API: remove folder ----------
-@csrf_exempt
 @login_required
 @require_http_methods(["DELETE"])
+@token_scope('delete')
 def api_rmdir(request):
     """
-    DELETE /api/rmdir?rel_path=<folder/relative/path>&recursive=1
-    - If recursive=1: delete folder and all contents.
+    DELETE /api/rmdir?rel_path=<folder/relative/path>&recursive=1[&async=1]
+    - If recursive=1: delete folder and all contents (Asset rows and quota included).
+      Large folders (or async=1) are queued: 202 + job, poll /api/jobs/<id>.
     - Else: remove only if empty.
     """
     space = get_current_space(request)
@@ -187,18 +273,21 @@ def api_rmdir(request):
     if not rel:
         return JsonResponse({'ok': False, 'error': 'cannot delete space root'}, status=400)
 
-    target = fs_base(space, rel)
     root = fs_space_root(space)
+    target = root / rel
     try:
         if not target.exists():
             return JsonResponse({'ok': False, 'error': 'not found'}, status=404)
-        if not str(target.resolve()).startswith(str(root.resolve())):
+        if not within_space(space, target):
             return JsonResponse({'ok': False, 'error': 'invalid path'}, status=400)
 
         if recursive:
-            shutil.rmtree(target)
-        else:
-            target.rmdir()  # raises OSError if not empty
+            files, nbytes = fileops.folder_stats(space, rel)
+            if jobs.should_defer(files, nbytes) or request.GET.get('async') == '1':
+                return _job_accepted(jobs.enqueue(space, Job.KIND_RMDIR, {'rel_path': rel}, total=files))
+            return JsonResponse({'ok': True, **fileops.rmdir(space, rel)})
+        target.rmdir()  # raises OSError if not empty
+        changes.record(space, AssetChange.OP_RMDIR, rel)
         return JsonResponse({'ok': True})
     except OSError as e:
         # not empty / permission etc.
@@ -207,16 +296,17 @@ def api_rmdir(request):
         return JsonResponse({'ok': False, 'error': str(e)}, status=500)
 
 # ---------- API: move/rename folder ----------
-@csrf_exempt
 @login_required
 @require_POST
+@token_scope('upload')
 def api_folder_move(request):
     """
     POST /api/folder/move
     Body JSON: {
       "old_rel_path": "<parent/rel>", "name": "<oldFolder>",
-      "new_rel_path": "<new/parent/rel>", "new_name": "<newFolderName>"
+      "new_rel_path": "<new/parent/rel>", "new_name": "<newFolderName>", "async": false
     }
+    Large folders (or async=true) are queued: 202 + job, poll /api/jobs/<id>.
     """
     space = get_current_space(request)
     if not space:
@@ -238,11 +328,11 @@ def api_folder_move(request):
     try:
         src_res = src.resolve()
         dst_res = dst.resolve()
-        if not str(src_res).startswith(str(fs_space_root(space).resolve())):
+        if not within_space(space, src):
             return JsonResponse({'ok': False, 'error': 'invalid src'}, status=400)
-        if not str(dst_res).startswith(str(fs_space_root(space).resolve())):
+        if not within_space(space, dst):
             return JsonResponse({'ok': False, 'error': 'invalid dst'}, status=400)
-        if str(dst_res).startswith(str(src_res) + os.sep):
+        if dst.is_relative_to(src) or str(dst_res).startswith(str(src_res) + os.sep):
             return JsonResponse({'ok': False, 'error': 'cannot move into itself'}, status=400)
 
         if not src.exists():
@@ -250,16 +340,21 @@ def api_folder_move(request):
         if dst.exists():
             return JsonResponse({'ok': False, 'error': 'dst exists'}, status=409)
 
-        dst.parent.mkdir(parents=True, exist_ok=True)
-        shutil.move(str(src), str(dst))
-        return JsonResponse({'ok': True})
+        src_rel = f"{old_rel}/{old_name}" if old_rel else old_name
+        dst_rel = f"{new_rel}/{new_name}" if new_rel else new_name
+        files, _ = fileops.folder_stats(space, src_rel)
+        if jobs.should_defer(files) or data.get('async'):
+            return _job_accepted(jobs.enqueue(space, Job.KIND_FOLDER_MOVE, {'src': src_rel, 'dst': dst_rel}, total=files))
+        return JsonResponse({'ok': True, **fileops.move_folder(space, src_rel, dst_rel)})
+    except fileops.FileOpError as e:
+        return JsonResponse({'ok': False, 'error': str(e)}, status=409)
     except Exception as e:
         return JsonResponse({'ok': False, 'error': str(e)}, status=500)
 
 
 @login_required
 @require_POST
-@csrf_exempt
+@token_scope('upload')
 def api_rename(request):
     space = get_current_space(request)
     if not space: return JsonResponse({'ok': False, 'error': 'no space'}, status=400)
@@ -273,21 +368,30 @@ def api_rename(request):
         a = Asset.objects.get(space=space, rel_path=old_rel, original_name=old_name)
     except Asset.DoesNotExist:
         return JsonResponse({'ok': False, 'error': 'not found'}, status=404)
+    # the target may be a cold row with nothing on hot disk to collide with
+    if Asset.objects.filter(space=space, rel_path=new_rel, original_name=new_name).exclude(id=a.id).exists():
+        return JsonResponse({'ok': False, 'error': 'target exists'}, status=409)
 
+    tiering.ensure_hot(a)
     old_p = build_storage_path(space, old_rel, old_name)
     if not old_p.exists(): return JsonResponse({'ok': False, 'error': 'missing on disk'}, status=404)
     new_p = build_storage_path(space, new_rel, new_name)
     if new_p.exists(): return JsonResponse({'ok': False, 'error': 'target exists'}, status=409)
     new_p.parent.mkdir(parents=True, exist_ok=True)
     os.replace(old_p, new_p)
-    a.rel_path, a.original_name = new_rel, new_name
-    a.save(update_fields=['rel_path', 'original_name'])
+    for ov, nv in zip(imageopt.derivative_paths(old_p), imageopt.derivative_paths(new_p)):
+        if ov.exists(): os.replace(ov, nv)
+    with transaction.atomic():
+        a.rel_path, a.original_name = new_rel, new_name
+        a.save(update_fields=['rel_path', 'original_name'])
+        changes.record(space, AssetChange.OP_RENAME, old_rel, old_name,
+                       new_rel_path=new_rel, new_name=new_name, size=a.size, sha256=a.sha256)
     return JsonResponse({'ok': True})
 
 
 @login_required
 @require_POST
-@csrf_exempt
+@token_scope('delete')
 def api_delete(request):
     space = get_current_space(request)
     if not space: return JsonResponse({'ok': False, 'error': 'no space'}, status=400)
@@ -302,64 +406,54 @@ def api_delete(request):
     p = build_storage_path(space, rel, name)
     try:
         if p.exists(): p.unlink()
+        tiering.discard_cold(a)
+        for v in imageopt.derivative_paths(p): v.unlink(missing_ok=True)
     except Exception:
         return JsonResponse({'ok': False, 'error': 'fs delete failed'}, status=500)
     # accounting
-    Space.objects.filter(id=space.id).update(
-        used_bytes=F('used_bytes') - a.size,
-        file_count=F('file_count') - 1
-    )
-    a.delete()
+    with transaction.atomic():
+        if Asset.objects.filter(id=a.id).delete()[0]:  # not already removed by the watcher
+            Space.objects.filter(id=space.id).update(
+                used_bytes=F('used_bytes') - a.size,
+                file_count=F('file_count') - 1
+            )
+            changes.record(space, AssetChange.OP_DELETE, rel, name)
     return JsonResponse({'ok': True})
 
 # ---------- batch delete ----------
 
 @login_required
 @require_POST
-@csrf_exempt
+@token_scope('delete')
 def api_delete_batch(request):
+    """
+    POST /api/delete-batch  Body JSON: { "items": [{"rel_path": "", "name": ""}, ...], "async": false }
+    Large batches (or async=true) are queued: 202 + job, poll /api/jobs/<id>.
+    """
     space = get_current_space(request)
     if not space: return JsonResponse({'ok': False, 'error': 'no space'}, status=400)
     data = json.loads(request.body.decode('utf-8'))
-    items = data.get('items') or []  # [{rel_path, name}]
-    ok = 0; err = 0
-    total_released = 0
-    for it in items:
-        rel = sanitize_rel_path(it.get('rel_path') or '')
-        name = safe_filename(it.get('name') or '')
-        try:
-            a = Asset.objects.get(space=space, rel_path=rel, original_name=name)
-        except Asset.DoesNotExist:
-            err += 1; continue
-        p = build_storage_path(space, rel, name)
-        try:
-            if p.exists(): p.unlink()
-            total_released += a.size
-            a.delete()
-            ok += 1
-        except Exception:
-            err += 1
-    if ok:
-        Space.objects.filter(id=space.id).update(
-            used_bytes=F('used_bytes') - total_released,
-            file_count=F('file_count') - ok
-        )
-    return JsonResponse({'ok': True, 'deleted': ok, 'failed': err})
+    items = _item_pairs(data.get('items'))
+    if jobs.should_defer(len(items)) or data.get('async'):
+        return _job_accepted(jobs.enqueue(space, Job.KIND_DELETE_BATCH, {'items': items}, total=len(items)))
+    return JsonResponse({'ok': True, **fileops.delete_batch(space, items)})
 
 # ---------- upload with quotas ----------
 
 @login_required
-@csrf_exempt
 @require_POST
+@token_scope('upload')
 def api_upload(request):
     """
-    POST /api/upload?bucket=assets&rel_path=a/b
+    POST /api/upload?bucket=assets&rel_path=a/b[&overwrite=1]
     multipart: file=@...
     Enforces per-space quotas: max_bytes, max_files
+    overwrite=1 replaces an existing file of the same name instead of adding "name (1).ext".
     """
     space = get_current_space(request)
     if not space: return JsonResponse({'ok': False, 'error': 'no space'}, status=400)
     rel = sanitize_rel_path(request.GET.get('rel_path') or '')
+    overwrite = (request.GET.get('overwrite') == '1')
     if 'file' not in request.FILES: return HttpResponseBadRequest('file required')
     f = request.FILES['file']
 
@@ -368,36 +462,58 @@ def api_upload(request):
     if not AllowedExtension.objects.filter(ext=ext, enabled=True).exists():
         return JsonResponse({'ok': False, 'error': f'extension .{ext} not allowed'}, status=415)
 
+    if request.api_token: space.refresh_from_db(fields=['used_bytes', 'file_count', 'max_bytes', 'max_files'])
+    safe_name = safe_filename(f.name)
+    existing = Asset.objects.filter(space=space, rel_path=rel, original_name=safe_name).first()
+    replacing = overwrite and existing is not None
+
     # quotas: check against current totals (race-safe enough for single-node)
-    if space.file_count + 1 > space.max_files:
+    if not replacing and space.file_count + 1 > space.max_files:
         return JsonResponse({'ok': False, 'error': 'file limit exceeded'}, status=403)
-    if space.used_bytes + f.size > space.max_bytes:
+    if space.used_bytes + f.size - (existing.size if replacing else 0) > space.max_bytes:
         return JsonResponse({'ok': False, 'error': 'space out of quota'}, status=403)
 
-    safe_name = safe_filename(f.name)
     head = f.read(min(8192, f.size)); f.seek(0)
     mime = guess_mime(safe_name, head)
 
     path = build_storage_path(space, rel, safe_name)
-    path = ensure_unique(path)
+    if replacing:
+        tiering.discard_cold(existing)
+        for v in imageopt.derivative_paths(path): v.unlink(missing_ok=True)
+    else:
+        # a cold-tier namesake is not on disk; bring it back so ensure_unique sees it
+        if existing and existing.tier == Asset.TIER_COLD: tiering.ensure_hot(existing)
+        path = ensure_unique(path)
 
-    tmp = path.with_suffix(path.suffix + ".part")
-    with tmp.open('wb') as dst:
-        for chunk in f.chunks():
-            dst.write(chunk)
-    os.replace(tmp, path)
-    size = path.stat().st_size
+    size, digest = write_chunks(f.chunks(), path)
 
-    # create asset + update accounting atomically
+    # create/replace asset + update accounting atomically
     with transaction.atomic():
-        a = Asset.objects.create(
-            space=space, rel_path=rel, original_name=path.name,
-            size=size, mime=mime, is_public=True
-        )
-        Space.objects.filter(id=space.id).update(
-            used_bytes=F('used_bytes') + size,
-            file_count=F('file_count') + 1
-        )
+        if not replacing:
+            try:
+                with transaction.atomic():
+                    a = Asset.objects.create(
+                        space=space, rel_path=rel, original_name=path.name,
+                        size=size, mime=mime, is_public=True, sha256=digest, source_sha256=digest
+                    )
+                Space.objects.filter(id=space.id).update(
+                    used_bytes=F('used_bytes') + size,
+                    file_count=F('file_count') + 1
+                )
+            except IntegrityError:
+                # the watcher indexed the file (and counted it) after os.replace: take over its row
+                existing = Asset.objects.select_for_update().get(space=space, rel_path=rel, original_name=path.name)
+                replacing = True
+        if replacing:
+            a = existing
+            delta = size - a.size
+            a.size, a.mime, a.sha256, a.source_sha256 = size, mime, digest, digest
+            a.tier, a.cold_codec, a.optimized_sha256 = Asset.TIER_HOT, '', ''
+            a.save(update_fields=['size', 'mime', 'sha256', 'source_sha256', 'tier', 'cold_codec', 'optimized_sha256'])
+            Space.objects.filter(id=space.id).update(used_bytes=F('used_bytes') + delta)
+        changes.record(space, AssetChange.OP_UPDATE if replacing else AssetChange.OP_UPLOAD,
+                       rel, a.original_name, size=size, sha256=a.sha256)
+        transaction.on_commit(lambda: imageopt.submit(a))
 
     return JsonResponse({'ok': True, 'url': a.public_url, 'name': a.original_name, 'size': a.size, 'mime': a.mime})
 
@@ -405,31 +521,361 @@ def api_upload(request):
 
 @login_required
 @require_POST
-@csrf_exempt
+@token_scope('read')
 def api_zip(request):
+    """
+    POST /api/zip  Body JSON: { "items": [{"rel_path": "", "name": ""}, ...], "async": false }
+    Small selections stream back directly; large ones (or async=true) are queued:
+    202 + job, then GET /api/jobs/<id>/download once it is done.
+    """
     space = get_current_space(request)
     if not space: return JsonResponse({'ok': False, 'error': 'no space'}, status=400)
     data = json.loads(request.body.decode('utf-8'))
-    items = data.get('items') or []  # [{rel_path, name}]
+    items = _item_pairs(data.get('items'))
     if not items: return JsonResponse({'ok': False, 'error': 'no items'}, status=400)
 
-    def stream():
-        bio = io.BytesIO()
-        with zipfile.ZipFile(bio, 'w', compression=zipfile.ZIP_DEFLATED) as z:
-            for it in items:
-                rel = sanitize_rel_path(it.get('rel_path') or '')
-                name = safe_filename(it.get('name') or '')
-                try:
-                    a = Asset.objects.get(space=space, rel_path=rel, original_name=name)
-                except Asset.DoesNotExist:
-                    continue
-                p = build_storage_path(space, rel, name)
-                if p.exists():
-                    arcname = f"{rel+'/'+name if rel else name}"
-                    z.write(p, arcname=arcname)
-        bio.seek(0)
-        yield from bio
-
-    resp = StreamingHttpResponse(stream(), content_type='application/zip')
-    resp['Content-Disposition'] = 'attachment; filename="download.zip"'
+    nbytes = fileops.items_query(space, items).aggregate(b=Sum('size'))['b'] or 0
+    if jobs.should_defer(len(items), nbytes) or data.get('async'):
+        return _job_accepted(jobs.enqueue(space, Job.KIND_ZIP, {'items': items}, total=len(items)))
+    out = tempfile.TemporaryFile()  # spooled to disk, not memory
+    fileops.write_zip(space, items, out)
+    out.seek(0)
+    return FileResponse(out, as_attachment=True, filename='download.zip', content_type='application/zip')
+
+# ---------- delta sync: change feed + manifest diff ----------
+
+@login_required
+@require_GET
+@token_scope('read')
+def api_changes(request):
+    """
+    GET /api/changes?since=<cursor>&limit=1000
+    Mutations after `since` (0 = from the beginning), oldest first. Keep the returned
+    `cursor` and pass it as `since` next time; `more` means call again right away.
+    """
+    space = get_current_space(request)
+    if not space: return JsonResponse({'ok': False, 'error': 'no space'}, status=400)
+    try:
+        since = int(request.GET.get('since') or 0)
+        limit = int(request.GET.get('limit') or 1000)
+    except ValueError:
+        return JsonResponse({'ok': False, 'error': 'bad request'}, status=400)
+    items, cursor, more = changes.feed(space, since, limit)
+    return JsonResponse({'ok': True, 'items': items, 'cursor': cursor, 'more': more})
+
+@login_required
+@require_POST
+@token_scope('read')
+def api_manifest_diff(request):
+    """
+    POST /api/manifest/diff
+    Body JSON: { "rel_path": "<optional prefix>", "files": { "<path>": {"sha256": "...", "size": 123} } }
+    Returns paths to upload (missing/changed) and stale server paths to delete, relative
+    to rel_path, plus the change-feed cursor to continue from.
+    """
+    space = get_current_space(request)
+    if not space: return JsonResponse({'ok': False, 'error': 'no space'}, status=400)
+    try:
+        data = json.loads(request.body.decode('utf-8') or "{}")
+        prefix = sanitize_rel_path(data.get('rel_path') or '')
+        files = data.get('files') or {}
+        if not isinstance(files, dict): raise ValueError('files must be an object')
+    except Exception:
+        return JsonResponse({'ok': False, 'error': 'bad request'}, status=400)
+    if (key := changes.bad_manifest_entry(files)) is not None:
+        return JsonResponse({'ok': False, 'error': 'invalid manifest entry', 'key': key}, status=400)
+    cursor = changes.current_cursor(space)
+    diff = changes.manifest_diff(space, files, prefix)
+    return JsonResponse({'ok': True, 'cursor': cursor, **diff})
+
+# ---------- releases: staged deploys + atomic promote/rollback ----------
+
+def _release_json(r: Release) -> dict:
+    return {
+        'id': r.id, 'site': r.site, 'label': r.label, 'state': r.state,
+        'file_count': r.file_count, 'total_bytes': r.total_bytes,
+        'created_at': r.created_at.isoformat(), 'promoted_at': r.promoted_at.isoformat() if r.promoted_at else None,
+    }
+
+def _get_release(space, rid) -> Release | None:
+    return Release.objects.select_related('space__owner').filter(space=space, id=rid).first()
+
+@login_required
+@require_http_methods(["GET", "POST"])
+@token_scope('read', POST='upload')
+def api_releases(request):
+    """
+    GET  /api/releases?site=<rel_path>  -> releases of a site (newest first)
+    POST /api/releases  Body JSON: { "site": "<rel_path>", "label": "v1.2", "clone": true }
+         Creates a staging release; clone=true starts from the live release's files.
+    """
+    space = get_current_space(request)
+    if not space: return JsonResponse({'ok': False, 'error': 'no space'}, status=400)
+    if request.method == 'GET':
+        site = sanitize_rel_path(request.GET.get('site') or '')
+        qs = Release.objects.filter(space=space)
+        if site: qs = qs.filter(site=site)
+        return JsonResponse({'ok': True, 'items': [_release_json(r) for r in qs[:100]]})
+    try:
+        data = json.loads(request.body.decode('utf-8') or "{}")
+        site = sanitize_rel_path(data.get('site') or '')
+        label = str(data.get('label') or '')[:64]
+    except Exception:
+        return JsonResponse({'ok': False, 'error': 'bad request'}, status=400)
+    if not site: return JsonResponse({'ok': False, 'error': 'site required'}, status=400)
+    r = releases.create(space, site, label, clone=bool(data.get('clone')))
+    return JsonResponse({'ok': True, 'release': _release_json(r)}, status=201)
+
+@login_required
+@require_POST
+@token_scope('upload')
+def api_release_upload(request, rid: int):
+    """
+    POST /api/releases/<id>/upload?rel_path=a/b
+    multipart: file=@...   (replaces a staged file of the same name)
+    """
+    space = get_current_space(request)
+    if not space: return JsonResponse({'ok': False, 'error': 'no space'}, status=400)
+    r = _get_release(space, rid)
+    if not r: return JsonResponse({'ok': False, 'error': 'not found'}, status=404)
+    rel = sanitize_rel_path(request.GET.get('rel_path') or '')
+    if 'file' not in request.FILES: return HttpResponseBadRequest('file required')
+    f = request.FILES['file']
+    ext = extract_extension(f.name)
+    if not AllowedExtension.objects.filter(ext=ext, enabled=True).exists():
+        return JsonResponse({'ok': False, 'error': f'extension .{ext} not allowed'}, status=415)
+    if request.api_token: space.refresh_from_db(fields=['used_bytes', 'max_bytes'])
+    if space.used_bytes + r.total_bytes + f.size > space.max_bytes:
+        return JsonResponse({'ok': False, 'error': 'space out of quota'}, status=403)
+    name = safe_filename(f.name)
+    head = f.read(min(8192, f.size)); f.seek(0)
+    try:
+        rf = releases.add_file(r, rel, name, f.chunks(), guess_mime(name, head))
+    except releases.ReleaseError as e:
+        return JsonResponse({'ok': False, 'error': str(e)}, status=409)
+    return JsonResponse({'ok': True, 'name': rf.original_name, 'size': rf.size, 'sha256': rf.sha256})
+
+@login_required
+@require_POST
+@token_scope('upload')
+def api_release_remove(request, rid: int):
+    """POST /api/releases/<id>/remove  Body JSON: { "paths": ["a/b/x.js", ...] }"""
+    space = get_current_space(request)
+    if not space: return JsonResponse({'ok': False, 'error': 'no space'}, status=400)
+    r = _get_release(space, rid)
+    if not r: return JsonResponse({'ok': False, 'error': 'not found'}, status=404)
+    try:
+        data = json.loads(request.body.decode('utf-8') or "{}")
+        paths = []
+        for p in data.get('paths') or []:
+            rel, name = changes.split_path(p)
+            paths.append((sanitize_rel_path(rel), safe_filename(name)))
+        n = releases.remove_files(r, paths)
+    except releases.ReleaseError as e:
+        return JsonResponse({'ok': False, 'error': str(e)}, status=409)
+    except Exception:
+        return JsonResponse({'ok': False, 'error': 'bad request'}, status=400)
+    return JsonResponse({'ok': True, 'removed': n})
+
+@login_required
+@require_POST
+@token_scope('upload')
+def api_release_promote(request, rid: int):
+    """POST /api/releases/<id>/promote -> atomically switch the site to this release."""
+    space = get_current_space(request)
+    if not space: return JsonResponse({'ok': False, 'error': 'no space'}, status=400)
+    r = _get_release(space, rid)
+    if not r: return JsonResponse({'ok': False, 'error': 'not found'}, status=404)
+    try:
+        r = releases.promote(r)
+    except (releases.ReleaseError, OSError) as e:
+        return JsonResponse({'ok': False, 'error': str(e)}, status=409)
+    return JsonResponse({'ok': True, 'release': _release_json(r)})
+
+@login_required
+@require_POST
+@token_scope('upload')
+def api_release_rollback(request):
+    """POST /api/releases/rollback  Body JSON: { "site": "<rel_path>", "steps": 1 }"""
+    space = get_current_space(request)
+    if not space: return JsonResponse({'ok': False, 'error': 'no space'}, status=400)
+    try:
+        data = json.loads(request.body.decode('utf-8') or "{}")
+        site = sanitize_rel_path(data.get('site') or '')
+        steps = int(data.get('steps') or 1)
+    except Exception:
+        return JsonResponse({'ok': False, 'error': 'bad request'}, status=400)
+    try:
+        r = releases.rollback(space, site, steps)
+    except (releases.ReleaseError, OSError) as e:
+        return JsonResponse({'ok': False, 'error': str(e)}, status=409)
+    return JsonResponse({'ok': True, 'release': _release_json(r)})
+
+# ---------- background jobs: status / cancel / download ----------
+
+@login_required
+@require_GET
+@token_scope('read')
+def api_jobs(request):
+    """GET /api/jobs[?state=running]  -> recent jobs of the current space"""
+    space = get_current_space(request)
+    if not space: return JsonResponse({'ok': False, 'error': 'no space'}, status=400)
+    qs = Job.objects.filter(space=space)
+    if request.GET.get('state'): qs = qs.filter(state=request.GET['state'])
+    return JsonResponse({'ok': True, 'items': [_job_json(j) for j in qs[:50]]})
+
+@login_required
+@require_GET
+@token_scope('read')
+def api_job(request, jid: int):
+    """GET /api/jobs/<id>  -> state + progress (polled by the dashboard)"""
+    space = get_current_space(request)
+    job = Job.objects.filter(space=space, id=jid).first() if space else None
+    if not job: return JsonResponse({'ok': False, 'error': 'not found'}, status=404)
+    return JsonResponse({'ok': True, 'job': _job_json(job)})
+
+@login_required
+@require_POST
+@token_scope('read')
+def api_job_cancel(request, jid: int):
+    """POST /api/jobs/<id>/cancel"""
+    space = get_current_space(request)
+    job = Job.objects.filter(space=space, id=jid).first() if space else None
+    if not job: return JsonResponse({'ok': False, 'error': 'not found'}, status=404)
+    need = jobs.KIND_SCOPES[job.kind]
+    if request.api_token and need not in request.api_token.scopes:
+        return JsonResponse({'ok': False, 'error': f'token lacks {need} scope'}, status=403)
+    return JsonResponse({'ok': True, 'job': _job_json(jobs.cancel(job))})
+
+@login_required
+@require_GET
+@token_scope('read')
+def api_job_download(request, jid: int):
+    """GET /api/jobs/<id>/download  -> zip produced by a finished zip job"""
+    space = get_current_space(request)
+    job = Job.objects.filter(space=space, id=jid, kind=Job.KIND_ZIP).first() if space else None
+    if not job: return JsonResponse({'ok': False, 'error': 'not found'}, status=404)
+    if job.state != Job.STATE_DONE: return JsonResponse({'ok': False, 'error': f'job is {job.state}'}, status=409)
+    p = jobs.artifact_path(job)
+    if not p.exists(): return JsonResponse({'ok': False, 'error': 'expired'}, status=410)
+    return FileResponse(p.open('rb'), as_attachment=True, filename='download.zip', content_type='application/zip')
+
+# ---------- cache policies (compiled into nginx maps) ----------
+
+def _policy_json(p: CachePolicy) -> dict:
+    return {
+        'id': p.id, 'prefix': p.prefix, 'max_age': p.max_age, 'immutable': p.immutable,
+        'stale_while_revalidate': p.stale_while_revalidate, 'cors_origins': p.cors_origins,
+        'cache_control': p.cache_control, 'updated_at': p.updated_at.isoformat(),
+    }
+
+@login_required
+@require_http_methods(["GET", "POST"])
+@token_scope('read', POST='upload')
+def api_cache_policies(request):
+    """
+    GET  /api/cache-policies  -> policies of the current space
+    POST /api/cache-policies  Body JSON: { "prefix": "data", "max_age": 60, "immutable": false,
+                                           "stale_while_revalidate": 300, "cors_origins": "https://a.example" }
+         Creates or replaces the policy of that prefix ("" = whole space); nginx is re-rendered in the background.
+    """
+    space = get_current_space(request)
+    if not space: return JsonResponse({'ok': False, 'error': 'no space'}, status=400)
+    if request.method == 'GET':
+        return JsonResponse({'ok': True, 'default': settings.CACHE_DEFAULT_CONTROL,
+                             'items': [_policy_json(p) for p in space.cache_policies.order_by('prefix')]})
+    try:
+        data = json.loads(request.body.decode('utf-8') or "{}")
+        prefix = sanitize_rel_path(data.get('prefix') or '')
+        fields = {
+            'max_age': max(0, int(data.get('max_age', 31536000))),
+            'immutable': bool(data.get('immutable', False)),
+            'stale_while_revalidate': max(0, int(data.get('stale_while_revalidate', 0))),
+            'cors_origins': cachepolicy.validate_origins(str(data.get('cors_origins', '*'))),
+        }
+    except Exception as e:
+        return JsonResponse({'ok': False, 'error': str(e) or 'bad request'}, status=400)
+    p, created = CachePolicy.objects.update_or_create(space=space, prefix=prefix, defaults=fields)
+    cachepolicy.render_async()
+    return JsonResponse({'ok': True, 'policy': _policy_json(p)}, status=201 if created else 200)
+
+@login_required
+@require_POST
+@token_scope('upload')
+def api_cache_policy_delete(request, pid: int):
+    """POST /api/cache-policies/<id>/delete"""
+    space = get_current_space(request)
+    if not space or not CachePolicy.objects.filter(space=space, id=pid).delete()[0]:
+        return JsonResponse({'ok': False, 'error': 'not found'}, status=404)
+    cachepolicy.render_async()
+    return JsonResponse({'ok': True})
+
+# ---------- API tokens (session only: a token cannot mint or revoke tokens) ----------
+
+def _token_json(t: ApiToken) -> dict:
+    return {
+        'id': t.id, 'name': t.name, 'key_id': t.key_id, 'scopes': sorted(t.scope_set), 'revoked': t.revoked,
+        'created_at': t.created_at.isoformat(), 'expires_at': t.expires_at.isoformat() if t.expires_at else None,
+    }
+
+@login_required
+@require_http_methods(["GET", "POST"])
+@token_scope(None)
+def api_tokens(request):
+    """
+    GET  /api/tokens  -> tokens of the current space
+    POST /api/tokens  Body JSON: { "name": "ci", "scopes": ["read", "upload"], "expires_days": 90 }
+         Returns the raw token once; only its key_id is stored.
+    """
+    space = get_current_space(request)
+    if not space: return JsonResponse({'ok': False, 'error': 'no space'}, status=400)
+    if request.method == 'GET':
+        return JsonResponse({'ok': True, 'items': [_token_json(t) for t in space.api_tokens.order_by('-id')]})
+    try:
+        data = json.loads(request.body.decode('utf-8') or "{}")
+        name = str(data.get('name') or '').strip()[:64]
+        scopes = set(data.get('scopes') or ['read'])
+        days = int(data.get('expires_days') or 0)
+    except Exception:
+        return JsonResponse({'ok': False, 'error': 'bad request'}, status=400)
+    if not name: return JsonResponse({'ok': False, 'error': 'name required'}, status=400)
+    if not scopes <= set(ApiToken.SCOPES):
+        return JsonResponse({'ok': False, 'error': f'scopes must be within {list(ApiToken.SCOPES)}'}, status=400)
+    expires_at = timezone.now() + timedelta(days=days) if days > 0 else None
+    t, raw = auth.issue(space, name, scopes, expires_at)
+    return JsonResponse({'ok': True, 'token': raw, **_token_json(t)}, status=201)
+
+@login_required
+@require_POST
+@token_scope(None)
+def api_token_revoke(request, tid: int):
+    """POST /api/tokens/<id>/revoke"""
+    space = get_current_space(request)
+    t = ApiToken.objects.filter(space=space, id=tid).first() if space else None
+    if not t: return JsonResponse({'ok': False, 'error': 'not found'}, status=404)
+    auth.revoke(t)
+    return JsonResponse({'ok': True})
+
+# ---------- origin fallback (cold tier rehydration) ----------
+
+@require_GET
+def cdn_origin(request, path: str):
+    """
+    GET /api/origin/<name_spase>/<slug>/<rel_path>/<name>
+    nginx falls back here when a /cdn/ file is missing on disk (try_files).
+    Cold assets are rehydrated to CDN_ROOT and served by nginx via X-Accel-Redirect.
+    """
+    parts = [p for p in path.split('/') if p]
+    if len(parts) < 3: return JsonResponse({'ok': False, 'error': 'not found'}, status=404)
+    ns, slug, name = parts[0], parts[1], parts[-1]
+    rel = '/'.join(parts[2:-1])
+    a = Asset.objects.select_related('space__owner').filter(
+        space__owner__name_spase=ns, space__slug=slug, rel_path=rel, original_name=name, is_public=True
+    ).first()
+    # a hot row whose file is gone (deleted out of band) must 404: redirecting would land
+    # on try_files -> @origin again until nginx gives up with a 500
+    if not a or not tiering.ensure_hot(a) or not tiering.hot_path(a).exists():
+        return JsonResponse({'ok': False, 'error': 'not found'}, status=404)
+    resp = HttpResponse(content_type=a.mime)
+    resp['X-Accel-Redirect'] = a.public_url
     return resp
@@ -0,0 +1,476 @@
+"""Sync out-of-band changes under CDN_ROOT (rsync, scp, ...) into the Asset index.
+
+`manage.py watch_cdn` keeps an inotify watch on every directory of the tree
+(through ctypes, no extra package) and turns events into paths to reconcile.
+Events are coalesced per path and a path is applied only after it has been
+quiet for WATCH_SETTLE_SECONDS, so a file written in many chunks, or one the
+API is writing itself, costs one lookup. Settled paths are applied in bulk:
+one query per folder to load rows, then bulk_create / bulk_update / delete,
+one counter UPDATE per space and one change-feed insert per kind.
+
+Reconciling is stat-based: the outcome depends on what is on disk now, not on
+the order of events. Directory moves are paired by cookie and rewrite rel_path
+with a single UPDATE. A full scandir reconcile runs every WATCH_RESCAN_SECONDS,
+after an inotify queue overflow, and is the only mode where inotify is
+missing.
+
+Never touched: cold-tier rows (their hot file is gone on purpose), anything
+below a symlinked folder (live releases own those rows), dotfiles, `*.part` /
+`*.tmp` and image derivatives (`x.png.webp` next to `x.png`). Rows with those
+names that came in through the API are left alone too.
+"""
+from __future__ import annotations
+import os, stat, time, select, struct, logging, ctypes, ctypes.util
+from collections import OrderedDict
+from pathlib import Path
+from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.db.models import F, Value, CharField
+from django.db.models.functions import Concat, Substr
+from .models import Space, Asset, AssetChange
+from .utils import guess_mime
+from . import changes, fileops, imageopt
+
+log = logging.getLogger(__name__)
+
+# <sys/inotify.h>
+IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO = 0x8, 0x40, 0x80
+IN_CREATE, IN_DELETE, IN_DELETE_SELF = 0x100, 0x200, 0x400
+IN_Q_OVERFLOW, IN_IGNORED, IN_ISDIR = 0x4000, 0x8000, 0x40000000
+IN_ONLYDIR, IN_DONT_FOLLOW = 0x01000000, 0x02000000
+IN_NONBLOCK, IN_CLOEXEC = 0o4000, 0o2000000
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+              | IN_ONLYDIR | IN_DONT_FOLLOW)
+_EVENT = struct.Struct('iIII')
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    _libc.inotify_init1  # noqa: B018 - raises AttributeError off Linux
+    INOTIFY_AVAILABLE = True
+except (OSError, AttributeError):
+    _libc = None
+    INOTIFY_AVAILABLE = False
+
+IMAGE_EXTS = ('.png', '.jpg', '.jpeg')
+
+
+def ignored(path: str) -> bool:
+    """Files the index leaves alone: temp files, and derivatives sitting next to their original."""
+    name = os.path.basename(path)
+    if name.startswith('.') or name.endswith(('.part', '.tmp')): return True
+    low = name.lower()
+    return (low.endswith(imageopt.DERIVATIVE_EXTS) and low[:-5].endswith(IMAGE_EXTS)
+            and os.path.lexists(path[:-5]))
+
+
+class Inotify:
+    def __init__(self):
+        self.fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0: raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+    def add(self, path: str) -> int:
+        wd = _libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, f"inotify_add_watch({path}): {os.strerror(err)}")
+        return wd
+
+    def read(self):
+        """Yield (wd, mask, cookie, name) for everything queued right now."""
+        while True:
+            try:
+                buf = os.read(self.fd, 1 << 20)
+            except BlockingIOError:
+                return
+            off = 0
+            while off < len(buf):
+                wd, mask, cookie, n = _EVENT.unpack_from(buf, off)
+                off += _EVENT.size
+                name = os.fsdecode(buf[off:off + n].rstrip(b'\0'))
+                off += n
+                yield wd, mask, cookie, name
+
+    def close(self):
+        os.close(self.fd)
+
+
+# ---------- applying changes ----------
+
+class Index:
+    """Maps disk paths to spaces and writes batches of reconciled paths."""
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.spaces: dict[tuple[str, str], Space | None] = {}
+
+    def locate(self, path: str) -> tuple[Space, str, str] | None:
+        """(space, rel_path, name) of a file path, None outside any space."""
+        parts = Path(path).relative_to(self.root).parts
+        if len(parts) < 3: return None
+        space = self.space(parts[0], parts[1])
+        return (space, '/'.join(parts[2:-1]), parts[-1]) if space else None
+
+    def space(self, ns: str, slug: str) -> Space | None:
+        key = (ns, slug)
+        if key not in self.spaces:
+            self.spaces[key] = Space.objects.select_related('owner').filter(owner__name_spase=ns, slug=slug).first()
+        return self.spaces[key]
+
+    def space_root(self, space: Space) -> Path:
+        return self.root / space.owner.name_spase / space.slug
+
+    def apply_paths(self, paths, renames: dict[str, str] | None = None) -> dict:
+        """Reconcile file paths against their rows; renames maps new path -> old path."""
+        renames = renames or {}
+        groups: dict[int, tuple[Space, list]] = {}
+        for p in paths:
+            if ignored(p): continue
+            loc = self.locate(p)
+            if loc is None: continue
+            try:
+                st = os.lstat(p)
+                size = st.st_size if stat.S_ISREG(st.st_mode) else None
+            except FileNotFoundError:
+                size = None
+            groups.setdefault(loc[0].id, (loc[0], []))[1].append((loc[1], loc[2], size, renames.get(p)))
+        stats = {'created': 0, 'updated': 0, 'deleted': 0, 'renamed': 0}
+        for space, entries in groups.values():
+            for k, v in self._apply_space(space, entries).items(): stats[k] += v
+        return stats
+
+    def _apply_space(self, space: Space, entries: list) -> dict:
+        keys = {(rel, name) for rel, name, _, _ in entries}
+        olds = {}
+        for rel, name, size, old in entries:
+            if old and size is not None:
+                loc = self.locate(old)
+                if loc and loc[0].id == space.id: olds[(rel, name)] = (loc[1], loc[2])
+        keys |= set(olds.values())
+        rows = {}
+        keys_l = list(keys)
+        for i in range(0, len(keys_l), fileops.BATCH):
+            for a in fileops.items_query(space, keys_l[i:i + fileops.BATCH]).only(
+                    'id', 'rel_path', 'original_name', 'size', 'tier'):
+                rows[(a.rel_path, a.original_name)] = a
+
+        new, updated, renamed, gone = [], [], [], []
+        for rel, name, size, _ in entries:
+            a = rows.get((rel, name))
+            if size is None:
+                if a and a.tier == Asset.TIER_HOT: gone.append(a)
+            elif a is None:
+                src = rows.get(olds.get((rel, name)))
+                old_p = self.space_root(space) / src.rel_path / src.original_name if src else None
+                if src and src.tier == Asset.TIER_HOT and not os.path.lexists(old_p):
+                    rows.pop((src.rel_path, src.original_name))
+                    renamed.append((src, src.rel_path, src.original_name, rel, name, size))
+                else:
+                    new.append(Asset(space=space, rel_path=rel, original_name=name, size=size,
+                                     mime=guess_mime(name), is_public=True))
+            elif a.tier == Asset.TIER_HOT and a.size != size:
+                updated.append((a, size))
+        gone = [a for a in gone if a.id not in {r[0].id for r in renamed}]
+        return self._write(space, new, updated, renamed, gone)
+
+    def _write(self, space: Space, new: list[Asset], updated: list, renamed: list, gone: list[Asset]) -> dict:
+        for attempt in (1, 2):
+            try:
+                with transaction.atomic():
+                    return self._write_once(space, new, updated, renamed, gone)
+            except IntegrityError:
+                if attempt == 2: raise  # the API created some of these rows meanwhile; re-check once
+
+    def _write_once(self, space, new, updated, renamed, gone) -> dict:
+        if new:  # rows the API created since the lookup are skipped
+            have = set(fileops.items_query(space, [(a.rel_path, a.original_name) for a in new])
+                       .values_list('rel_path', 'original_name'))
+            new = [a for a in new if (a.rel_path, a.original_name) not in have]
+            Asset.objects.bulk_create(new, batch_size=1000)
+        d_bytes, d_files = sum(a.size for a in new), len(new)
+        if updated:  # re-read under the lock: the API or the optimizer may have accounted for it already
+            cur = dict(Asset.objects.select_for_update().filter(id__in=[a.id for a, _ in updated], tier=Asset.TIER_HOT)
+                       .values_list('id', 'size'))
+            updated = [(a, size) for a, size in updated if cur.get(a.id, size) != size]
+            for a, _ in updated: a.size = cur[a.id]
+        for a, size in updated:
+            d_bytes += size - a.size
+            a.size, a.mime = size, guess_mime(a.original_name)
+            a.sha256 = a.optimized_sha256 = a.source_sha256 = ''
+        if updated:
+            Asset.objects.bulk_update([a for a, _ in updated], ['size', 'mime', 'sha256', 'optimized_sha256', 'source_sha256'],
+                                      batch_size=1000)
+        for a, _, _, rel, name, size in renamed:
+            d_bytes += size - a.size
+            a.rel_path, a.original_name, a.size = rel, name, size
+        if renamed:
+            Asset.objects.bulk_update([r[0] for r in renamed], ['rel_path', 'original_name', 'size'], batch_size=1000)
+        # delete only rows still there and still hot, and release exactly their bytes
+        sizes = dict(Asset.objects.select_for_update().filter(id__in=[a.id for a in gone], tier=Asset.TIER_HOT)
+                     .values_list('id', 'size')) if gone else {}
+        if sizes:
+            Asset.objects.filter(id__in=list(sizes)).delete()
+            d_bytes -= sum(sizes.values()); d_files -= len(sizes)
+        if d_bytes or d_files:
+            Space.objects.filter(id=space.id).update(used_bytes=F('used_bytes') + d_bytes, file_count=F('file_count') + d_files)
+        changes.record_many(space, AssetChange.OP_UPLOAD,
+                            [{'rel_path': a.rel_path, 'name': a.original_name, 'size': a.size} for a in new])
+        changes.record_many(space, AssetChange.OP_UPDATE,
+                            [{'rel_path': a.rel_path, 'name': a.original_name, 'size': a.size} for a, _ in updated])
+        changes.record_many(space, AssetChange.OP_RENAME,
+                            [{'rel_path': r0, 'name': n0, 'new_rel_path': r1, 'new_name': n1, 'size': sz}
+                             for _, r0, n0, r1, n1, sz in renamed])
+        changes.record_many(space, AssetChange.OP_DELETE,
+                            [{'rel_path': a.rel_path, 'name': a.original_name} for a in gone if a.id in sizes])
+        return {'created': len(new), 'updated': len(updated), 'renamed': len(renamed), 'deleted': len(sizes)}
+
+    def move_dir(self, src: str, dst: str) -> int:
+        """A directory was renamed inside the tree: rewrite rel_path of its rows in one UPDATE."""
+        s, d = self._folder(src), self._folder(dst)
+        if not s or not d: return 0
+        if s[0].id != d[0].id:  # moved across spaces: drop + rescan
+            return self.drop_dir(src) + self.apply_paths(list(walk_files(dst)))['created']
+        space, src_rel, dst_rel = s[0], s[1], d[1]
+        with transaction.atomic():
+            n = fileops.folder_assets(space, src_rel).update(
+                rel_path=Concat(Value(dst_rel), Substr('rel_path', len(src_rel) + 1), output_field=CharField()))
+            changes.record(space, AssetChange.OP_FOLDER_MOVE, src_rel, new_rel_path=dst_rel)
+        return n
+
+    def drop_dir(self, path: str) -> int:
+        """A directory vanished: delete its hot rows (cold ones still have their cold file)."""
+        if os.path.lexists(path): return 0
+        loc = self._folder(path)
+        if not loc: return 0
+        space, rel = loc
+        qs = fileops.folder_assets(space, rel).filter(tier=Asset.TIER_HOT)
+        n = 0
+        with transaction.atomic():
+            while batch := list(qs.order_by('id').values_list('id', 'size')[:fileops.BATCH]):
+                Asset.objects.filter(id__in=[i for i, _ in batch]).delete()
+                Space.objects.filter(id=space.id).update(used_bytes=F('used_bytes') - sum(s for _, s in batch),
+                                                         file_count=F('file_count') - len(batch))
+                n += len(batch)
+            if n: changes.record(space, AssetChange.OP_RMDIR, rel)
+        return n
+
+    def _folder(self, path: str) -> tuple[Space, str] | None:
+        parts = Path(path).relative_to(self.root).parts
+        if len(parts) < 3: return None
+        space = self.space(parts[0], parts[1])
+        return (space, '/'.join(parts[2:])) if space else None
+
+    def reconcile(self, space: Space) -> dict:
+        """Full scandir pass over one space: the fallback when events may have been lost."""
+        root = self.space_root(space)
+        on_disk = {}
+        links = []
+        for p, size in walk_files(str(root), with_size=True, symlinks=links):
+            rel, _, name = str(Path(p).relative_to(root)).rpartition('/')
+            on_disk[(rel, name)] = size
+        linked = tuple(str(Path(l).relative_to(root)) + '/' for l in links)
+        new, updated, gone = [], [], []
+        for a in Asset.objects.filter(space=space, tier=Asset.TIER_HOT).only(
+                'id', 'rel_path', 'original_name', 'size', 'tier').iterator(chunk_size=2000):
+            if linked and (a.rel_path + '/').startswith(linked): continue
+            if ignored(os.path.join(root, a.rel_path, a.original_name)): continue  # walk_files skipped it too
+            size = on_disk.pop((a.rel_path, a.original_name), None)
+            if size is None: gone.append(a)
+            elif size != a.size: updated.append((a, size))
+        cold = set(Asset.objects.filter(space=space, tier=Asset.TIER_COLD).values_list('rel_path', 'original_name'))
+        for (rel, name), size in on_disk.items():
+            if (rel, name) not in cold:
+                new.append(Asset(space=space, rel_path=rel, original_name=name, size=size,
+                                 mime=guess_mime(name), is_public=True))
+        stats = {'created': 0, 'updated': 0, 'renamed': 0, 'deleted': 0}
+        step = 2000
+        for i in range(0, max(len(new), len(updated), len(gone)), step):
+            for k, v in self._write(space, new[i:i + step], updated[i:i + step], [], gone[i:i + step]).items():
+                stats[k] += v
+        return stats
+
+def walk_files(top: str, with_size: bool = False, symlinks: list | None = None):
+    """Regular, non-ignored files below `top` via os.scandir; symlinked dirs are not followed."""
+    stack = [top]
+    while stack:
+        d = stack.pop()
+        try:
+            it = os.scandir(d)
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        with it:
+            for e in it:
+                if e.is_symlink():
+                    if symlinks is not None and e.is_dir(): symlinks.append(e.path)
+                    continue
+                if e.is_dir(follow_symlinks=False):
+                    stack.append(e.path)
+                elif e.is_file(follow_symlinks=False) and not ignored(e.path):
+                    yield (e.path, e.stat(follow_symlinks=False).st_size) if with_size else e.path
+
+
+# ---------- event loop ----------
+
+class Watcher:
+    def __init__(self, root: Path | None = None, log_fn=None):
+        self.root = Path(root or settings.CDN_ROOT)
+        self.index = Index(self.root)
+        self.log = log_fn or (lambda msg: None)
+        self.ino: Inotify | None = None
+        self.wd_path: dict[int, str] = {}
+        self.path_wd: dict[str, int] = {}
+        self.pending: OrderedDict[str, float] = OrderedDict()   # file path -> last event time
+        self.moves_from: dict[int, tuple[str, bool, float]] = {}  # cookie -> (path, is_dir, t)
+        self.renames: dict[str, str] = {}                        # new file path -> old file path
+        self.dir_ops: list[tuple[float, str, str, str]] = []     # (t, op, path, dst)
+        self.overflow = False
+
+    # -- watches --
+    def watch_tree(self, top: str, mark_files: bool = False):
+        """Watch `top` and all directories below it; optionally queue the files found (new dirs)."""
+        stack = [top]
+        while stack:
+            d = stack.pop()
+            if os.path.islink(d): continue
+            try:
+                wd = self.ino.add(d)
+            except OSError as e:
+                if e.errno == 28:  # ENOSPC: fs.inotify.max_user_watches
+                    log.error("out of inotify watches at %s; raise fs.inotify.max_user_watches", d)
+                continue
+            self.wd_path[wd] = d; self.path_wd[d] = wd
+            try:
+                with os.scandir(d) as it:
+                    for e in it:
+                        if e.is_dir(follow_symlinks=False): stack.append(e.path)
+                        elif mark_files and e.is_file(follow_symlinks=False): self.touch(e.path)
+            except FileNotFoundError:
+                pass
+
+    def _forget(self, path: str):
+        prefix = path + os.sep
+        for p in [p for p in self.path_wd if p == path or p.startswith(prefix)]:
+            self.wd_path.pop(self.path_wd.pop(p), None)
+
+    def _rebase(self, src: str, dst: str):
+        prefix = src + os.sep
+        for p in [p for p in self.path_wd if p == src or p.startswith(prefix)]:
+            wd = self.path_wd.pop(p)
+            np = dst + p[len(src):]
+            self.path_wd[np] = wd; self.wd_path[wd] = np
+
+    # -- events --
+    def touch(self, path: str, t: float | None = None):
+        self.pending[path] = time.monotonic() if t is None else t
+        self.pending.move_to_end(path)
+
+    def handle(self, wd: int, mask: int, cookie: int, name: str):
+        now = time.monotonic()
+        if mask & IN_Q_OVERFLOW:
+            self.overflow = True; return
+        base = self.wd_path.get(wd)
+        if base is None: return
+        if mask & IN_IGNORED:
+            self.wd_path.pop(wd, None); self.path_wd.pop(base, None); return
+        if mask & IN_DELETE_SELF: return  # handled via the parent's IN_DELETE
+        path = os.path.join(base, name)
+        is_dir = bool(mask & IN_ISDIR)
+        if mask & IN_MOVED_FROM:
+            self.moves_from[cookie] = (path, is_dir, now); return
+        if mask & IN_MOVED_TO:
+            src = self.moves_from.pop(cookie, None)
+            if is_dir:
+                if src:
+                    self._rebase(src[0], path)
+                    self.dir_ops.append((now, 'move', src[0], path))
+                else:
+                    self.watch_tree(path, mark_files=True)
+            else:
+                if src: self.renames[path] = src[0]; self.touch(src[0], now)
+                self.touch(path, now)
+            return
+        if is_dir:
+            if mask & IN_CREATE: self.watch_tree(path, mark_files=True)
+            elif mask & IN_DELETE:
+                self._forget(path); self.dir_ops.append((now, 'drop', path, ''))
+            return
+        self.touch(path, now)
+
+    def _settled(self, now: float) -> tuple[list[str], dict[str, str]]:
+        settle = settings.WATCH_SETTLE_SECONDS
+        # unpaired moves: the other end is outside the tree
+        for cookie, (path, is_dir, t) in list(self.moves_from.items()):
+            if now - t >= settle:
+                del self.moves_from[cookie]
+                if is_dir:
+                    self._forget(path); self.dir_ops.append((t, 'drop', path, ''))
+                else:
+                    self.touch(path, t)
+        paths = []
+        while self.pending and len(paths) < settings.WATCH_BATCH:
+            path, t = next(iter(self.pending.items()))
+            if now - t < settle: break
+            self.pending.popitem(last=False)
+            paths.append(path)
+        renames = {p: self.renames.pop(p) for p in paths if p in self.renames}
+        return paths, renames
+
+    def flush(self, now: float | None = None) -> int:
+        """Apply settled directory ops and up to WATCH_BATCH settled paths; returns paths applied."""
+        now = time.monotonic() if now is None else now
+        settle = settings.WATCH_SETTLE_SECONDS
+        ready = [op for op in self.dir_ops if now - op[0] >= settle]
+        if ready:
+            self.dir_ops = [op for op in self.dir_ops if now - op[0] < settle]
+            for _, op, path, dst in ready:
+                n = self.index.move_dir(path, dst) if op == 'move' else self.index.drop_dir(path)
+                if n: self.log(f"{op} {path} {dst}: {n} rows")
+        paths, renames = self._settled(now)
+        if not paths: return 0
+        stats = self.index.apply_paths(paths, renames)
+        if any(stats.values()): self.log(f"{len(paths)} paths: {stats}")
+        return len(paths)
+
+    def rescan(self) -> dict:
+        self.index.spaces.clear()
+        total = {'created': 0, 'updated': 0, 'renamed': 0, 'deleted': 0}
+        for space in Space.objects.select_related('owner'):
+            for k, v in self.index.reconcile(space).items(): total[k] += v
+        self.log(f"rescan: {total}")
+        return total
+
+    def run(self, stop, use_inotify: bool = True):
+        """Main loop until `stop` (a threading.Event) is set."""
+        self.root.mkdir(parents=True, exist_ok=True)
+        rescan_every = settings.WATCH_RESCAN_SECONDS
+        if use_inotify and INOTIFY_AVAILABLE:
+            self.ino = Inotify()
+            self.watch_tree(str(self.root))
+            self.log(f"watching {len(self.wd_path)} directories")
+        else:
+            self.log("inotify not available: scandir polling only")
+            rescan_every = rescan_every or 300
+        self.rescan()  # catch up on what happened while we were not running
+        last_rescan = time.monotonic()
+        tick = settings.WATCH_DEBOUNCE_MS / 1000
+        backlog = False
+        try:
+            while not stop.is_set():
+                if self.ino:
+                    # drain the kernel queue between batches so it does not overflow under load
+                    r, _, _ = select.select([self.ino.fd], [], [], 0 if backlog else tick)
+                    if r:
+                        for ev in self.ino.read(): self.handle(*ev)
+                else:
+                    stop.wait(tick)
+                now = time.monotonic()
+                if self.overflow:
+                    # events were dropped: rebuild watches and reconcile everything
+                    self.overflow = False
+                    self.wd_path.clear(); self.path_wd.clear()
+                    self.ino.close(); self.ino = Inotify(); self.watch_tree(str(self.root))
+                    self.rescan(); last_rescan = now
+                elif rescan_every and now - last_rescan >= rescan_every:
+                    self.rescan(); last_rescan = now
+                backlog = self.flush(now) >= settings.WATCH_BATCH
+        finally:
+            if self.ino: self.ino.close()
@@ -16,13 +16,36 @@ const fmtSize = n => { const u=['B','KB','MB','GB','TB']; let i=0; while(n>=1024
 const pct = (a,b) => b? Math.min(100, Math.round(a/b*100)) : 0;
 const joinPath = (...p) => p.filter(Boolean).join('/');
 const debounce = (fn,t)=>{ let id; return (...a)=>{ clearTimeout(id); id=setTimeout(()=>fn(...a),t);} };
+const csrfToken = () => (document.cookie.match(/(?:^|;\s*)csrftoken=([^;]+)/)||[])[1] || '';
+const withCsrf = (h={}) => ({ ...h, 'X-CSRFToken': csrfToken() });
 async function fetchJson(url, opts={}) {
-  const res = await fetch(url, { headers: { 'Accept': 'application/json' }, ...opts });
+  const method = (opts.method || 'GET').toUpperCase();
+  let headers = { 'Accept': 'application/json', ...(opts.headers||{}) };
+  if (method !== 'GET' && method !== 'HEAD') headers = withCsrf(headers);
+  const res = await fetch(url, { ...opts, headers });
   if (res.status === 204) return { ok: true };
   const text = await res.text();
   try { return JSON.parse(text); } catch { return { ok: false, __raw: text }; }
 }
 
+// Folder listings cached by path; revalidated with If-None-Match, a 304 reuses the cached copy
+const listingCache = new Map(); // path -> {etag, data, fresh}
+async function fetchListing(path){
+  const hit = listingCache.get(path);
+  if (hit && hit.fresh) { hit.fresh = false; return hit.data; } // seeded by /api/bootstrap
+  const headers = { 'Accept': 'application/json' };
+  if (hit) headers['If-None-Match'] = hit.etag;
+  let res;
+  try { res = await fetch(`/api/browse?rel_path=${encodeURIComponent(path)}`, { headers, cache: 'no-store' }); }
+  catch { return hit ? hit.data : { ok: false }; }
+  if (res.status === 304 && hit) return hit.data;
+  let j;
+  try { j = await res.json(); } catch { return { ok: false }; }
+  const etag = res.headers.get('ETag');
+  if (res.ok && j.ok && etag) listingCache.set(path, { etag, data: j, fresh: false });
+  return j;
+}
+
 // ---------- Global state ----------
 let currentPath = '';
 let selected = new Set();
@@ -74,7 +97,10 @@ tabUpload?.addEventListener('click', ()=>switchTab('upload'));
 async function loadSpaces(){
   const j = await fetchJson('/api/spaces');
   if(!j || (!j.ok && !Array.isArray(j.items))){ showToast('Failed to load spaces'); return; }
-  spaces = j.items || [];
+  renderSpaces(j.items || []);
+}
+function renderSpaces(items){
+  spaces = items;
   const sel = $('#spaceSel'); sel.innerHTML = '';
   spaces.forEach(s=>{
     const opt=document.createElement('option');
@@ -93,6 +119,7 @@ $('#spaceSel')?.addEventListener('change', async (e)=>{
   const j = await fetchJson('/api/space/set',{method:'POST',headers:{'Content-Type':'application/json'},body:JSON.stringify({space_id:id})});
   if(!j || !j.ok){ showToast('Failed to switch space'); return; }
   currentSpaceId = +id;
+  listingCache.clear();
   const s = spaces.find(x=>x.id==id); if(s) updateUsage(s);
   currentPath=''; await reloadAll();
 });
@@ -138,7 +165,7 @@ function makeTreeNode(relPath, name, isRoot=false){
       childrenWrap = document.createElement('div');
       childrenWrap.className = 'children';
       node.after(childrenWrap);
-      const j = await fetchJson(`/api/browse?rel_path=${encodeURIComponent(node.dataset.path || '')}`);
+      const j = await fetchListing(node.dataset.path || '');
       if ((j.ok || j.folders || j.files) && Array.isArray(j.folders)) {
         j.folders.forEach(fname => childrenWrap.appendChild(makeTreeNode(node.dataset.path || '', fname, false)));
       }
@@ -177,7 +204,7 @@ async function buildTreeRoot(){
   treeRoot.innerHTML = '';
   const root = makeTreeNode('', '', true);
   treeRoot.appendChild(root);
-  const j = await fetchJson('/api/browse?rel_path=');
+  const j = await fetchListing('');
   if ((j.ok || j.folders || j.files) && Array.isArray(j.folders)) {
     const wrap = document.createElement('div');
     wrap.className = 'children';
@@ -331,6 +358,24 @@ ctx?.addEventListener('click', async (e)=>{
   }
 });
 
+// ---------- Background jobs ----------
+// Heavy ops answer 202 + {job}; poll until it finishes, showing progress in the toast.
+async function waitJob(job, label){
+  while(job.state === 'queued' || job.state === 'running'){
+    showToast(`${label}… ${job.total ? pct(job.progress, job.total)+'%' : job.state}`, 1500);
+    await new Promise(r => setTimeout(r, 1000));
+    const j = await fetchJson(`/api/jobs/${job.id}`);
+    if(!j.ok) break;
+    job = j.job;
+  }
+  return job;
+}
+async function settle(j, label){
+  if(!j.ok || !j.job) return j;
+  const job = await waitJob(j.job, label);
+  return job.state === 'done' ? { ok: true, ...job.result } : { ok: false, error: job.error || `job ${job.state}` };
+}
+
 // ---------- Folder ops ----------
 async function renameFolder(relPath, oldName){
   const newName = await showModal({title:'Rename / Move Folder', text:'New folder name:', withInput:true, placeholder:oldName, okText:'Next'});
@@ -342,7 +387,7 @@ async function renameFolder(relPath, oldName){
     new_rel_path: (newRel||relPath||''),
     new_name: (newName||oldName)
   };
-  const j = await fetchJson('/api/folder/move',{method:'POST', headers:{'Content-Type':'application/json'}, body:JSON.stringify(body)});
+  const j = await settle(await fetchJson('/api/folder/move',{method:'POST', headers:{'Content-Type':'application/json'}, body:JSON.stringify(body)}), 'Moving folder');
   if(!j.ok){ showToast('Folder rename/move failed'); return; }
   showToast('Folder updated'); await reloadAll();
 }
@@ -359,9 +404,9 @@ async function deleteFolder(relPath, name, recursive){
   }
   const path = joinPath(relPath||'', name);
   const url = `/api/rmdir?rel_path=${encodeURIComponent(path)}&recursive=${recursive?1:0}`;
-  const j = await fetchJson(url, { method:'DELETE' });
+  const j = await settle(await fetchJson(url, { method:'DELETE' }), 'Deleting folder');
   if(!j.ok){ showToast(j.error || 'Folder delete failed'); return; }
-  showToast('Folder deleted'); await reloadAll();
+  showToast('Folder deleted'); await loadSpaces(); await reloadAll();
 }
 
 // ---------- File ops ----------
@@ -390,7 +435,7 @@ async function browse(){
   navLock = true;
   $('#skeleton').classList.remove('hidden'); grid.innerHTML=''; emptyState.classList.add('hidden');
   try{
-    const j = await fetchJson(`/api/browse?rel_path=${encodeURIComponent(currentPath)}`);
+    const j = await fetchListing(currentPath);
     if (!(j.ok || j.folders || j.files)) { showToast('Failed to load folder'); return; }
     cacheFolders = Array.isArray(j.folders) ? j.folders : [];
     cacheFiles   = Array.isArray(j.files)   ? j.files   : [];
@@ -432,7 +477,7 @@ async function renameFile(oldName){
   if(newName===null) return;
   const newPath = await showModal({title:'Move (optional)', text:'Enter new relative path (empty = stay here):', withInput:true, placeholder: currentPath || '', okText:'Apply'});
   const body = { old_rel_path: currentPath, old_name: oldName, new_rel_path: (newPath||currentPath), new_name: (newName || oldName) };
-  const r = await fetch('/api/rename',{method:'POST', headers:{'Content-Type':'application/json'}, body:JSON.stringify(body)});
+  const r = await fetch('/api/rename',{method:'POST', headers:withCsrf({'Content-Type':'application/json'}), body:JSON.stringify(body)});
   const j = await r.json().catch(()=>({ok:false}));
   if(!j.ok){ showToast('Rename failed'); return; }
   showToast('Renamed'); await reloadAll();
@@ -441,7 +486,7 @@ async function renameFile(oldName){
 async function deleteFile(name){
   const ok = await showModal({title:'Delete file', text:`Delete "${name}"?`, okText:'Delete', danger:true});
   if(!ok) return;
-  const r = await fetch('/api/delete',{method:'POST', headers:{'Content-Type':'application/json'}, body:JSON.stringify({rel_path: currentPath, name})});
+  const r = await fetch('/api/delete',{method:'POST', headers:withCsrf({'Content-Type':'application/json'}), body:JSON.stringify({rel_path: currentPath, name})});
   const j = await r.json().catch(()=>({ok:false}));
   if(!j.ok){ showToast('Delete failed'); return; }
   showToast('Deleted');
@@ -451,10 +496,18 @@ async function deleteFile(name){
 $('#actZip')?.addEventListener('click', async ()=>{
   if(!selected.size) return;
   const items = Array.from(selected).map(n=>({rel_path: currentPath, name:n}));
-  const res = await fetch('/api/zip',{method:'POST', headers:{'Content-Type':'application/json'}, body:JSON.stringify({items})});
+  const res = await fetch('/api/zip',{method:'POST', headers:withCsrf({'Content-Type':'application/json'}), body:JSON.stringify({items})});
   if(!res.ok){ showToast('ZIP failed'); return; }
-  const blob = await res.blob(); const url = URL.createObjectURL(blob);
-  const a = document.createElement('a'); a.href=url; a.download='download.zip'; document.body.appendChild(a); a.click(); a.remove(); URL.revokeObjectURL(url);
+  let url;
+  if(res.status === 202){
+    const j = await settle(await res.json(), 'Building ZIP');
+    if(!j.ok){ showToast(j.error || 'ZIP failed'); return; }
+    url = j.download;
+  } else {
+    url = URL.createObjectURL(await res.blob());
+  }
+  const a = document.createElement('a'); a.href=url; a.download='download.zip'; document.body.appendChild(a); a.click(); a.remove();
+  if(url.startsWith('blob:')) URL.revokeObjectURL(url);
 });
 
 $('#actDelete')?.addEventListener('click', async ()=>{
@@ -462,7 +515,7 @@ $('#actDelete')?.addEventListener('click', async ()=>{
   const ok = await showModal({title:'Delete selected', text:`Delete ${selected.size} files?`, okText:'Delete', danger:true});
   if(!ok) return;
   const items = Array.from(selected).map(n=>({rel_path: currentPath, name:n}));
-  const j = await fetchJson('/api/delete-batch',{method:'POST', headers:{'Content-Type':'application/json'}, body:JSON.stringify({items})});
+  const j = await settle(await fetchJson('/api/delete-batch',{method:'POST', headers:{'Content-Type':'application/json'}, body:JSON.stringify({items})}), 'Deleting');
   if(!j.ok) showToast('Batch delete failed'); else showToast(`Deleted ${j.deleted}, failed ${j.failed}`);
   await loadSpaces(); await reloadAll();
 });
@@ -518,7 +571,7 @@ folderInput?.addEventListener('change', e=>{
 });
 function xhrUpload(url, formData, onProgress){
   return new Promise((resolve,reject)=>{
-    const x=new XMLHttpRequest(); x.open('POST', url);
+    const x=new XMLHttpRequest(); x.open('POST', url); x.setRequestHeader('X-CSRFToken', csrfToken());
     x.upload.onprogress = e => onProgress(e.loaded, e.total);
     x.onload = () => (x.status>=200&&x.status<300) ? resolve(x.responseText) : reject(x.responseText);
     x.onerror = () => reject('network'); x.send(formData);
@@ -547,11 +600,14 @@ $('#startUpload')?.addEventListener('click', async ()=>{
 
 // ---------- Allowed extensions badge ----------
 async function loadAllowedExts(){
+  const j = await fetchJson('/api/allowed-extensions');
+  renderAllowedExts((j.ok || j.items) && Array.isArray(j.items) ? j.items : []);
+}
+function renderAllowedExts(items){
   const badge = $('#allowedBadge');
   const info  = $('#extInfo');
-  const j = await fetchJson('/api/allowed-extensions');
-  if ((j.ok || j.items) && Array.isArray(j.items) && j.items.length) {
-    const list = j.items.join(', ');
+  if (items.length) {
+    const list = items.join(', ');
     if (badge){ badge.textContent = `Allowed: ${list}`; badge.classList.remove('hidden'); }
     if (info){ info.textContent  = `Allowed: ${list}`; }
   } else {
@@ -562,13 +618,19 @@ async function loadAllowedExts(){
 
 // ---------- Init ----------
 async function init(){
-  await loadSpaces();
+  // one round trip for spaces, allowlist and the root listing
+  const j = await fetchJson('/api/bootstrap');
+  if (j && j.ok) {
+    renderSpaces(j.spaces || []);
+    renderAllowedExts(j.allowed_extensions || []);
+    const { etag, ...listing } = j.browse;
+    listingCache.set(listing.path, { etag, data: { ok: true, ...listing }, fresh: true });
+  } else {
+    await loadSpaces();
+    await loadAllowedExts();
+  }
   switchTab('explorer');
-  buildTreeRoot();
   await reloadAll();
   $('#currentPathHint').textContent = '/'+currentPath;
-  fetch('/api/allowed-extensions').then(r=>r.json()).then(j=>{
-    $('#extInfo').textContent = j.ok ? `Allowed: ${j.items.join(', ')}` : 'Allowed: (error)';
-  }).catch(()=> $('#extInfo').textContent = 'Allowed: (error)');
 }
 document.readyState === 'loading' ? document.addEventListener('DOMContentLoaded', init) : init();